@@ -5,144 +5,3289 @@ Usando Google Gemini
 """
 
 import os
+import io
 import re
-import csv
+import asyncio
+import sys
 import json
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from datetime import datetime
+import time
+import random
+import signal
+import bisect
+import hashlib
+import sqlite3
+import secrets
+import atexit
+import threading
+import logging
+import contextvars
+import queue as queue_module
+from logging.handlers import QueueHandler, QueueListener
+try:
+    import fcntl
+except ImportError:  # Windows: sem lock entre processos (use um único worker)
+    fcntl = None
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
-from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator, Optional
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from collections import OrderedDict
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import httpx
 
+# Fim das importações: o detalhamento da inicialização mede o módulo a partir daqui
+MODULE_STARTED = time.perf_counter()
+
 # Configuração
 DATA_DIR = Path(__file__).parent.parent / "data"
 CSV_FILE = DATA_DIR / "leads_imobiliaria.csv"
+LEADS_DB_FILE = Path(os.environ.get("LEADS_DB_PATH", DATA_DIR / "leads.db"))
+# Leads que não puderam ser gravados no banco (último recurso para não perder dados)
+UNSAVED_LEADS_FILE = DATA_DIR / "leads_unsaved.jsonl"
+# Base local de distritos e áreas de Londres (borough, zona, fatos das áreas)
+AREAS_FILE = Path(os.environ.get("AREAS_FILE", Path(__file__).parent / "london_areas.json"))
+# Frontend (templates e static) e as variantes comprimidas geradas no build
+FRONTEND_DIR = Path(__file__).parent.parent / "frontend"
+ASSETS_DIST_DIR = Path(os.environ.get("ASSETS_DIST_DIR", FRONTEND_DIR / "dist"))
+
+# Colunas dos leads (mesma ordem do CSV original)
+LEAD_FIELDS = [
+    "timestamp",
+    "nome",
+    "whatsapp",
+    "email",
+    "tipo_interesse",
+    "orcamento",
+    "postcode",
+    "detalhes_adicionais",
+    "email_valido",
+    "postcode_valido"
+]
+
+# Colunas derivadas do postcode pelo índice de áreas (só no banco, fora do CSV)
+AREA_FIELDS = ("distrito", "borough", "zona")
+STORE_FIELDS = LEAD_FIELDS + list(AREA_FIELDS)
+# Colunas da exportação (o id serve de cursor para retomar)
+EXPORT_FIELDS = ["id"] + STORE_FIELDS
+# Colunas repetitivas, gravadas como dicionário + códigos no formato colunar
+COLUMNAR_DICTIONARY_FIELDS = ("tipo_interesse", "email_valido", "postcode_valido", "distrito", "borough", "zona")
 
 # Garantir que o diretório de dados existe
 DATA_DIR.mkdir(exist_ok=True)
 
-# API Key do Gemini
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY", "").strip()
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GOOGLE_API_KEY}"
+# API Key do Gemini
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY", "").strip()
+# Base configurável para permitir apontar para um stub local em testes
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_API_URL = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent?key={GOOGLE_API_KEY}"
+GEMINI_STREAM_URL = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={GOOGLE_API_KEY}"
+GEMINI_CACHE_URL = f"{GEMINI_API_BASE}/cachedContents"
+
+# Context caching do SYSTEM_PROMPT (com fallback para instruções inline)
+GEMINI_CONTEXT_CACHE_CONFIG = {
+    # Desligado por padrão: o SYSTEM_PROMPT atual fica abaixo do mínimo de tokens do cachedContent
+    "enabled": os.environ.get("GEMINI_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes"),
+    # Mínimo aceito pelo Gemini para um cachedContent (depende do modelo)
+    "min_tokens": int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "4096")),
+    "ttl_seconds": int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600")),
+    "refresh_margin": int(os.environ.get("GEMINI_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS", "300")),
+    "retry_after": int(os.environ.get("GEMINI_CONTEXT_CACHE_RETRY_SECONDS", "600")),
+}
+
+# Pool HTTP compartilhado para o Gemini (keep-alive + HTTP/2)
+GEMINI_HTTP_CONFIG = {
+    "http2": os.environ.get("GEMINI_HTTP2", "true").lower() in ("1", "true", "yes"),
+    "max_connections": int(os.environ.get("GEMINI_POOL_MAX_CONNECTIONS", "20")),
+    "max_keepalive_connections": int(os.environ.get("GEMINI_POOL_MAX_KEEPALIVE", "10")),
+    "keepalive_expiry": float(os.environ.get("GEMINI_KEEPALIVE_EXPIRY", "60")),
+    "connect_timeout": float(os.environ.get("GEMINI_CONNECT_TIMEOUT", "5")),
+    "read_timeout": float(os.environ.get("GEMINI_READ_TIMEOUT", "30")),
+    "write_timeout": float(os.environ.get("GEMINI_WRITE_TIMEOUT", "10")),
+    "pool_timeout": float(os.environ.get("GEMINI_POOL_TIMEOUT", "10")),
+}
+
+# Processos do uvicorn (--workers); WEB_CONCURRENCY é a convenção do Render/Heroku
+WEB_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+# Identifica este processo nos claims do estado compartilhado
+WORKER_ID = f"{os.getpid()}-{secrets.token_hex(3)}"
+
+# Agendamento das chamadas ao Gemini: concorrência, taxa, retries e circuit breaker.
+# Concorrência e taxa são limites do serviço inteiro, divididos entre os workers.
+GEMINI_SCHEDULER_CONFIG = {
+    "max_concurrency": max(1, int(os.environ.get("GEMINI_MAX_CONCURRENCY", "16")) // WEB_WORKERS),
+    # Token bucket: requisições por segundo e rajada máxima (0 desativa)
+    "rate_per_second": float(os.environ.get("GEMINI_RATE_PER_SECOND", "30")) / WEB_WORKERS,
+    "burst": max(1, int(os.environ.get("GEMINI_RATE_BURST", "30")) // WEB_WORKERS),
+    "max_retries": int(os.environ.get("GEMINI_MAX_RETRIES", "3")),
+    "retry_base": float(os.environ.get("GEMINI_RETRY_BASE_SECONDS", "0.5")),
+    "retry_max": float(os.environ.get("GEMINI_RETRY_MAX_SECONDS", "8")),
+    # Tempo máximo de espera (fila + retries) antes de responder "tente novamente"
+    "queue_deadline": float(os.environ.get("GEMINI_QUEUE_DEADLINE_SECONDS", "15")),
+    "breaker_threshold": int(os.environ.get("GEMINI_BREAKER_THRESHOLD", "5")),
+    "breaker_reset": float(os.environ.get("GEMINI_BREAKER_RESET_SECONDS", "30")),
+}
+
+# Configuração de email (opcional)
+EMAIL_CONFIG = {
+    "smtp_server": os.environ.get("SMTP_SERVER", "smtp.gmail.com"),
+    "smtp_port": int(os.environ.get("SMTP_PORT", "587")),
+    "sender_email": os.environ.get("SENDER_EMAIL", ""),
+    "sender_password": os.environ.get("SENDER_PASSWORD", ""),
+    "recipient_email": os.environ.get("RECIPIENT_EMAIL", ""),
+    "starttls": os.environ.get("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes"),
+    "timeout": float(os.environ.get("SMTP_TIMEOUT", "30")),
+    # Fila de envio: reenvio com backoff e agrupamento opcional em digest
+    "digest_window": float(os.environ.get("EMAIL_DIGEST_WINDOW_SECONDS", "0")),
+    "batch_size": int(os.environ.get("EMAIL_BATCH_SIZE", "50")),
+    "max_attempts": int(os.environ.get("EMAIL_MAX_ATTEMPTS", "8")),
+    "retry_base": float(os.environ.get("EMAIL_RETRY_BASE_SECONDS", "5")),
+    "retry_max": float(os.environ.get("EMAIL_RETRY_MAX_SECONDS", "900")),
+}
+
+# Gravação de leads em lote (group commit) fora do caminho da requisição
+LEAD_WRITER_CONFIG = {
+    "queue_size": int(os.environ.get("LEAD_WRITER_QUEUE_SIZE", "1000")),
+    "batch_size": int(os.environ.get("LEAD_WRITER_BATCH_SIZE", "100")),
+    "batch_delay": float(os.environ.get("LEAD_WRITER_BATCH_DELAY_MS", "5")) / 1000,
+    # batch = fsync a cada commit de lote, normal = só nos checkpoints do WAL, off = nunca
+    "fsync": os.environ.get("LEADS_FSYNC", "batch").lower(),
+    # Leads repetidos (mesmo e-mail, celular ou postcode + nome) atualizam o registro existente
+    "dedupe": os.environ.get("LEAD_DEDUPE", "true").lower() in ("1", "true", "yes"),
+}
+
+# Exportação de leads em streaming (/api/leads/export)
+EXPORT_CONFIG = {
+    # Linhas por leitura do banco e por bloco enviado
+    "chunk_rows": int(os.environ.get("EXPORT_CHUNK_ROWS", "500")),
+    # Linhas por grupo no formato colunar
+    "row_group_size": int(os.environ.get("EXPORT_ROW_GROUP_SIZE", "5000")),
+}
+
+# Stream de leads novos para o painel (/api/leads/events)
+LEAD_EVENTS_CONFIG = {
+    # Intervalo de consulta ao banco (leads gravados por outros workers); os deste worker chegam na hora
+    "poll_interval": float(os.environ.get("LEAD_EVENTS_POLL_SECONDS", "2")),
+    "heartbeat": float(os.environ.get("LEAD_EVENTS_HEARTBEAT_SECONDS", "15")),
+    "max_subscribers": int(os.environ.get("LEAD_EVENTS_MAX_SUBSCRIBERS", "100")),
+    # Eventos pendentes por painel; um painel que não acompanha é desconectado e reconecta
+    "queue_size": int(os.environ.get("LEAD_EVENTS_QUEUE_SIZE", "100")),
+}
+
+# Cache HTTP do frontend
+STATIC_CONFIG = {
+    # URLs sem hash (ex.: widget-embed.js embutido em sites de terceiros); as com hash são imutáveis
+    "max_age": int(os.environ.get("STATIC_MAX_AGE_SECONDS", "3600")),
+    "immutable_max_age": 365 * 24 * 3600,
+}
+
+# Cache opcional de respostas para aberturas e perguntas frequentes
+RESPONSE_CACHE_CONFIG = {
+    "enabled": os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes"),
+    "max_entries": int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+    "max_bytes": int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(5 * 1024 * 1024))),
+    "ttl_seconds": int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+    # Só conversas curtas (abertura/FAQ) são candidatas
+    "max_user_turns": int(os.environ.get("RESPONSE_CACHE_MAX_TURNS", "2")),
+}
+
+# Orçamento de tokens do histórico enviado ao Gemini
+HISTORY_CONFIG = {
+    "token_budget": int(os.environ.get("HISTORY_TOKEN_BUDGET", "2000")),
+    "keep_messages": int(os.environ.get("HISTORY_KEEP_MESSAGES", "8")),
+    "summary_tokens": int(os.environ.get("HISTORY_SUMMARY_TOKENS", "300")),
+}
+
+# Aquecimento em segundo plano após a inicialização (conexão com o Gemini, cache do prompt, índices)
+WARMUP_CONFIG = {
+    "enabled": os.environ.get("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes"),
+    # Depois do prazo o worker se declara pronto mesmo com passos pendentes
+    "timeout": float(os.environ.get("WARMUP_TIMEOUT_SECONDS", "10")),
+}
+
+# Limites por cliente no chat (cada chamada custa uma requisição paga ao Gemini)
+CHAT_LIMIT_CONFIG = {
+    "window_seconds": float(os.environ.get("CHAT_RATE_WINDOW_SECONDS", "60")),
+    "per_ip": int(os.environ.get("CHAT_RATE_LIMIT_PER_IP", "60")),
+    "per_session": int(os.environ.get("CHAT_RATE_LIMIT_PER_SESSION", "20")),
+    "max_body_bytes": int(os.environ.get("CHAT_MAX_BODY_BYTES", str(64 * 1024))),
+    "max_message_chars": int(os.environ.get("CHAT_MAX_MESSAGE_CHARS", "2000")),
+    "max_history_messages": int(os.environ.get("CHAT_MAX_HISTORY_MESSAGES", "60")),
+    "max_history_chars": int(os.environ.get("CHAT_MAX_HISTORY_CHARS", "30000")),
+    "max_keys": int(os.environ.get("CHAT_RATE_MAX_KEYS", "100000")),
+    # Proxies confiáveis na frente do app (Render e Railway: 1). O IP do cliente é a entrada
+    # do X-Forwarded-For acrescentada pelo proxy mais distante, contando da direita
+    "trusted_proxy_hops": int(os.environ.get(
+        "CHAT_TRUSTED_PROXY_HOPS",
+        "1" if os.environ.get("CHAT_TRUST_FORWARDED_FOR", "").lower() in ("1", "true", "yes")
+        or os.environ.get("RENDER") or os.environ.get("RAILWAY_ENVIRONMENT") else "0",
+    )),
+}
+
+# Logs estruturados (JSON) gravados por uma thread separada
+LOG_CONFIG = {
+    "level": os.environ.get("LOG_LEVEL", "INFO").upper(),
+    # Fração das requisições que emitem seus eventos DEBUG (com LOG_LEVEL=DEBUG)
+    "debug_sample_rate": float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1.0")),
+    "redact_pii": os.environ.get("LOG_REDACT_PII", "true").lower() in ("1", "true", "yes"),
+}
+
+# Sessões de conversa mantidas no servidor
+SESSION_CONFIG = {
+    "ttl_seconds": int(os.environ.get("SESSION_TTL_SECONDS", "3600")),
+    "max_sessions": int(os.environ.get("SESSION_MAX_ENTRIES", "10000")),
+}
+
+# Estado compartilhado entre workers: sessões, cache de respostas, rate limit e
+# o nome do cachedContent do SYSTEM_PROMPT
+STATE_CONFIG = {
+    # memory = estado de cada processo; sqlite = arquivo comum a todos os workers da máquina
+    "backend": os.environ.get("STATE_BACKEND", "sqlite" if WEB_WORKERS > 1 else "memory").lower(),
+    "path": Path(os.environ.get("STATE_DB_PATH", DATA_DIR / "state.db")),
+    # Prazo para devolver notificações presas em 'sending' por um worker que morreu
+    "outbox_lease": float(os.environ.get("OUTBOX_LEASE_SECONDS", "300")),
+}
+
+
+# Padrões dos validadores (também usados para detectar dados pessoais em texto livre)
+EMAIL_PATTERN = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+# Padrão UK: AA9A 9AA, A9A 9AA, A9 9AA, A99 9AA, AA9 9AA, AA99 9AA
+UK_POSTCODE_PATTERN = r'[A-Z]{1,2}[0-9][A-Z0-9]?\s*[0-9][A-Z]{2}'
+UK_MOBILE_PATTERN = r'(?:\+44\s?7|07)\d{3}\s?\d{3}\s?\d{3}'
+
+PERSONAL_DATA_RE = re.compile(
+    rf'{EMAIL_PATTERN}|\b{UK_POSTCODE_PATTERN}\b|{UK_MOBILE_PATTERN}',
+    re.IGNORECASE,
+)
+
+
+# Padrões pré-compilados (o outward/inward separados permitem normalizar o postcode)
+EMAIL_RE = re.compile(EMAIL_PATTERN)
+UK_POSTCODE_RE = re.compile(r'(?P<outward>[A-Z]{1,2}[0-9][A-Z0-9]?)\s*(?P<inward>[0-9][A-Z]{2})')
+WHITESPACE_RE = re.compile(r'\s+')
+NON_DIGIT_RE = re.compile(r'\D')
+# Orçamentos em texto livre ("£650k", "£2,500 pcm", "£1.2m", "£450 pw")
+BUDGET_AMOUNT_RE = re.compile(r"(\d+(?:,\d{3})*(?:\.\d+)?)\s*(k|m|mil|million|thousand)?\b", re.IGNORECASE)
+BUDGET_RENT_RE = re.compile(r"pcm|p\.c\.m|pw|p/w|per\s+(?:month|week)|a\s+(?:month|week)|monthly|weekly|/\s*(?:month|week|mo|wk)", re.IGNORECASE)
+BUDGET_WEEKLY_RE = re.compile(r"pw|p/w|week", re.IGNORECASE)
+# Faixas de orçamento (limite superior exclusivo, rótulo)
+SALE_BUDGET_BUCKETS = (
+    (300_000, "sale:<300k"),
+    (500_000, "sale:300k-500k"),
+    (750_000, "sale:500k-750k"),
+    (1_000_000, "sale:750k-1m"),
+    (2_000_000, "sale:1m-2m"),
+    (float("inf"), "sale:2m+"),
+)
+RENT_BUDGET_BUCKETS = (
+    (1_500, "rent:<1.5k pcm"),
+    (2_500, "rent:1.5k-2.5k pcm"),
+    (4_000, "rent:2.5k-4k pcm"),
+    (float("inf"), "rent:4k+ pcm"),
+)
+# Valores plausíveis; fora deles o orçamento fica como "unknown"
+SALE_BUDGET_RANGE = (30_000, 100_000_000)
+RENT_BUDGET_RANGE = (150, 200_000)
+# Versão das faixas dos agregados; mudar as regras acima exige reconstruir (rollup_leads)
+ROLLUPS_VERSION = "1"
+
+# Campos do lead recalculados pela validação
+VALIDATION_FIELDS = ("email", "postcode", "email_valido", "postcode_valido")
+
+
+def validate_email(email: str) -> bool:
+    """Valida formato de email"""
+    return EMAIL_RE.fullmatch(email) is not None
+
+
+def normalise_postcode(postcode: str) -> Optional[str]:
+    """Postcode na forma canônica ("SW1A 1AA") ou None se for inválido"""
+    match = UK_POSTCODE_RE.fullmatch(postcode.upper().strip())
+    if match is None:
+        return None
+    return f"{match.group('outward')} {match.group('inward')}"
+
+
+def validate_uk_postcode(postcode: str) -> bool:
+    """Valida formato de postcode do Reino Unido"""
+    return normalise_postcode(postcode) is not None
+
+
+def check_lead_fields(lead_data: dict) -> dict:
+    """Valida e normaliza os campos do lead numa única passada"""
+    email = str(lead_data.get("email") or "").strip()
+    raw_postcode = str(lead_data.get("postcode") or "").strip()
+    postcode = normalise_postcode(raw_postcode)
+
+    errors = []
+    email_valid = validate_email(email)
+    if not email_valid:
+        errors.append(f"Invalid email: {email}")
+    if postcode is None:
+        errors.append(f"Invalid postcode: {raw_postcode} (expected format: SW1A 1AA)")
+
+    return {
+        "email": email,
+        "email_valid": email_valid,
+        # Postcode inválido é mantido como veio (em maiúsculas) para não perder o dado
+        "postcode": postcode or WHITESPACE_RE.sub(" ", raw_postcode.upper()),
+        "postcode_valid": postcode is not None,
+        "errors": errors,
+    }
+
+
+def normalise_lead(row: dict) -> dict:
+    """Linha do lead com e-mail/postcode normalizados e as colunas de validade recalculadas"""
+    checked = check_lead_fields(row)
+    return dict(
+        row,
+        email=checked["email"],
+        postcode=checked["postcode"],
+        email_valido="Yes" if checked["email_valid"] else "No",
+        postcode_valido="Yes" if checked["postcode_valid"] else "No",
+    )
+
+
+def normalise_phone(phone: str) -> Optional[str]:
+    """Celular só com dígitos, na forma nacional (07700900123), ou None se for curto demais"""
+    digits = NON_DIGIT_RE.sub("", phone)
+    if digits.startswith("0044"):
+        digits = "0" + digits[4:]
+    elif digits.startswith("44") and len(digits) == 12:
+        digits = "0" + digits[2:]
+    return digits if len(digits) >= 10 else None
+
+
+def dedupe_keys(lead: dict) -> list:
+    """Chaves que identificam o mesmo cliente, da mais forte para a mais fraca"""
+    keys = []
+    email = str(lead.get("email") or "").strip().lower()
+    if validate_email(email):
+        keys.append(f"email:{email}")
+    phone = normalise_phone(str(lead.get("whatsapp") or ""))
+    if phone:
+        keys.append(f"phone:{phone}")
+    # Postcode sozinho junta vizinhos; com o nome identifica a pessoa
+    postcode = normalise_postcode(str(lead.get("postcode") or ""))
+    name = WHITESPACE_RE.sub(" ", str(lead.get("nome") or "")).strip().casefold()
+    if postcode and name:
+        keys.append(f"name:{postcode}|{name}")
+    return keys
+
+
+def merge_lead(existing: dict, incoming: dict) -> dict:
+    """Junta um lead repetido ao registro existente (o mais novo prevalece, sem trocar dado válido por inválido)"""
+    merged = dict(existing)
+    for field in ("nome", "whatsapp", "tipo_interesse", "orcamento"):
+        value = str(incoming.get(field) or "").strip()
+        if value:
+            merged[field] = value
+    for field, flag in (("email", "email_valido"), ("postcode", "postcode_valido")):
+        if incoming.get(field) and (incoming.get(flag) == "Yes" or existing.get(flag) != "Yes"):
+            merged[field] = incoming[field]
+    details = str(incoming.get("detalhes_adicionais") or "").strip()
+    current = str(existing.get("detalhes_adicionais") or "")
+    if details and details not in current:
+        merged["detalhes_adicionais"] = f"{current} | {details}" if current else details
+    merged = normalise_lead(merged)
+    merged.update(area_index.lead_fields(merged["postcode"]))
+    return merged
+
+
+class LeadDedupeIndex:
+    """Chaves normalizadas (e-mail, celular, postcode + nome) → id do lead, em memória
+
+    Montado na inicialização a partir do store; cada lead novo é conferido em O(1).
+    O store aplica o resultado na mesma transação da gravação e, antes, lê os leads
+    que outros workers gravaram desde a última vez (last_id).
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self.last_id = 0
+        self.merged = 0
+        # O warm-up carrega o índice numa thread enquanto o writer pode estar gravando
+        self.lock = threading.Lock()
+
+    def load(self, store: "LeadStore", batch_size: int = 1000):
+        """Carga completa (warm-up); sem ela a primeira gravação lê os leads que faltam"""
+        with self.lock:
+            self._ids = {}
+            self.last_id = 0
+            for lead in store.iter_leads(batch_size):
+                self.add(lead["id"], lead)
+
+    def find(self, lead: dict, pending: Optional[dict] = None) -> Optional[int]:
+        for key in dedupe_keys(lead):
+            lead_id = (pending or {}).get(key) or self._ids.get(key)
+            if lead_id is not None:
+                return lead_id
+        return None
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._ids
+
+    def add(self, lead_id: int, lead: dict):
+        # O registro mais antigo fica com a chave
+        for key in dedupe_keys(lead):
+            self._ids.setdefault(key, lead_id)
+        self.last_id = max(self.last_id, lead_id)
+
+    def update(self, keys: dict, last_id: int):
+        """Aplica as chaves de um lote já gravado"""
+        self._ids.update(keys)
+        self.last_id = max(self.last_id, last_id)
+
+    def stats(self) -> dict:
+        return {"keys": len(self._ids), "last_id": self.last_id, "merged": self.merged}
+
+
+def parse_budget(orcamento: str) -> Optional[float]:
+    """Maior valor citado no orçamento, em libras ("£1.2m" → 1200000, "£450k-£500k" → 500000)"""
+    amounts = []
+    for number, unit in BUDGET_AMOUNT_RE.findall(orcamento):
+        amount = float(number.replace(",", ""))
+        unit = unit.lower()
+        if unit in ("k", "thousand"):
+            amount *= 1_000
+        elif unit in ("m", "mil", "million"):
+            amount *= 1_000_000
+        amounts.append(amount)
+    return max(amounts) if amounts else None
+
+
+def budget_bucket(orcamento: str, interest: str) -> str:
+    """Faixa do orçamento: aluguel por mês (pcm) ou valor de compra/venda"""
+    text = str(orcamento or "")
+    amount = parse_budget(text)
+    if amount is None:
+        return "unknown"
+    if BUDGET_RENT_RE.search(text) or "rent" in str(interest or ""):
+        if BUDGET_WEEKLY_RE.search(text):
+            amount = amount * 52 / 12
+        buckets, (low, high) = RENT_BUDGET_BUCKETS, RENT_BUDGET_RANGE
+    else:
+        buckets, (low, high) = SALE_BUDGET_BUCKETS, SALE_BUDGET_RANGE
+    # Valor fora da escala do tipo (ex.: "£650k" de aluguel) não entra em nenhuma faixa
+    if not low <= amount < high:
+        return "unknown"
+    return next(label for limit, label in buckets if amount < limit)
+
+
+def lead_rollup_buckets(lead: dict) -> list:
+    """(dimensão, faixa) em que um lead entra nos agregados de /api/leads/stats"""
+    interest = lead.get("tipo_interesse") or "unknown"
+    buckets = [
+        ("all", "total"),
+        ("interest", interest),
+        ("district", lead.get("distrito") or "unknown"),
+        ("budget", budget_bucket(lead.get("orcamento"), interest)),
+    ]
+    try:
+        day = datetime.fromisoformat(str(lead.get("timestamp") or "")[:10]).date()
+    except ValueError:
+        day = None
+    if day is not None:
+        year, week, _ = day.isocalendar()
+        buckets.append(("day", day.isoformat()))
+        buckets.append(("week", f"{year}-W{week:02d}"))
+    email_invalid = lead.get("email_valido") != "Yes"
+    postcode_invalid = lead.get("postcode_valido") != "Yes"
+    if email_invalid:
+        buckets.append(("validation", "email_invalid"))
+    if postcode_invalid:
+        buckets.append(("validation", "postcode_invalid"))
+    if email_invalid or postcode_invalid:
+        buckets.append(("validation", "any_invalid"))
+    return buckets
+
+
+def validate_leads(rows: Iterable[dict]) -> Iterator[dict]:
+    """Validação em lote: normaliza as linhas uma a uma, sem carregar tudo em memória"""
+    for row in rows:
+        yield normalise_lead(row)
+
+
+# Outward code isolado (ex.: "SW1A", "E14"), em consultas e no texto do cliente
+OUTWARD_RE = re.compile(r'[A-Z]{1,2}[0-9][A-Z0-9]?')
+OUTWARD_IN_TEXT_RE = re.compile(r'\b[A-Z]{1,2}[0-9][A-Z0-9]?\b')
+# Ordem das regiões na lista de áreas do SYSTEM_PROMPT
+AREA_REGIONS = ("Central", "North", "South", "East", "West")
+
+
+class AreaIndex:
+    """Índice local de outward code → borough/zona/localidade e das áreas que a Sophie conhece"""
+
+    def __init__(self, data: dict, version: str = ""):
+        self.version = version
+        self.boroughs = tuple(sorted({borough for borough, _, _ in data["districts"].values()}))
+        borough_ids = {name: index for index, name in enumerate(self.boroughs)}
+        # Uma tupla pequena por distrito; os nomes de borough ficam numa tabela única
+        self._districts = {
+            outward: (borough_ids[borough], zone, sys.intern(locality))
+            for outward, (borough, zone, locality) in data["districts"].items()
+        }
+        self.areas = tuple(data["areas"])
+        self._area_by_district = {district: area for area in self.areas for district in area["districts"]}
+        self._area_by_name = {area["name"].lower(): area for area in self.areas}
+        self._borough_by_name = {name.lower(): name for name in self.boroughs}
+        self._districts_by_locality = {}
+        for outward, (_, _, locality) in self._districts.items():
+            self._districts_by_locality.setdefault(locality.lower(), []).append(outward)
+        names = sorted(self._area_by_name, key=len, reverse=True)
+        self._mention_re = re.compile(r"\b(" + "|".join(re.escape(name) for name in names) + r")\b", re.IGNORECASE)
+
+    @classmethod
+    def load(cls, path: Path) -> "AreaIndex":
+        """Lê a base uma vez; a versão (hash do arquivo) indica quando reindexar os leads"""
+        raw = path.read_bytes()
+        return cls(json.loads(raw), hashlib.sha256(raw).hexdigest()[:16])
+
+    @staticmethod
+    def outward(value: str) -> Optional[str]:
+        """Outward code de um postcode completo ou de um outward code avulso"""
+        postcode = normalise_postcode(value)
+        if postcode is not None:
+            return postcode.split(" ", 1)[0]
+        compact = value.replace(" ", "").upper()
+        return compact if OUTWARD_RE.fullmatch(compact) else None
+
+    def _district(self, outward: str) -> Optional[tuple]:
+        # Subdistritos (ex.: "SW1A", "W1K") caem no distrito ("SW1", "W1") se não tiverem entrada própria
+        entry = self._districts.get(outward)
+        if entry is None and outward[-1].isalpha():
+            entry = self._districts.get(outward[:-1])
+        return entry
+
+    def lookup(self, value: str) -> Optional[dict]:
+        """Borough, zona, localidade e área conhecida de um postcode ou outward code"""
+        outward = self.outward(value)
+        if outward is None:
+            return None
+        entry = self._district(outward)
+        if entry is None:
+            return None
+        borough_id, zone, locality = entry
+        area = self._area_by_district.get(outward)
+        if area is None and outward[-1].isalpha():
+            area = self._area_by_district.get(outward[:-1])
+        return {
+            "outward": outward,
+            "borough": self.boroughs[borough_id],
+            "zone": zone,
+            "locality": locality,
+            "area": area,
+        }
+
+    def area(self, name: str) -> Optional[dict]:
+        return self._area_by_name.get(name.strip().lower())
+
+    def borough(self, name: str) -> Optional[str]:
+        """Nome canônico de um borough, sem diferenciar maiúsculas"""
+        return self._borough_by_name.get(name.strip().lower())
+
+    def districts_named(self, name: str) -> list:
+        """Outward codes de uma área conhecida ou de uma localidade (ex.: "Chelsea", "Clapham")"""
+        area = self.area(name)
+        if area is not None:
+            return list(area["districts"])
+        return list(self._districts_by_locality.get(name.strip().lower(), []))
+
+    def lead_fields(self, postcode: str) -> dict:
+        """Colunas de área do lead; vazias quando o postcode é inválido ou fora do índice"""
+        fields = dict.fromkeys(AREA_FIELDS, "")
+        outward = self.outward(postcode) if normalise_postcode(postcode) else None
+        if outward is None:
+            return fields
+        fields["distrito"] = outward
+        entry = self._district(outward)
+        if entry is not None:
+            fields["borough"] = self.boroughs[entry[0]]
+            fields["zona"] = str(entry[1])
+        return fields
+
+    def mentions(self, text: str, limit: int = 2) -> list:
+        """Áreas conhecidas e distritos citados numa mensagem, na ordem em que aparecem"""
+        found = []
+        seen = set()
+        for match in self._mention_re.finditer(text):
+            area = self._area_by_name[match.group(1).lower()]
+            if area["name"] not in seen:
+                seen.add(area["name"])
+                found.append(self.describe_area(area))
+        for match in OUTWARD_IN_TEXT_RE.finditer(text):
+            info = self.lookup(match.group(0))
+            if info is None:
+                continue
+            key = info["area"]["name"] if info["area"] else info["outward"]
+            if key not in seen:
+                seen.add(key)
+                found.append(self.describe_area(info["area"]) if info["area"] else self.describe_district(info))
+        return found[:limit]
+
+    @staticmethod
+    def describe_area(area: dict) -> str:
+        return (
+            f"{area['name']} ({area['borough']}, zone {area['zone']}, "
+            f"postcodes {', '.join(area['districts'])}; stations: {', '.join(area['stations'])}): {area['summary']}"
+        )
+
+    @staticmethod
+    def describe_district(info: dict) -> str:
+        return f"{info['outward']} is {info['locality']}, in the borough of {info['borough']} (zone {info['zone']})."
+
+    def prompt_section(self) -> str:
+        """Lista de áreas por região, no formato do SYSTEM_PROMPT"""
+        lines = []
+        for region in AREA_REGIONS:
+            names = [area["name"] for area in self.areas if area["region"] == region]
+            if names:
+                lines.append(f"- {region}: {', '.join(names)}")
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "districts": len(self._districts),
+            "areas": len(self.areas),
+            "boroughs": len(self.boroughs),
+        }
+
+
+area_index = AreaIndex.load(AREAS_FILE)
+
+
+def contains_personal_data(text: str) -> bool:
+    """Detecta email, celular ou postcode em texto livre"""
+    return PERSONAL_DATA_RE.search(text) is not None
+
+
+# Dados pessoais mascarados nos logs, com os mesmos padrões dos validadores
+REDACT_RE = re.compile(
+    rf'(?P<email>{EMAIL_PATTERN})|(?P<postcode>\b{UK_POSTCODE_PATTERN}\b)|(?P<phone>{UK_MOBILE_PATTERN})',
+    re.IGNORECASE,
+)
+
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+debug_sampled_var: contextvars.ContextVar = contextvars.ContextVar("debug_sampled", default=False)
+
+# Atributos padrão do LogRecord; os demais (extra=...) viram campos do JSON
+STANDARD_LOG_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id"}
+
+
+def redact(text: str) -> str:
+    return REDACT_RE.sub(lambda match: f"[{match.lastgroup}]", text)
+
+
+class JSONLogFormatter(logging.Formatter):
+    """Uma linha JSON por evento, com os dados pessoais mascarados"""
+
+    def __init__(self, redact_pii: bool = True):
+        super().__init__()
+        self.redact_pii = redact_pii
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in STANDARD_LOG_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        return redact(line) if self.redact_pii else line
+
+
+class RequestQueueHandler(QueueHandler):
+    """Enfileira o evento sem formatar: JSON, redação e I/O ficam na thread do listener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class DebugSampler(logging.Filter):
+    """DEBUG só para as requisições sorteadas; os demais níveis passam sempre"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or debug_sampled_var.get()
+
+
+def setup_logging(config: dict) -> QueueListener:
+    """Configura o logger da aplicação com handler não bloqueante"""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JSONLogFormatter(config["redact_pii"]))
+    log_queue: queue_module.SimpleQueue = queue_module.SimpleQueue()
+    handler = RequestQueueHandler(log_queue)
+    handler.addFilter(DebugSampler())
+
+    app_logger = logging.getLogger("property_agent")
+    app_logger.setLevel(config["level"])
+    app_logger.addHandler(handler)
+    app_logger.propagate = False
+
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+logger = logging.getLogger("property_agent")
+log_listener = setup_logging(LOG_CONFIG)
+# Esvazia a fila de logs ao encerrar o processo (servidor ou CLI)
+atexit.register(log_listener.stop)
+
+
+# Buckets de latência (segundos) dos histogramas
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """Contador no formato Prometheus; só é alterado no event loop, sem locks"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), series: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        # Séries conhecidas são alocadas de antemão
+        self.values = {values: 0.0 for values in series} if labels else {(): 0.0}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, values)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """Histograma no formato Prometheus com buckets fixos"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), series: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        for values in (series if labels else ((),)):
+            self.add_series(values)
+
+    def add_series(self, values: tuple):
+        # [contagem por bucket (+Inf no fim), soma]
+        self._series.setdefault(values, [[0] * (len(self.buckets) + 1), 0.0])
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            self.add_series(label_values)
+            series = self._series[label_values]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Métricas expostas em /metrics"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, extra: list = ()) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.extend(extra)
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.counter(
+    "http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+HTTP_LATENCY = metrics.histogram(
+    "http_request_duration_seconds", "Time to response headers by route", ("route",))
+CHAT_FIRST_TOKEN = metrics.histogram(
+    "chat_stream_first_token_seconds", "Time to the first streamed token")
+GEMINI_REQUESTS = metrics.counter(
+    "gemini_requests_total", "Upstream Gemini calls by kind and status", ("kind", "status"))
+GEMINI_LATENCY = metrics.histogram(
+    "gemini_request_duration_seconds", "Upstream Gemini latency (headers, for streams)", ("kind",),
+    series=(("generate",), ("stream",)))
+GEMINI_TOKENS = metrics.counter(
+    "gemini_tokens_total", "Tokens reported in usageMetadata", ("direction",),
+    series=(("input",), ("output",), ("cached",)))
+LEADS_CAPTURED = metrics.counter(
+    "leads_captured_total", "Captured leads by source", ("source",), series=(("model",), ("local",)))
+LEAD_VALIDATION_FAILURES = metrics.counter(
+    "lead_validation_failures_total", "Lead fields that failed validation", ("field",),
+    series=(("email",), ("postcode",)))
+EMAIL_SEND_LATENCY = metrics.histogram(
+    "email_send_duration_seconds", "SMTP send duration by result", ("result",),
+    series=(("sent",), ("failed",)))
+LEAD_WRITE_LATENCY = metrics.histogram(
+    "lead_store_write_duration_seconds", "Lead batch commit duration")
+LEADS_WRITTEN = metrics.counter(
+    "lead_store_rows_written_total", "Lead rows committed to the store")
+
+
+def email_configured() -> bool:
+    """Indica se o envio de notificações por email está configurado"""
+    return bool(EMAIL_CONFIG["sender_email"] and EMAIL_CONFIG["recipient_email"])
+
+
+def build_lead_email(lead_data: dict, captured_at: datetime) -> "MIMEMultipart":
+    """Monta o email de notificação de um lead"""
+    # Importados só quando há email a enviar (fora do caminho da inicialização)
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
+    msg = MIMEMultipart()
+    msg['From'] = EMAIL_CONFIG["sender_email"]
+    msg['To'] = EMAIL_CONFIG["recipient_email"]
+    msg['Subject'] = f"🏠 New Lead Captured - {lead_data.get('tipo_interesse', 'N/A').upper()}"
+    area = f"{lead_data['borough']}, zone {lead_data['zona']}" if lead_data.get('borough') else 'N/A'
+
+    body = f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; padding: 20px;">
+        <h2 style="color: #1a1f3d;">🏠 New Property Lead</h2>
+        <hr style="border: 1px solid #c9a227;">
+        <table style="width: 100%; border-collapse: collapse;">
+            <tr>
+                <td style="padding: 10px; font-weight: bold;">Name:</td>
+                <td style="padding: 10px;">{lead_data.get('nome', 'N/A')}</td>
+            </tr>
+            <tr style="background: #f5f3ef;">
+                <td style="padding: 10px; font-weight: bold;">Email:</td>
+                <td style="padding: 10px;">{lead_data.get('email', 'N/A')}</td>
+            </tr>
+            <tr>
+                <td style="padding: 10px; font-weight: bold;">Interest:</td>
+                <td style="padding: 10px;">{lead_data.get('tipo_interesse', 'N/A').upper()}</td>
+            </tr>
+            <tr style="background: #f5f3ef;">
+                <td style="padding: 10px; font-weight: bold;">Budget:</td>
+                <td style="padding: 10px;">{lead_data.get('orcamento', 'N/A')}</td>
+            </tr>
+            <tr>
+                <td style="padding: 10px; font-weight: bold;">Postcode:</td>
+                <td style="padding: 10px;">{lead_data.get('postcode', 'N/A')}</td>
+            </tr>
+            <tr>
+                <td style="padding: 10px; font-weight: bold;">Area:</td>
+                <td style="padding: 10px;">{area}</td>
+            </tr>
+            <tr style="background: #f5f3ef;">
+                <td style="padding: 10px; font-weight: bold;">Details:</td>
+                <td style="padding: 10px;">{lead_data.get('detalhes_adicionais', 'N/A')}</td>
+            </tr>
+        </table>
+        <hr style="border: 1px solid #c9a227;">
+        <p style="color: #666; font-size: 12px;">
+            Captured on: {captured_at.strftime('%d/%m/%Y at %H:%M')}
+        </p>
+    </body>
+    </html>
+    """
+
+    msg.attach(MIMEText(body, 'html'))
+    return msg
+
+
+def build_digest_email(items: list) -> "MIMEMultipart":
+    """Monta um único email com vários leads capturados em sequência"""
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
+    msg = MIMEMultipart()
+    msg['From'] = EMAIL_CONFIG["sender_email"]
+    msg['To'] = EMAIL_CONFIG["recipient_email"]
+    msg['Subject'] = f"🏠 {len(items)} New Leads Captured"
+
+    rows = "".join(f"""
+                <tr style="background: {'#f5f3ef' if index % 2 else 'white'};">
+                    <td style="padding: 8px;">{captured_at.strftime('%d/%m/%Y %H:%M')}</td>
+                    <td style="padding: 8px;">{lead_data.get('nome', 'N/A')}</td>
+                    <td style="padding: 8px;">{lead_data.get('email', 'N/A')}</td>
+                    <td style="padding: 8px;">{lead_data.get('whatsapp', 'N/A')}</td>
+                    <td style="padding: 8px;">{str(lead_data.get('tipo_interesse', 'N/A')).upper()}</td>
+                    <td style="padding: 8px;">{lead_data.get('orcamento', 'N/A')}</td>
+                    <td style="padding: 8px;">{lead_data.get('postcode', 'N/A')}</td>
+                </tr>""" for index, (lead_data, captured_at) in enumerate(items))
+
+    body = f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; padding: 20px;">
+        <h2 style="color: #1a1f3d;">🏠 {len(items)} New Property Leads</h2>
+        <hr style="border: 1px solid #c9a227;">
+        <table style="width: 100%; border-collapse: collapse;">
+            <tr style="text-align: left;">
+                <th style="padding: 8px;">Captured</th>
+                <th style="padding: 8px;">Name</th>
+                <th style="padding: 8px;">Email</th>
+                <th style="padding: 8px;">Mobile</th>
+                <th style="padding: 8px;">Interest</th>
+                <th style="padding: 8px;">Budget</th>
+                <th style="padding: 8px;">Postcode</th>
+            </tr>{rows}
+        </table>
+    </body>
+    </html>
+    """
+
+    msg.attach(MIMEText(body, 'html'))
+    return msg
+
+
+class SMTPConnection:
+    """Conexão SMTP autenticada reutilizada entre envios"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self._server: Optional["smtplib.SMTP"] = None
+
+    def _connect(self) -> "smtplib.SMTP":
+        # smtplib só é importado no primeiro envio
+        import smtplib
+
+        server = smtplib.SMTP(
+            self.config["smtp_server"],
+            self.config["smtp_port"],
+            timeout=self.config["timeout"],
+        )
+        if self.config["starttls"]:
+            server.starttls()
+        if self.config["sender_password"]:
+            server.login(self.config["sender_email"], self.config["sender_password"])
+        return server
+
+    def send(self, msg: "MIMEMultipart"):
+        """Envia reaproveitando a conexão; reconecta uma vez se o servidor a fechou"""
+        import smtplib
+
+        for attempt in range(2):
+            if self._server is None:
+                self._server = self._connect()
+            try:
+                self._server.send_message(msg)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.close()
+                if attempt:
+                    raise
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        if self._server is not None:
+            import smtplib
+
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+
+class GeminiHTTPPool:
+    """Cliente httpx de longa duração compartilhado pelas chamadas ao Gemini"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.client: Optional[httpx.AsyncClient] = None
+        self.http2 = False
+        self.requests_total = 0
+        self.waits_total = 0
+        self.in_flight = 0
+        self._transport: Optional[httpx.AsyncHTTPTransport] = None
+
+    def start(self):
+        """Cria o cliente e o pool de conexões"""
+        if self.client is not None:
+            return
+
+        self.http2 = self.config["http2"]
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Package 'h2' not installed, using HTTP/1.1 for Gemini")
+                self.http2 = False
+
+        limits = httpx.Limits(
+            max_connections=self.config["max_connections"],
+            max_keepalive_connections=self.config["max_keepalive_connections"],
+            keepalive_expiry=self.config["keepalive_expiry"],
+        )
+        timeout = httpx.Timeout(
+            connect=self.config["connect_timeout"],
+            read=self.config["read_timeout"],
+            write=self.config["write_timeout"],
+            pool=self.config["pool_timeout"],
+        )
+        self._transport = httpx.AsyncHTTPTransport(http2=self.http2, limits=limits)
+        self.client = httpx.AsyncClient(
+            transport=self._transport,
+            timeout=timeout,
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def preconnect(self):
+        """Abre uma conexão (TCP, TLS e HTTP/2) antes da primeira chamada, lendo os metadados do modelo"""
+        if self.client is None:
+            self.start()
+        # Qualquer resposta serve: o que importa é a conexão ficar no pool
+        await self.client.get(f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}", params={"key": GOOGLE_API_KEY})
+
+    async def aclose(self):
+        """Fecha todas as conexões do pool"""
+        if self.client is not None:
+            await self.client.aclose()
+        self.client = None
+        self._transport = None
+
+    def _connections(self) -> list:
+        pool = getattr(self._transport, "_pool", None)
+        return list(getattr(pool, "connections", []) or [])
+
+    def _must_wait(self) -> bool:
+        """Indica se a próxima requisição vai esperar por uma conexão livre"""
+        if self.in_flight < self.config["max_connections"]:
+            return False
+        connections = [c for c in self._connections() if not c.is_closed()]
+        return not any(c.is_available() for c in connections)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        """POST usando o pool compartilhado"""
+        if self.client is None:
+            self.start()
+
+        self.requests_total += 1
+        if self._must_wait():
+            self.waits_total += 1
+
+        self.in_flight += 1
+        try:
+            return await self.client.post(url, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+    async def open_stream(self, url: str, **kwargs) -> httpx.Response:
+        """POST em modo streaming; a resposta deve ser fechada com close_stream"""
+        if self.client is None:
+            self.start()
+
+        self.requests_total += 1
+        if self._must_wait():
+            self.waits_total += 1
+
+        self.in_flight += 1
+        try:
+            request = self.client.build_request("POST", url, **kwargs)
+            return await self.client.send(request, stream=True)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+
+    async def close_stream(self, response: httpx.Response):
+        """Libera a conexão de uma resposta aberta com open_stream"""
+        try:
+            await response.aclose()
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        """Estatísticas do pool para dimensionamento"""
+        connections = [c for c in self._connections() if not c.is_closed()]
+        idle = sum(1 for c in connections if c.is_idle())
+        return {
+            "http2": self.http2,
+            "max_connections": self.config["max_connections"],
+            "max_keepalive_connections": self.config["max_keepalive_connections"],
+            "connections": len(connections),
+            "in_use": len(connections) - idle,
+            "idle": idle,
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "waits_total": self.waits_total,
+        }
+
+
+gemini_pool = GeminiHTTPPool(GEMINI_HTTP_CONFIG)
+
+
+class UpstreamUnavailable(Exception):
+    """O Gemini não pôde ser chamado a tempo (fila, rate limit ou circuit breaker)"""
+
+    def __init__(self, reason: str, retry_after: float = 0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class GeminiScheduler:
+    """Limita, espaça e repete as chamadas ao Gemini, agrupando requisições idênticas"""
+
+    RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, config: dict):
+        self.config = config
+        self._semaphore = asyncio.Semaphore(max(1, config["max_concurrency"]))
+        self._tokens = float(config["burst"])
+        self._refilled_at = time.monotonic()
+        # Chamada compartilhada por chave e quantas requisições ainda a aguardam
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._waiters: dict[str, int] = {}
+        # Circuit breaker: falhas consecutivas de servidor/rede
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self.waiting = 0
+        self.running = 0
+        self.requests_total = 0
+        self.retries_total = 0
+        self.coalesced_total = 0
+        self.rejected_total = 0
+        self.breaker_opens = 0
+
+    def _remaining(self, deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self.rejected_total += 1
+            raise UpstreamUnavailable("queue_deadline")
+        return remaining
+
+    def _check_breaker(self) -> bool:
+        """True quando esta tentativa é a requisição de teste do meio-aberto"""
+        if self._opened_at is None:
+            return False
+        retry_after = self._opened_at + self.config["breaker_reset"] - time.monotonic()
+        if retry_after > 0 or self._probing:
+            self.rejected_total += 1
+            raise UpstreamUnavailable("circuit_open", max(retry_after, 1))
+        # Meio-aberto: uma única requisição de teste passa
+        self._probing = True
+        return True
+
+    def _record(self, failed: bool, probe: bool = False):
+        if probe:
+            self._probing = False
+        if not failed:
+            self._failures = 0
+            self._opened_at = None
+            return
+        self._failures += 1
+        if probe or self._failures >= self.config["breaker_threshold"]:
+            if self._opened_at is None or probe:
+                self.breaker_opens += 1
+            self._opened_at = time.monotonic()
+
+    async def _take_token(self, deadline: float):
+        rate = self.config["rate_per_second"]
+        if rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.config["burst"], self._tokens + (now - self._refilled_at) * rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            wait = (1 - self._tokens) / rate
+            if wait >= self._remaining(deadline):
+                self.rejected_total += 1
+                raise UpstreamUnavailable("rate_limited", wait)
+            await asyncio.sleep(wait)
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        """Espera antes do próximo retry: Retry-After do Gemini ou backoff exponencial com jitter"""
+        if response is not None:
+            try:
+                return min(float(response.headers.get("retry-after", "")), self.config["retry_max"])
+            except ValueError:
+                pass
+        delay = min(self.config["retry_base"] * (2 ** (attempt - 1)), self.config["retry_max"])
+        return random.uniform(delay / 2, delay)
+
+    async def run(
+        self,
+        send: Callable[[], Awaitable[httpx.Response]],
+        discard: Optional[Callable[[httpx.Response], Awaitable[None]]] = None,
+        kind: str = "generate",
+    ) -> httpx.Response:
+        """Executa send() dentro dos limites, repetindo 429/5xx até o prazo da fila"""
+        deadline = time.monotonic() + self.config["queue_deadline"]
+        attempt = 0
+        while True:
+            probe = self._check_breaker()
+            try:
+                await self._take_token(deadline)
+
+                timeout = self._remaining(deadline)
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), timeout)
+                except asyncio.TimeoutError:
+                    self.rejected_total += 1
+                    raise UpstreamUnavailable("queue_deadline")
+                finally:
+                    self.waiting -= 1
+
+                self.running += 1
+                self.requests_total += 1
+                response = None
+                started = time.perf_counter()
+                try:
+                    response = await send()
+                except httpx.TransportError as e:
+                    error = e
+                else:
+                    error = None
+                finally:
+                    self.running -= 1
+                    self._semaphore.release()
+                    GEMINI_LATENCY.observe(time.perf_counter() - started, kind)
+                    GEMINI_REQUESTS.inc(kind, str(response.status_code) if response is not None else "error")
+
+                if response is not None and response.status_code not in self.RETRYABLE_STATUS:
+                    self._record(failed=False, probe=probe)
+                    probe = False
+                    return response
+
+                # 429 é controle de taxa, não falha do serviço
+                self._record(failed=response is None or response.status_code >= 500, probe=probe)
+                probe = False
+            finally:
+                # Teste que não chegou a um resultado (cancelado, sem token ou sem vaga) libera o meio-aberto
+                if probe:
+                    self._probing = False
+            if response is not None and discard is not None:
+                await discard(response)
+
+            attempt += 1
+            delay = self._backoff(attempt, response)
+            if attempt > self.config["max_retries"] or time.monotonic() + delay >= deadline:
+                self.rejected_total += 1
+                if error is not None:
+                    logger.error("Gemini unreachable", extra={"error": str(error)})
+                status = "network" if response is None else str(response.status_code)
+                raise UpstreamUnavailable(f"upstream_{status}", delay)
+
+            self.retries_total += 1
+            await asyncio.sleep(delay)
+
+    async def coalesce(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        """Requisições idênticas em andamento compartilham uma única chamada.
+
+        A chamada roda numa task própria: quem desiste (cliente desconectou) deixa de
+        aguardar, e ela só é cancelada quando não sobra ninguém esperando.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(partial(self._forget, key))
+        else:
+            self.coalesced_total += 1
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+                if self._waiters[key] == 0 and not task.done():
+                    task.cancel()
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+        # Evita o aviso de exceção não lida quando ninguém mais aguardava
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        if self._opened_at is None:
+            breaker = "closed"
+        elif self._probing:
+            breaker = "half_open"
+        else:
+            breaker = "open"
+        return {
+            "max_concurrency": self.config["max_concurrency"],
+            "running": self.running,
+            "waiting": self.waiting,
+            "coalescing": len(self._inflight),
+            "requests_total": self.requests_total,
+            "retries_total": self.retries_total,
+            "coalesced_total": self.coalesced_total,
+            "rejected_total": self.rejected_total,
+            "breaker": breaker,
+            "breaker_opens": self.breaker_opens,
+        }
+
+
+gemini_scheduler = GeminiScheduler(GEMINI_SCHEDULER_CONFIG)
+
+
+class SharedStateDB:
+    """Arquivo SQLite com o estado compartilhado pelos workers da mesma máquina"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            window_index INTEGER NOT NULL,
+            current INTEGER NOT NULL,
+            previous INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits(updated_at);
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at);
+        CREATE TABLE IF NOT EXISTS shared_values (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        # Uma conexão por thread, em autocommit: as transações são explícitas (BEGIN IMMEDIATE)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Estado descartável: sem fsync a cada escrita
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Leitura + escrita atômicas entre processos"""
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connect().executescript(self.SCHEMA)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def get_value(self, key: str) -> Optional[tuple[str, float]]:
+        """Valor compartilhado e seu vencimento (time.time()), se ainda válido"""
+        row = self.connect().execute(
+            "SELECT value, expires_at FROM shared_values WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return (row["value"], row["expires_at"]) if row else None
+
+    def claim_value(self, key: str, value: str, expires_at: float) -> bool:
+        """Grava o valor só se a chave estiver livre (ou vencida); indica se conseguiu"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM shared_values WHERE key = ? AND expires_at <= ?", (key, time.time()))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO shared_values (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+        return cursor.rowcount == 1
+
+    def delete_value(self, key: str, value: str):
+        """Remove o valor só se ainda for o mesmo (outro worker pode já ter trocado)"""
+        self.connect().execute("DELETE FROM shared_values WHERE key = ? AND value = ?", (key, value))
+
+    def set_value(self, key: str, value: str, expires_at: float):
+        self.connect().execute(
+            "INSERT INTO shared_values (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (key, value, expires_at),
+        )
+
+
+shared_state: Optional[SharedStateDB] = (
+    SharedStateDB(STATE_CONFIG["path"]) if STATE_CONFIG["backend"] == "sqlite" else None
+)
+
+
+class SessionStore:
+    """Interface para backends de sessão de conversa"""
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def save(self, session_id: str, session: dict):
+        raise NotImplementedError
+
+    async def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class InMemorySessionStore(SessionStore):
+    """Sessões em memória com despejo LRU e expiração por TTL"""
+
+    def __init__(self, ttl_seconds: int, max_sessions: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def _purge_expired(self, now: float):
+        # Entradas mais antigas ficam no início do OrderedDict
+        while self._sessions:
+            session_id, (expires_at, _) = next(iter(self._sessions.items()))
+            if expires_at > now:
+                break
+            del self._sessions[session_id]
+            self.expirations += 1
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        now = time.monotonic()
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        expires_at, session = entry
+        if expires_at <= now:
+            del self._sessions[session_id]
+            self.expirations += 1
+            return None
+        return session
+
+    async def save(self, session_id: str, session: dict):
+        now = time.monotonic()
+        self._sessions[session_id] = (now + self.ttl_seconds, session)
+        self._sessions.move_to_end(session_id)
+        self._purge_expired(now)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "sessions": len(self._sessions),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessões no estado compartilhado, visíveis para todos os workers"""
+
+    # Limpeza de expiradas e excedentes a cada tantas gravações
+    PURGE_EVERY = 200
+
+    def __init__(self, db: SharedStateDB, ttl_seconds: int, max_sessions: int):
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.evictions = 0
+        self.expirations = 0
+        self._writes = 0
+
+    def _get(self, session_id: str) -> Optional[dict]:
+        row = self.db.connect().execute(
+            "SELECT data, expires_at FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row["expires_at"] <= time.time():
+            self.expirations += 1
+            return None
+        return json.loads(row["data"])
+
+    def _save(self, session_id: str, data: str):
+        now = time.time()
+        conn = self.db.connect()
+        conn.execute(
+            "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+            (session_id, data, now + self.ttl_seconds),
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            # Excedentes: as que vencem primeiro são as usadas há mais tempo
+            cursor = conn.execute(
+                "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY expires_at "
+                "LIMIT MAX(0, (SELECT COUNT(*) FROM sessions) - ?))",
+                (self.max_sessions,),
+            )
+            self.evictions += cursor.rowcount
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._get, session_id)
+
+    async def save(self, session_id: str, session: dict):
+        # Serializa no loop: a sessão pode mudar depois que a thread começar
+        await asyncio.to_thread(self._save, session_id, json.dumps(session))
+
+    def _delete(self, session_id: str):
+        self.db.connect().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    async def delete(self, session_id: str):
+        await asyncio.to_thread(self._delete, session_id)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "sessions": self.db.connect().execute(
+                "SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0],
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class ResponseCache:
+    """Cache LRU + TTL de respostas do Gemini, limitado em bytes"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self._entries: OrderedDict = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalise(text: str) -> str:
+        return " ".join(text.casefold().split()).strip(" .!?")
+
+    def key_for(self, messages: list, generation_config: dict) -> Optional[str]:
+        """Chave da conversa, ou None se ela não pode ser cacheada"""
+        if not self.config["enabled"]:
+            return None
+
+        user_turns = 0
+        normalised = []
+        for message in messages:
+            text = "".join(part.get("text", "") for part in message.get("parts", []))
+            if message.get("role") == "user":
+                user_turns += 1
+                # Turnos com dados pessoais nunca são cacheados
+                if contains_personal_data(text):
+                    self.skipped += 1
+                    return None
+            normalised.append([message.get("role"), self._normalise(text)])
+
+        if user_turns > self.config["max_user_turns"]:
+            return None
+
+        material = json.dumps(
+            {"model": GEMINI_MODEL, "system": SYSTEM_PROMPT, "config": generation_config, "contents": normalised},
+            sort_keys=True,
+        )
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def _put(self, key: str, text: str):
+        size = len(key) + len(text.encode())
+        if size > self.config["max_bytes"]:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.config["ttl_seconds"], text, size)
+        self.bytes += size
+        while self._entries and (
+            self.bytes > self.config["max_bytes"] or len(self._entries) > self.config["max_entries"]
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._get(key)
+
+    async def put(self, key: str, text: str):
+        self._put(key, text)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.config["enabled"],
+            "backend": "memory",
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped_personal_data": self.skipped,
+            "evictions": self.evictions,
+        }
+
+
+class SQLiteResponseCache(ResponseCache):
+    """Cache de respostas no estado compartilhado (TTL por entrada, limites aplicados na limpeza)"""
+
+    PURGE_EVERY = 100
+
+    def __init__(self, config: dict, db: SharedStateDB):
+        super().__init__(config)
+        self.db = db
+        self._writes = 0
+
+    def _get(self, key: str) -> Optional[str]:
+        try:
+            row = self.db.connect().execute(
+                "SELECT text FROM response_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row["text"]
+
+    def _put(self, key: str, text: str):
+        size = len(key) + len(text.encode())
+        if size > self.config["max_bytes"]:
+            return
+        now = time.time()
+        try:
+            conn = self.db.connect()
+            conn.execute(
+                "INSERT INTO response_cache (key, text, size, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET text = excluded.text, size = excluded.size, "
+                "expires_at = excluded.expires_at",
+                (key, text, size, now + self.config["ttl_seconds"]),
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                self._purge(conn, now)
+        except sqlite3.Error as e:
+            # Cache é opcional: uma falha só vira um miss na próxima vez
+            logger.warning("Shared response cache write failed", extra={"error": str(e)})
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: str, text: str):
+        await asyncio.to_thread(self._put, key, text)
+
+    def _purge(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+        entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache").fetchone()
+        if entries <= self.config["max_entries"] and total <= self.config["max_bytes"]:
+            return
+        # Remove as que vencem primeiro até voltar aos limites
+        for row in conn.execute("SELECT key, size FROM response_cache ORDER BY expires_at").fetchall():
+            if entries <= self.config["max_entries"] and total <= self.config["max_bytes"]:
+                break
+            conn.execute("DELETE FROM response_cache WHERE key = ?", (row["key"],))
+            entries -= 1
+            total -= row["size"]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        entries, total = self.db.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache WHERE expires_at > ?", (time.time(),)
+        ).fetchone()
+        return {
+            "enabled": self.config["enabled"],
+            "backend": "sqlite",
+            "entries": entries,
+            "bytes": total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped_personal_data": self.skipped,
+            "evictions": self.evictions,
+        }
+
+
+if shared_state is not None:
+    response_cache: ResponseCache = SQLiteResponseCache(RESPONSE_CACHE_CONFIG, shared_state)
+    session_store: SessionStore = SQLiteSessionStore(
+        shared_state, SESSION_CONFIG["ttl_seconds"], SESSION_CONFIG["max_sessions"]
+    )
+else:
+    response_cache = ResponseCache(RESPONSE_CACHE_CONFIG)
+    session_store = InMemorySessionStore(SESSION_CONFIG["ttl_seconds"], SESSION_CONFIG["max_sessions"])
+
+
+class RateLimitBackend:
+    """Interface para backends de contagem do rate limit (memória local ou compartilhado)"""
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        """Registra uma requisição; retorna 0 se permitida ou os segundos até liberar"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+def sliding_window_hit(entry: Optional[list], now: float, limit: int, window: float) -> tuple[list, float]:
+    """Janela deslizante aproximada (atual + anterior ponderada).
+
+    `entry` é [índice da janela, contagem atual, contagem anterior]; retorna a
+    entrada atualizada e 0 se a requisição é permitida, ou os segundos até liberar.
+    """
+    index = int(now // window)
+    if entry is None or entry[0] < index - 1:
+        entry = [index, 0, 0]
+    elif entry[0] == index - 1:
+        entry = [index, 0, entry[1]]
+
+    _, current, previous = entry
+    elapsed = (now % window) / window
+    if previous * (1 - elapsed) + current < limit:
+        entry[1] += 1
+        return entry, 0
+    if current >= limit or not previous:
+        return entry, window - now % window
+    # Espera até o peso da janela anterior cair o suficiente
+    return entry, max((1 - (limit - current) / previous - elapsed) * window, 0.001)
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """Janela deslizante aproximada por chave, em memória e com LRU"""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        # chave -> [índice da janela, contagem atual, contagem anterior]
+        self._windows: OrderedDict = OrderedDict()
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        entry, retry_after = sliding_window_hit(self._windows.get(key), time.monotonic(), limit, window)
+        self._windows[key] = entry
+        self._windows.move_to_end(key)
+        while len(self._windows) > self.max_keys:
+            self._windows.popitem(last=False)
+        return retry_after
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "keys": len(self._windows)}
+
+
+class SQLiteRateLimitBackend(RateLimitBackend):
+    """Mesma janela deslizante, com as contagens no estado compartilhado entre workers"""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, db: SharedStateDB):
+        self.db = db
+        self._hits = 0
+
+    def _hit(self, key: str, limit: int, window: float) -> float:
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT window_index, current, previous FROM rate_limits WHERE key = ?", (key,)
+            ).fetchone()
+            entry, retry_after = sliding_window_hit(list(row) if row else None, now, limit, window)
+            conn.execute(
+                "INSERT INTO rate_limits (key, window_index, current, previous, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET window_index = excluded.window_index, current = excluded.current, "
+                "previous = excluded.previous, updated_at = excluded.updated_at",
+                (key, *entry, now),
+            )
+            self._hits += 1
+            if self._hits % self.PURGE_EVERY == 0:
+                # Chaves sem uso há duas janelas já não pesam na contagem
+                conn.execute("DELETE FROM rate_limits WHERE updated_at < ?", (now - 2 * window,))
+        return retry_after
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        return await asyncio.to_thread(self._hit, key, limit, window)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "keys": self.db.connect().execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0],
+        }
+
+
+class ChatRateLimiter:
+    """Limites por IP e por sessão do chat, com contadores de bloqueios"""
+
+    def __init__(self, backend: RateLimitBackend, config: dict):
+        self.backend = backend
+        self.config = config
+        self.ip_limited = 0
+        self.session_limited = 0
+        self.oversized = 0
+
+    async def check_ip(self, ip: str) -> float:
+        retry_after = await self.backend.hit(f"ip:{ip}", self.config["per_ip"], self.config["window_seconds"])
+        if retry_after:
+            self.ip_limited += 1
+        return retry_after
+
+    async def check_session(self, session_id: str) -> float:
+        retry_after = await self.backend.hit(
+            f"session:{session_id}", self.config["per_session"], self.config["window_seconds"]
+        )
+        if retry_after:
+            self.session_limited += 1
+        return retry_after
+
+    def stats(self) -> dict:
+        return {
+            "per_ip": self.config["per_ip"],
+            "per_session": self.config["per_session"],
+            "window_seconds": self.config["window_seconds"],
+            "ip_limited": self.ip_limited,
+            "session_limited": self.session_limited,
+            "oversized": self.oversized,
+            **self.backend.stats(),
+        }
+
+
+chat_limiter = ChatRateLimiter(
+    SQLiteRateLimitBackend(shared_state) if shared_state is not None
+    else InMemoryRateLimitBackend(CHAT_LIMIT_CONFIG["max_keys"]),
+    CHAT_LIMIT_CONFIG,
+)
+
+
+class LeadStore:
+    """Interface para armazenamento de leads"""
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def save(self, lead: dict) -> int:
+        raise NotImplementedError
+
+    def save_many(self, leads: list) -> list:
+        return [self.save(lead) for lead in leads]
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def list_leads(self) -> list:
+        raise NotImplementedError
+
+    def query_leads(
+        self,
+        filters: dict,
+        limit: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+    ) -> list:
+        raise NotImplementedError
+
+    def interest_counts(self) -> dict:
+        raise NotImplementedError
+
+    def rollups(self) -> dict:
+        """Agregados mantidos a cada gravação: {dimensão: {faixa: total}}"""
+        raise NotImplementedError
+
+    def rebuild_rollups(self, batch_size: int = 1000):
+        """Recalcula os agregados varrendo a tabela (backfill)"""
+        raise NotImplementedError
+
+    def latest_id(self) -> int:
+        raise NotImplementedError
+
+    def change_position(self) -> tuple[int, int]:
+        """Último id gravado e última alteração registrada (para acompanhar inserções e junções)"""
+        raise NotImplementedError
+
+    def updated_leads(self, after_seq: int, limit: int) -> tuple[int, list]:
+        """Leads alterados por junção depois de after_seq: (última alteração lida, linhas atuais)"""
+        raise NotImplementedError
+
+    def iter_leads(
+        self,
+        batch_size: int = 500,
+        filters: Optional[dict] = None,
+        after_id: int = 0,
+        until_id: Optional[int] = None,
+    ) -> Iterator[dict]:
+        """Leads em ordem de id, com os mesmos filtros do painel, dentro de (after_id, until_id]"""
+        raise NotImplementedError
+
+    def get_meta(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set_meta(self, key: str, value: str):
+        raise NotImplementedError
+
+    def update_validation(self, leads: list):
+        """Regrava e-mail, postcode e colunas de validade de leads existentes (por id)"""
+        raise NotImplementedError
+
+    def update_areas(self, leads: list):
+        """Regrava distrito, borough e zona de leads existentes (por id)"""
+        raise NotImplementedError
+
+    def get_lead(self, lead_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def merge_many(self, leads: list, index: LeadDedupeIndex) -> list:
+        """Grava os leads juntando os repetidos ao registro existente; retorna (lead gravado, se foi junção)"""
+        raise NotImplementedError
+
+    def merge_duplicates(self, leads: list, duplicate_ids: list):
+        """Regrava os registros que receberam junções e apaga as cópias, numa transação"""
+        raise NotImplementedError
+
+
+class SQLiteLeadStore(LeadStore):
+    """Leads em SQLite (modo WAL) com índices para as consultas do painel"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            nome TEXT NOT NULL DEFAULT '',
+            whatsapp TEXT NOT NULL DEFAULT '',
+            email TEXT NOT NULL DEFAULT '',
+            tipo_interesse TEXT NOT NULL DEFAULT '',
+            orcamento TEXT NOT NULL DEFAULT '',
+            postcode TEXT NOT NULL DEFAULT '',
+            detalhes_adicionais TEXT NOT NULL DEFAULT '',
+            email_valido TEXT NOT NULL DEFAULT 'No',
+            postcode_valido TEXT NOT NULL DEFAULT 'No',
+            distrito TEXT NOT NULL DEFAULT '',
+            borough TEXT NOT NULL DEFAULT '',
+            zona TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_leads_timestamp ON leads(timestamp);
+        CREATE INDEX IF NOT EXISTS idx_leads_tipo_interesse ON leads(tipo_interesse);
+        CREATE INDEX IF NOT EXISTS idx_leads_postcode ON leads(postcode);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS lead_rollups (
+            dimension TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, bucket)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS lead_updates (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER NOT NULL
+        );
+    """
+
+    # Alterações mantidas no registro de junções (o stream do painel lê só as recentes)
+    UPDATES_KEEP = 10000
+
+    # Criados depois da migração das colunas de área em bancos antigos
+    AREA_INDEXES = """
+        CREATE INDEX IF NOT EXISTS idx_leads_distrito ON leads(distrito);
+        CREATE INDEX IF NOT EXISTS idx_leads_borough ON leads(borough);
+    """
+
+    SYNCHRONOUS = {"batch": "FULL", "normal": "NORMAL", "off": "OFF"}
+
+    def __init__(self, path: Path, fsync: str = "batch"):
+        if fsync not in self.SYNCHRONOUS:
+            raise ValueError(f"Invalid fsync policy: {fsync}")
+        self.path = path
+        self.synchronous = self.SYNCHRONOUS[fsync]
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Uma conexão por thread; o modo WAL permite leituras concorrentes
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(leads)")}
+        for field in AREA_FIELDS:
+            if field not in columns:
+                conn.execute(f"ALTER TABLE leads ADD COLUMN {field} TEXT NOT NULL DEFAULT ''")
+        conn.executescript(self.AREA_INDEXES)
+        conn.commit()
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    @staticmethod
+    def _row(lead: dict) -> tuple:
+        return tuple(str(lead.get(field, "") or "") for field in STORE_FIELDS)
+
+    @staticmethod
+    def _apply_rollups(conn: sqlite3.Connection, added: Iterable[dict] = (), removed: Iterable[dict] = ()):
+        """Atualiza os agregados na mesma transação da gravação (um upsert por faixa alterada)"""
+        deltas = {}
+        for leads, sign in ((added, 1), (removed, -1)):
+            for lead in leads:
+                for bucket in lead_rollup_buckets(lead):
+                    deltas[bucket] = deltas.get(bucket, 0) + sign
+        conn.executemany(
+            "INSERT INTO lead_rollups (dimension, bucket, total) VALUES (?, ?, ?) "
+            "ON CONFLICT(dimension, bucket) DO UPDATE SET total = total + excluded.total",
+            [(dimension, bucket, total) for (dimension, bucket), total in deltas.items() if total],
+        )
+
+    @staticmethod
+    def _rows_by_id(conn: sqlite3.Connection, ids: list) -> dict:
+        rows = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for row in conn.execute(f"SELECT * FROM leads WHERE id IN ({', '.join('?' for _ in chunk)})", chunk):
+                rows[row["id"]] = dict(row)
+        return rows
+
+    def save(self, lead: dict) -> int:
+        return self.save_many([lead])[0]
+
+    def save_many(self, leads: list) -> list:
+        conn = self._connect()
+        placeholders = ", ".join("?" for _ in STORE_FIELDS)
+        ids = []
+        with conn:
+            for lead in leads:
+                cursor = conn.execute(
+                    f"INSERT INTO leads ({', '.join(STORE_FIELDS)}) VALUES ({placeholders})",
+                    self._row(lead),
+                )
+                ids.append(cursor.lastrowid)
+            self._apply_rollups(conn, leads)
+        return ids
+
+    def merge_many(self, leads: list, index: LeadDedupeIndex) -> list:
+        conn = self._connect()
+        placeholders = ", ".join("?" for _ in STORE_FIELDS)
+        assignments = ", ".join(f"{field} = ?" for field in STORE_FIELDS)
+        results = []
+        keys = {}
+        with index.lock, conn:
+            last_id = index.last_id
+            # Trava de escrita antes da consulta: outro worker não grava o mesmo cliente no meio
+            conn.execute("BEGIN IMMEDIATE")
+            for row in conn.execute("SELECT * FROM leads WHERE id > ? ORDER BY id", (index.last_id,)).fetchall():
+                index.add(row["id"], dict(row))
+            for lead in leads:
+                lead_id = index.find(lead, keys)
+                existing = None
+                if lead_id is not None:
+                    existing = conn.execute("SELECT * FROM leads WHERE id = ?", (lead_id,)).fetchone()
+                if existing is None:
+                    lead_id = conn.execute(
+                        f"INSERT INTO leads ({', '.join(STORE_FIELDS)}) VALUES ({placeholders})",
+                        self._row(lead),
+                    ).lastrowid
+                    stored = dict(lead, id=lead_id)
+                    keys.update((key, lead_id) for key in dedupe_keys(stored))
+                    last_id = max(last_id, lead_id)
+                    self._apply_rollups(conn, [stored])
+                    results.append((stored, False))
+                else:
+                    stored = merge_lead(dict(existing), lead)
+                    conn.execute(f"UPDATE leads SET {assignments} WHERE id = ?", (*self._row(stored), lead_id))
+                    # A sequência segue a ordem dos commits (escritas serializadas): o painel não perde junções
+                    conn.execute("INSERT INTO lead_updates (lead_id) VALUES (?)", (lead_id,))
+                    self._apply_rollups(conn, [stored], [dict(existing)])
+                    # Chaves novas do registro (ex.: celular informado depois) passam a apontar para ele
+                    for key in dedupe_keys(stored):
+                        if key not in keys and key not in index:
+                            keys[key] = lead_id
+                    results.append((stored, True))
+            if any(merged for _, merged in results):
+                conn.execute(
+                    "DELETE FROM lead_updates WHERE seq <= (SELECT MAX(seq) FROM lead_updates) - ?",
+                    (self.UPDATES_KEEP,),
+                )
+            # Só depois do commit: um rollback não deixa ids inexistentes no índice
+            conn.commit()
+            index.update(keys, last_id)
+            index.merged += sum(merged for _, merged in results)
+        return results
+
+    def get_lead(self, lead_id: int) -> Optional[dict]:
+        row = self._connect().execute("SELECT * FROM leads WHERE id = ?", (lead_id,)).fetchone()
+        return dict(row) if row else None
+
+    def merge_duplicates(self, leads: list, duplicate_ids: list):
+        conn = self._connect()
+        assignments = ", ".join(f"{field} = ?" for field in STORE_FIELDS)
+        with conn:
+            previous = self._rows_by_id(conn, [lead["id"] for lead in leads] + list(duplicate_ids))
+            conn.executemany(
+                f"UPDATE leads SET {assignments} WHERE id = ?",
+                [(*self._row(lead), lead["id"]) for lead in leads],
+            )
+            conn.executemany("DELETE FROM leads WHERE id = ?", [(lead_id,) for lead_id in duplicate_ids])
+            self._apply_rollups(conn, leads, previous.values())
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+
+    def list_leads(self) -> list:
+        rows = self._connect().execute("SELECT * FROM leads ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _filter_clause(filters: dict) -> tuple[list, list]:
+        """Converte os filtros do painel em cláusulas SQL que usam os índices"""
+        clauses = []
+        params = []
+
+        if filters.get("tipo_interesse"):
+            clauses.append("tipo_interesse = ?")
+            params.append(filters["tipo_interesse"].strip().lower())
+
+        # Filtros de área usam as colunas preenchidas pelo índice de áreas
+        area = (filters.get("postcode_area") or "").strip()
+        compact = area.replace(" ", "").upper()
+        outward = area_index.outward(area)
+        if not area:
+            pass
+        elif compact.isalpha() and len(compact) <= 2:
+            # Área (ex.: "E") não pode casar com outra área ("EC")
+            clauses.append("distrito GLOB ?")
+            params.append(f"{compact}[0-9]*")
+        elif outward:
+            # Outward code ou postcode completo ("SW1A 1AA" → "SW1A"); o distrito inclui os
+            # subdistritos com letra ("SW1" → "SW1A"), como em AreaIndex._district
+            clauses.append("(distrito = ? OR distrito GLOB ?)")
+            params.extend([outward, f"{outward}[A-Z]"])
+        else:
+            # Área conhecida ou localidade (ex.: "Chelsea") → seus distritos
+            districts = area_index.districts_named(area)
+            if districts:
+                clauses.append(f"distrito IN ({', '.join('?' for _ in districts)})")
+                params.extend(districts)
+            else:
+                clauses.append("0")
+
+        if filters.get("borough"):
+            clauses.append("borough = ?")
+            params.append(area_index.borough(filters["borough"]) or filters["borough"].strip())
+        if filters.get("zone"):
+            clauses.append("zona = ?")
+            params.append(str(filters["zone"]))
+
+        if filters.get("date_from"):
+            clauses.append("timestamp >= ?")
+            params.append(filters["date_from"])
+        if filters.get("date_to"):
+            clauses.append("timestamp < ?")
+            params.append(filters["date_to"])
+
+        if filters.get("valid") == "yes":
+            clauses.append("email_valido = 'Yes' AND postcode_valido = 'Yes'")
+        elif filters.get("valid") == "no":
+            clauses.append("(email_valido = 'No' OR postcode_valido = 'No')")
+
+        return clauses, params
+
+    def query_leads(
+        self,
+        filters: dict,
+        limit: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+    ) -> list:
+        clauses, params = self._filter_clause(filters)
+        if before_id is not None:
+            clauses.append("id < ?")
+            params.append(before_id)
+        if after_id is not None:
+            clauses.append("id > ?")
+            params.append(after_id)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        # Com after_id os mais antigos vêm primeiro para não pular linhas novas
+        order = "ASC" if after_id is not None else "DESC"
+        rows = self._connect().execute(
+            f"SELECT * FROM leads {where} ORDER BY id {order} LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def interest_counts(self) -> dict:
+        # Dos agregados, sem varrer a tabela; leads sem interesse ficam em "unknown"
+        rows = self._connect().execute(
+            "SELECT bucket, total FROM lead_rollups WHERE dimension = 'interest' AND total > 0"
+        ).fetchall()
+        return {row["bucket"]: row["total"] for row in rows}
+
+    def rollups(self) -> dict:
+        result = {}
+        for row in self._connect().execute("SELECT dimension, bucket, total FROM lead_rollups WHERE total > 0"):
+            result.setdefault(row["dimension"], {})[row["bucket"]] = row["total"]
+        return result
+
+    def rebuild_rollups(self, batch_size: int = 1000):
+        conn = self._connect()
+        with conn:
+            # Trava de escrita durante a varredura: nenhum lead fica de fora ou conta duas vezes
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM lead_rollups")
+            last_id = 0
+            while True:
+                rows = conn.execute("SELECT * FROM leads WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                self._apply_rollups(conn, [dict(row) for row in rows])
+                last_id = rows[-1]["id"]
+
+    def latest_id(self) -> int:
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM leads").fetchone()[0]
+
+    def change_position(self) -> tuple[int, int]:
+        row = self._connect().execute(
+            "SELECT (SELECT COALESCE(MAX(id), 0) FROM leads), (SELECT COALESCE(MAX(seq), 0) FROM lead_updates)"
+        ).fetchone()
+        return row[0], row[1]
+
+    def updated_leads(self, after_seq: int, limit: int) -> tuple[int, list]:
+        rows = self._connect().execute(
+            "SELECT u.seq AS change_seq, l.* FROM lead_updates u JOIN leads l ON l.id = u.lead_id "
+            "WHERE u.seq > ? ORDER BY u.seq LIMIT ?",
+            (after_seq, limit),
+        ).fetchall()
+        if not rows:
+            return after_seq, []
+        # Um lead alterado várias vezes vai uma vez só, na versão atual
+        latest = {}
+        for row in rows:
+            lead = dict(row)
+            lead.pop("change_seq")
+            latest[lead["id"]] = lead
+        return rows[-1]["change_seq"], list(latest.values())
+
+    def iter_leads(
+        self,
+        batch_size: int = 500,
+        filters: Optional[dict] = None,
+        after_id: int = 0,
+        until_id: Optional[int] = None,
+    ) -> Iterator[dict]:
+        # Paginação por chave (id) para não carregar a tabela inteira
+        clauses, params = self._filter_clause(filters or {})
+        if until_id is not None:
+            clauses.append("id <= ?")
+            params.append(until_id)
+        where = " AND ".join(["id > ?", *clauses])
+        last_id = after_id
+        while True:
+            # Conexão obtida a cada lote: um gerador de streaming pode continuar em outra thread
+            rows = self._connect().execute(
+                f"SELECT * FROM leads WHERE {where} ORDER BY id LIMIT ?",
+                (last_id, *params, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+            last_id = rows[-1]["id"]
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    def _update_columns(self, leads: list, fields: tuple):
+        conn = self._connect()
+        with conn:
+            previous = self._rows_by_id(conn, [lead["id"] for lead in leads])
+            conn.executemany(
+                f"UPDATE leads SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                [tuple(lead[field] for field in fields) + (lead["id"],) for lead in leads],
+            )
+            updated = [dict(row, **{field: lead[field] for field in fields})
+                       for lead in leads if (row := previous.get(lead["id"])) is not None]
+            self._apply_rollups(conn, updated, previous.values())
+
+    def update_validation(self, leads: list):
+        self._update_columns(leads, VALIDATION_FIELDS)
+
+    def update_areas(self, leads: list):
+        self._update_columns(leads, AREA_FIELDS)
+
+
+lead_store: LeadStore = SQLiteLeadStore(LEADS_DB_FILE, LEAD_WRITER_CONFIG["fsync"])
+
+
+class NotificationOutbox:
+    """Notificações pendentes persistidas em SQLite para sobreviver a reinícios"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            last_error TEXT,
+            claimed_by TEXT,
+            claimed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox(status, next_attempt_at);
+    """
+
+    # Pendentes vencidos ou em envio por um worker que não terminou dentro do lease
+    DUE_CLAUSE = "(status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND claimed_at <= ?)"
+
+    def __init__(self, path: Path, lease: float = 300.0):
+        self.path = path
+        self.lease = lease
+        self.opened = False
+        # Uma conexão por thread: as escritas rodam fora do event loop (asyncio.to_thread)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(notification_outbox)")}
+        for column, kind in (("claimed_by", "TEXT"), ("claimed_at", "REAL")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE notification_outbox ADD COLUMN {column} {kind}")
+        conn.commit()
+        self.opened = True
+
+    def close(self):
+        self.opened = False
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def add_many(self, payloads: list) -> list:
+        conn = self.connect()
+        created_at, now = datetime.now().isoformat(), time.time()
+        ids = []
+        with conn:
+            for payload in payloads:
+                cursor = conn.execute(
+                    "INSERT INTO notification_outbox (payload, created_at, next_attempt_at) VALUES (?, ?, ?)",
+                    (json.dumps(payload), created_at, now),
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def due(self, now: float, limit: int) -> list:
+        """Itens prontos para envio (só consulta; o envio exige claim)"""
+        rows = self.connect().execute(
+            f"SELECT * FROM notification_outbox WHERE {self.DUE_CLAUSE} ORDER BY id LIMIT ?",
+            (now, now - self.lease, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim(self, now: float, limit: int, owner: str) -> list:
+        """Reserva itens prontos para este worker; outro worker não pega os mesmos"""
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "UPDATE notification_outbox SET status = 'sending', claimed_by = ?, claimed_at = ? "
+                f"WHERE id IN (SELECT id FROM notification_outbox WHERE {self.DUE_CLAUSE} ORDER BY id LIMIT ?)",
+                (owner, now, now, now - self.lease, limit),
+            )
+            rows = conn.execute(
+                "SELECT * FROM notification_outbox WHERE status = 'sending' AND claimed_by = ? AND claimed_at = ? "
+                "ORDER BY id",
+                (owner, now),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def next_due(self) -> Optional[float]:
+        row = self.connect().execute(
+            "SELECT MIN(CASE status WHEN 'pending' THEN next_attempt_at ELSE claimed_at + ? END) "
+            "FROM notification_outbox WHERE status IN ('pending', 'sending')",
+            (self.lease,),
+        ).fetchone()
+        return row[0]
+
+    def delete(self, ids: list):
+        conn = self.connect()
+        with conn:
+            conn.executemany("DELETE FROM notification_outbox WHERE id = ?", [(i,) for i in ids])
+
+    def reschedule(self, item_id: int, attempts: int, next_attempt_at: float, error: str, failed: bool):
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "UPDATE notification_outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, status = ?, "
+                "claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+                (attempts, next_attempt_at, error, "failed" if failed else "pending", item_id),
+            )
+
+    def counts(self) -> dict:
+        if not self.opened:
+            return {}
+        rows = self.connect().execute(
+            "SELECT status, COUNT(*) AS total FROM notification_outbox GROUP BY status"
+        ).fetchall()
+        return {row["status"]: row["total"] for row in rows}
+
+
+class NotificationQueue:
+    """Fila assíncrona de notificações por email, fora do caminho da requisição"""
+
+    def __init__(self, outbox: NotificationOutbox, config: dict):
+        self.outbox = outbox
+        self.config = config
+        # Identifica os claims deste processo no outbox compartilhado
+        self.owner = WORKER_ID
+        self.smtp = SMTPConnection(config)
+        self.sent = 0
+        self.digests = 0
+        self.retries = 0
+        self.send_failures = 0
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stop: Optional[asyncio.Event] = None
+
+    def start(self):
+        """Abre o outbox e inicia o worker (itens pendentes de execuções anteriores incluídos)"""
+        self.outbox.open()
+        self._wakeup = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Para o worker; o que não foi entregue continua no outbox"""
+        if self._task is None:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+        self._task = None
+        await asyncio.to_thread(self.smtp.close)
+        self.outbox.close()
+
+    async def enqueue(self, leads: list) -> int:
+        """Agenda a notificação dos leads capturados (o INSERT no outbox roda numa thread)"""
+        if not leads:
+            return 0
+        if not email_configured():
+            logger.info("Email not configured, skipping notification")
+            return 0
+
+        captured_at = datetime.now().isoformat()
+        await asyncio.to_thread(self.outbox.add_many, [{"lead": lead, "captured_at": captured_at} for lead in leads])
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return len(leads)
+
+    async def _sleep(self, timeout: Optional[float]):
+        """Espera até o timeout, um novo item ou o pedido de parada"""
+        waiters = [asyncio.ensure_future(self._wakeup.wait()), asyncio.ensure_future(self._stop.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            items = await asyncio.to_thread(self.outbox.due, time.time(), self.config["batch_size"])
+
+            if not items:
+                next_due = await asyncio.to_thread(self.outbox.next_due)
+                await self._sleep(None if next_due is None else max(0.0, next_due - time.time()))
+                continue
+
+            if self.config["digest_window"] > 0 and any(item["attempts"] == 0 for item in items):
+                # Aguarda a janela para agrupar uma rajada de leads num único email
+                try:
+                    await asyncio.wait_for(self._stop.wait(), self.config["digest_window"])
+                except asyncio.TimeoutError:
+                    pass
+
+            # Com vários workers, só quem reservar os itens envia
+            items = await asyncio.to_thread(self.outbox.claim, time.time(), self.config["batch_size"], self.owner)
+            if items:
+                await self._deliver(items)
+
+    async def _deliver(self, items: list):
+        decoded = []
+        for item in items:
+            payload = json.loads(item["payload"])
+            decoded.append((payload["lead"], datetime.fromisoformat(payload["captured_at"])))
+
+        if self.config["digest_window"] > 0 and len(items) > 1:
+            groups = [(items, build_digest_email(decoded))]
+        else:
+            groups = [([item], build_lead_email(*entry)) for item, entry in zip(items, decoded)]
+
+        for group, msg in groups:
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.smtp.send, msg)
+            except Exception as e:
+                EMAIL_SEND_LATENCY.observe(time.perf_counter() - started, "failed")
+                self.send_failures += 1
+                logger.error("Failed to send email", extra={"error": str(e), "leads": len(group)})
+                for item in group:
+                    await self._retry(item, str(e))
+                continue
+
+            EMAIL_SEND_LATENCY.observe(time.perf_counter() - started, "sent")
+            await asyncio.to_thread(self.outbox.delete, [item["id"] for item in group])
+            self.sent += len(group)
+            if len(group) > 1:
+                self.digests += 1
+            logger.info("Notification email sent", extra={"leads": len(group)})
+
+    async def _retry(self, item: dict, error: str):
+        attempts = item["attempts"] + 1
+        failed = attempts >= self.config["max_attempts"]
+        # Backoff exponencial com jitter
+        delay = min(self.config["retry_base"] * 2 ** (attempts - 1), self.config["retry_max"])
+        delay *= 0.5 + random.random() / 2
+        await asyncio.to_thread(self.outbox.reschedule, item["id"], attempts, time.time() + delay, error, failed)
+        if failed:
+            logger.error("Giving up on notification", extra={"notification_id": item["id"], "attempts": attempts})
+        else:
+            self.retries += 1
+
+    def stats(self) -> dict:
+        counts = self.outbox.counts()
+        return {
+            "pending": counts.get("pending", 0),
+            "sending": counts.get("sending", 0),
+            "failed": counts.get("failed", 0),
+            "sent": self.sent,
+            "digests": self.digests,
+            "retries": self.retries,
+            "send_failures": self.send_failures,
+        }
+
+
+notification_queue = NotificationQueue(NotificationOutbox(LEADS_DB_FILE, STATE_CONFIG["outbox_lease"]), EMAIL_CONFIG)
+
+
+class LeadWriter:
+    """Grava leads em lotes a partir de uma única task alimentada por uma fila"""
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, store: LeadStore, config: dict, dedupe: Optional[LeadDedupeIndex] = None):
+        self.store = store
+        self.config = config
+        self.dedupe = dedupe
+        self.commit_hooks = []
+        self.batches = 0
+        self.rows = 0
+        self.merged = 0
+        self.backpressure_waits = 0
+        self.last_commit_ms = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.config["queue_size"])
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Grava tudo o que ainda está na fila e encerra a task"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._queue = None
+
+    async def submit(self, row: dict):
+        """Enfileira um lead; só espera se a fila estiver cheia (backpressure)"""
+        if self._task is None:
+            # Sem a task (ex.: uso fora do lifespan): grava diretamente
+            await self._after_commit(await asyncio.to_thread(self._save, [row]))
+            return
+
+        if self._queue.full():
+            self.backpressure_waits += 1
+        await self._queue.put(row)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+
+            # Janela curta para agrupar leads concorrentes no mesmo commit
+            if batch[0] is not None and self.config["batch_delay"] > 0 and self._queue.empty():
+                await asyncio.sleep(self.config["batch_delay"])
+            while len(batch) < self.config["batch_size"] and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            if None in batch:
+                stopping = True
+                batch = [row for row in batch if row is not None]
+                # Drena o que chegou antes do pedido de parada
+                while not self._queue.empty():
+                    row = self._queue.get_nowait()
+                    if row is not None:
+                        batch.append(row)
+
+            if batch:
+                await self._commit(batch)
+
+    async def _commit(self, batch: list):
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            started = time.perf_counter()
+            try:
+                saved = await asyncio.to_thread(self._save, batch)
+                break
+            except Exception as e:
+                logger.error("Failed to save leads", extra={"leads": len(batch), "attempt": attempt, "error": str(e)})
+                if attempt == self.MAX_ATTEMPTS:
+                    await asyncio.to_thread(self._write_unsaved, batch)
+                    return
+                await asyncio.sleep(min(0.2 * 2 ** attempt, 5.0))
+
+        elapsed = time.perf_counter() - started
+        LEAD_WRITE_LATENCY.observe(elapsed)
+        LEADS_WRITTEN.inc(amount=len(batch))
+        self.last_commit_ms = elapsed * 1000
+        self.batches += 1
+        self.rows += len(batch)
+        await self._after_commit(saved)
+
+    def _save(self, batch: list) -> list:
+        """Grava o lote; com o índice de duplicados, leads repetidos atualizam o registro existente"""
+        if self.dedupe is None:
+            return [dict(row, id=lead_id) for row, lead_id in zip(batch, self.store.save_many(batch))]
+        saved = []
+        for lead, merged in self.store.merge_many(batch, self.dedupe):
+            if merged:
+                self.merged += 1
+                lead["merged"] = True
+            saved.append(lead)
+        return saved
+
+    async def _after_commit(self, leads: list):
+        # Ganchos podem ser corrotinas (ex.: o outbox, que grava numa thread)
+        for hook in self.commit_hooks:
+            try:
+                result = hook(leads)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logger.exception("Lead commit hook failed")
+
+    @staticmethod
+    def _write_unsaved(batch: list):
+        UNSAVED_LEADS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(UNSAVED_LEADS_FILE, "a", encoding="utf-8") as f:
+            for row in batch:
+                f.write(json.dumps(row) + "\n")
+        logger.error("Leads written to the unsaved file", extra={"leads": len(batch), "file": UNSAVED_LEADS_FILE.name})
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "rows": self.rows,
+            "avg_batch_size": round(self.rows / self.batches, 2) if self.batches else 0,
+            "backpressure_waits": self.backpressure_waits,
+            "merged": self.merged,
+            "last_commit_ms": round(self.last_commit_ms, 2),
+            "fsync": self.config["fsync"],
+        }
+
+
+lead_dedupe = LeadDedupeIndex() if LEAD_WRITER_CONFIG["dedupe"] else None
+lead_writer = LeadWriter(lead_store, LEAD_WRITER_CONFIG, lead_dedupe)
+
+
+async def notify_saved_leads(leads: list):
+    """Notificações só saem depois que o lead foi gravado (e só para clientes novos)"""
+    await notification_queue.enqueue([lead for lead in leads if not lead.get("merged")])
+
+
+lead_writer.commit_hooks.append(notify_saved_leads)
+
+
+class LeadBroadcaster:
+    """Acompanha os leads novos no banco e repassa cada lote a todos os painéis conectados.
+
+    Uma única leitura por lote, qualquer que seja o número de painéis; o evento
+    SSE é montado uma vez e a mesma string vai para todas as filas.
+    """
+
+    def __init__(self, store: LeadStore, config: dict):
+        self.store = store
+        self.config = config
+        self.latest_id = 0
+        # Última junção repassada (leads repetidos atualizam a linha existente)
+        self.latest_update = 0
+        self.reads = 0
+        self.events = 0
+        self.dropped = 0
+        self._subscribers: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.close_all()
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def notify(self, leads: list):
+        """Commit hook do lead writer: publica sem esperar o próximo ciclo de consulta"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def subscribe(self) -> Optional[asyncio.Queue]:
+        if len(self._subscribers) >= self.config["max_subscribers"]:
+            return None
+        if not self._subscribers:
+            # Sem painéis o banco não é consultado: retoma a partir do último lead e da última junção
+            position = await asyncio.to_thread(self.store.change_position)
+            if not self._subscribers:
+                self.latest_id, self.latest_update = position
+        queue = asyncio.Queue(maxsize=self.config["queue_size"])
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def _close(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+        # Abre espaço para o aviso de fim mesmo com a fila cheia
+        while queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def close_all(self):
+        """Encerra todos os streams (desligamento); os painéis reconectam em outro worker"""
+        for queue in list(self._subscribers):
+            self._close(queue)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.config["poll_interval"])
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._subscribers:
+                continue
+            try:
+                await self._publish_new()
+            except Exception:
+                logger.exception("Lead events poll failed")
+
+    def _read_changes(self) -> tuple[int, list, list, dict]:
+        """Numa thread: junções e leads novos desde a última leitura, mais os contadores atuais"""
+        latest_update, updated = self.store.updated_leads(self.latest_update, 500)
+        # Leads ainda não repassados vão como novos, já na versão atual
+        updated = [lead for lead in updated if lead["id"] <= self.latest_id]
+        rows = self.store.query_leads({}, 500, after_id=self.latest_id)
+        totals = interest_summary(self.store.interest_counts()) if rows or updated else {}
+        return latest_update, updated, rows, totals
+
+    async def _publish_new(self):
+        latest_id, latest_update = await asyncio.to_thread(self.store.change_position)
+        while (latest_id > self.latest_id or latest_update > self.latest_update) and self._subscribers:
+            changed_to, updated, rows, totals = await asyncio.to_thread(self._read_changes)
+            self.reads += 1
+            self.latest_update = changed_to
+            if rows:
+                self.latest_id = rows[-1]["id"]
+            if rows or updated:
+                self._broadcast(rows, updated, totals)
+            if len(rows) < 500 and changed_to >= latest_update:
+                break
+
+    def _broadcast(self, rows: list, updated: list, totals: dict):
+        # Variação dos contadores do painel trazida pelos leads novos deste lote
+        interests = {}
+        for row in rows:
+            interests[row["tipo_interesse"]] = interests.get(row["tipo_interesse"], 0) + 1
+        counts = interest_summary(interests)
+        data = {"leads": rows, "updated": updated, "counts": counts, "totals": totals, "latest_id": self.latest_id}
+        event = f"id: {self.latest_id}\nevent: leads\ndata: {json.dumps(data)}\n\n"
+        self.events += 1
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                self._close(queue)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "latest_id": self.latest_id,
+            "latest_update": self.latest_update,
+            "reads": self.reads,
+            "events": self.events,
+            "dropped_subscribers": self.dropped,
+        }
+
+
+lead_broadcaster = LeadBroadcaster(lead_store, LEAD_EVENTS_CONFIG)
+lead_writer.commit_hooks.append(lead_broadcaster.notify)
+
+
+def migrate_csv_to_store(store: LeadStore, csv_path: Path, force: bool = False) -> int:
+    """Importa o CSV legado para o store uma única vez; retorna quantos leads importou"""
+    if not csv_path.exists():
+        return 0
+    if store.get_meta("csv_migrated_at") and not force:
+        return 0
+
+    import csv
+
+    imported = 0
+    batch = []
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        for row in validate_leads(csv.DictReader(f)):
+            row["tipo_interesse"] = (row.get("tipo_interesse") or "").strip().lower()
+            row.update(area_index.lead_fields(row["postcode"]))
+            batch.append(row)
+            if len(batch) >= 1000:
+                imported += len(store.save_many(batch))
+                batch = []
+    if batch:
+        imported += len(store.save_many(batch))
+
+    store.set_meta("csv_migrated_at", datetime.now().isoformat())
+    logger.info("Imported leads from CSV", extra={"leads": imported, "file": csv_path.name})
+    return imported
+
+
+def revalidate_store(store: LeadStore, batch_size: int = 1000) -> dict:
+    """Revalida todos os leads numa passada, regravando só as linhas que mudaram"""
+    totals = {"checked": 0, "updated": 0, "invalid": 0}
+    pending = []
+    for lead in store.iter_leads(batch_size):
+        normalised = normalise_lead(lead)
+        totals["checked"] += 1
+        if "No" in (normalised["email_valido"], normalised["postcode_valido"]):
+            totals["invalid"] += 1
+        if any(normalised[field] != lead[field] for field in VALIDATION_FIELDS):
+            pending.append(normalised)
+            if len(pending) >= batch_size:
+                store.update_validation(pending)
+                totals["updated"] += len(pending)
+                pending = []
+    if pending:
+        store.update_validation(pending)
+        totals["updated"] += len(pending)
+    return totals
+
+
+def index_lead_areas(store: LeadStore, index: AreaIndex, batch_size: int = 1000, force: bool = False) -> int:
+    """Preenche distrito/borough/zona dos leads; só roda de novo quando a base de áreas muda"""
+    if store.get_meta("areas_version") == index.version and not force:
+        return 0
+
+    updated = 0
+    pending = []
+    for lead in store.iter_leads(batch_size):
+        fields = index.lead_fields(lead["postcode"])
+        if any(lead[field] != fields[field] for field in AREA_FIELDS):
+            pending.append(dict(fields, id=lead["id"]))
+            if len(pending) >= batch_size:
+                store.update_areas(pending)
+                updated += len(pending)
+                pending = []
+    if pending:
+        store.update_areas(pending)
+        updated += len(pending)
+
+    store.set_meta("areas_version", index.version)
+    if updated:
+        logger.info("Indexed lead areas", extra={"leads": updated, "version": index.version})
+    return updated
 
-# Configuração de email (opcional)
-EMAIL_CONFIG = {
-    "smtp_server": os.environ.get("SMTP_SERVER", "smtp.gmail.com"),
-    "smtp_port": int(os.environ.get("SMTP_PORT", "587")),
-    "sender_email": os.environ.get("SENDER_EMAIL", ""),
-    "sender_password": os.environ.get("SENDER_PASSWORD", ""),
-    "recipient_email": os.environ.get("RECIPIENT_EMAIL", ""),
-}
 
+def rollup_leads(store: LeadStore, force: bool = False) -> bool:
+    """Monta os agregados de /api/leads/stats uma vez; depois eles seguem cada gravação"""
+    if store.get_meta("rollups_version") == ROLLUPS_VERSION and not force:
+        return False
+    started = time.perf_counter()
+    store.rebuild_rollups()
+    store.set_meta("rollups_version", ROLLUPS_VERSION)
+    logger.info("Built lead rollups", extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)})
+    return True
 
-def validate_email(email: str) -> bool:
-    """Valida formato de email"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
 
+def dedupe_store(store: LeadStore, batch_size: int = 1000) -> dict:
+    """Junta os leads repetidos já gravados ao registro mais antigo e apaga as cópias"""
+    index = LeadDedupeIndex()
+    totals = {"checked": 0, "merged": 0}
+    targets = {}
+    duplicates = []
+    for lead in store.iter_leads(batch_size):
+        totals["checked"] += 1
+        target_id = index.find(lead)
+        if target_id is None:
+            index.add(lead["id"], lead)
+            continue
+        target = targets.get(target_id) or store.get_lead(target_id)
+        targets[target_id] = merge_lead(target, lead)
+        index.add(target_id, targets[target_id])
+        duplicates.append(lead["id"])
+        if len(duplicates) >= batch_size:
+            store.merge_duplicates(list(targets.values()), duplicates)
+            totals["merged"] += len(duplicates)
+            targets = {}
+            duplicates = []
+    if duplicates:
+        store.merge_duplicates(list(targets.values()), duplicates)
+        totals["merged"] += len(duplicates)
+    if totals["merged"]:
+        logger.info("Merged duplicate leads", extra=totals)
+    return totals
 
-def validate_uk_postcode(postcode: str) -> bool:
-    """Valida formato de postcode do Reino Unido"""
-    # Padrão UK: AA9A 9AA, A9A 9AA, A9 9AA, A99 9AA, AA9 9AA, AA99 9AA
-    pattern = r'^[A-Z]{1,2}[0-9][A-Z0-9]?\s*[0-9][A-Z]{2}$'
-    return bool(re.match(pattern, postcode.upper().strip()))
 
+def revalidate_csv(source, target):
+    """Revalida um CSV de leads em streaming, escrevendo a versão normalizada"""
+    import csv
 
-def send_email_notification(lead_data: dict):
-    """Send email notification when a lead is captured"""
-    if not EMAIL_CONFIG["sender_email"] or not EMAIL_CONFIG["recipient_email"]:
-        print("[INFO] Email not configured, skipping notification")
-        return False
+    reader = csv.DictReader(source)
+    writer = csv.DictWriter(target, fieldnames=reader.fieldnames or LEAD_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for row in validate_leads(reader):
+        writer.writerow(row)
 
+
+def process_uptime_ms() -> Optional[float]:
+    """Milissegundos desde o início do processo (Linux; None em outros sistemas)"""
     try:
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_CONFIG["sender_email"]
-        msg['To'] = EMAIL_CONFIG["recipient_email"]
-        msg['Subject'] = f"🏠 New Lead Captured - {lead_data.get('tipo_interesse', 'N/A').upper()}"
-
-        body = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px;">
-            <h2 style="color: #1a1f3d;">🏠 New Property Lead</h2>
-            <hr style="border: 1px solid #c9a227;">
-            <table style="width: 100%; border-collapse: collapse;">
-                <tr>
-                    <td style="padding: 10px; font-weight: bold;">Name:</td>
-                    <td style="padding: 10px;">{lead_data.get('nome', 'N/A')}</td>
-                </tr>
-                <tr style="background: #f5f3ef;">
-                    <td style="padding: 10px; font-weight: bold;">Email:</td>
-                    <td style="padding: 10px;">{lead_data.get('email', 'N/A')}</td>
-                </tr>
-                <tr>
-                    <td style="padding: 10px; font-weight: bold;">Interest:</td>
-                    <td style="padding: 10px;">{lead_data.get('tipo_interesse', 'N/A').upper()}</td>
-                </tr>
-                <tr style="background: #f5f3ef;">
-                    <td style="padding: 10px; font-weight: bold;">Budget:</td>
-                    <td style="padding: 10px;">{lead_data.get('orcamento', 'N/A')}</td>
-                </tr>
-                <tr>
-                    <td style="padding: 10px; font-weight: bold;">Postcode:</td>
-                    <td style="padding: 10px;">{lead_data.get('postcode', 'N/A')}</td>
-                </tr>
-                <tr style="background: #f5f3ef;">
-                    <td style="padding: 10px; font-weight: bold;">Details:</td>
-                    <td style="padding: 10px;">{lead_data.get('detalhes_adicionais', 'N/A')}</td>
-                </tr>
-            </table>
-            <hr style="border: 1px solid #c9a227;">
-            <p style="color: #666; font-size: 12px;">
-                Captured on: {datetime.now().strftime('%d/%m/%Y at %H:%M')}
-            </p>
-        </body>
-        </html>
-        """
+        # starttime (campo 22 de /proc/self/stat) em ticks desde o boot
+        fields = Path("/proc/self/stat").read_text().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        uptime = float(Path("/proc/uptime").read_text().split()[0])
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    return round((uptime - started) * 1000, 1)
 
-        msg.attach(MIMEText(body, 'html'))
 
-        server = smtplib.SMTP(EMAIL_CONFIG["smtp_server"], EMAIL_CONFIG["smtp_port"])
-        server.starttls()
-        server.login(EMAIL_CONFIG["sender_email"], EMAIL_CONFIG["sender_password"])
-        server.send_message(msg)
-        server.quit()
+class StartupTimer:
+    """Detalhamento da inicialização: fases (ms) e marcos contados do início do processo"""
 
-        print("[INFO] Notification email sent successfully")
-        return True
-    except Exception as e:
-        print(f"[ERROR] Failed to send email: {str(e)}")
-        return False
+    def __init__(self):
+        self.phases = {}
+        self.marks = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    def mark(self, name: str):
+        """Registra o marco uma única vez (ex.: primeira resposta)"""
+        if name not in self.marks:
+            self.marks[name] = process_uptime_ms()
+
+    def stats(self) -> dict:
+        return {"phases_ms": dict(self.phases), "since_process_start_ms": dict(self.marks)}
+
+
+startup_timer = StartupTimer()
+
+
+class WarmUp:
+    """Aquecimento opcional em segundo plano: o worker já atende, e /api/ready indica quando terminou"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.state = "pending"
+        self.steps = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state in ("done", "disabled")
+
+    def start(self):
+        if not self.config["enabled"]:
+            # Sem warm-up, cada parte é criada no primeiro uso
+            self.state = "disabled"
+            return
+        self.state = "running"
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _steps(self) -> dict:
+        steps = {"gemini_connect": gemini_pool.preconnect}
+        if system_prompt_cache.usable():
+            # Cria (ou adota) o cachedContent do SYSTEM_PROMPT
+            steps["context_cache"] = system_prompt_cache.get_name
+        if lead_dedupe is not None:
+            steps["dedupe_index"] = partial(asyncio.to_thread, lead_dedupe.load, lead_store)
+        return steps
+
+    async def _step(self, name: str, func: Callable[[], Awaitable]):
+        self.steps[name] = "running"
+        with startup_timer.phase(f"warmup.{name}"):
+            try:
+                await func()
+                self.steps[name] = "ok"
+            except Exception as e:
+                self.steps[name] = "failed"
+                logger.warning("Warm-up step failed", extra={"step": name, "error": str(e)})
+
+    async def _run(self):
+        with startup_timer.phase("warmup"):
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(self._step(name, func) for name, func in self._steps().items())),
+                    self.config["timeout"],
+                )
+            except asyncio.TimeoutError:
+                for name, status in self.steps.items():
+                    if status == "running":
+                        self.steps[name] = "timeout"
+        self.state = "done"
+        startup_timer.mark("warm")
+        logger.info("Warm-up finished", extra={"steps": self.steps, **startup_timer.stats()})
+
+    def stats(self) -> dict:
+        return {"state": self.state, "steps": dict(self.steps)}
+
+
+warm_up = WarmUp(WARMUP_CONFIG)
+
+
+@contextmanager
+def startup_lock(path: Path):
+    """Serializa esquema e migrações entre workers que sobem ao mesmo tempo"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def close_streams_on_signal():
+    """Encerra os streams do painel assim que o uvicorn recebe SIGTERM/SIGINT.
+
+    Sem isso o desligamento gracioso esperaria as conexões SSE até o timeout.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(lead_broadcaster.close_all)
+            previous(signum, frame)
+
+        signal.signal(sig, handler)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Inicialização da aplicação"""
-    # Criar arquivo CSV com cabeçalhos se não existir
-    if not CSV_FILE.exists():
-        with open(CSV_FILE, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                "timestamp",
-                "nome",
-                "whatsapp",
-                "email",
-                "tipo_interesse",
-                "orcamento",
-                "postcode",
-                "detalhes_adicionais",
-                "email_valido",
-                "postcode_valido"
-            ])
+    # Séries de latência de todas as rotas alocadas antes do tráfego
+    for route in app.routes:
+        HTTP_LATENCY.add_series((route.path,))
+    with startup_timer.phase("lifespan"):
+        with startup_timer.phase("lifespan.stores"), startup_lock(LEADS_DB_FILE.with_name(LEADS_DB_FILE.name + ".lock")):
+            lead_store.open()
+            if shared_state is not None:
+                shared_state.open()
+            # Migrações e backfills só fazem trabalho na primeira vez (ou quando a base muda)
+            migrate_csv_to_store(lead_store, CSV_FILE)
+            index_lead_areas(lead_store, area_index)
+            rollup_leads(lead_store)
+            notification_queue.start()
+
+        # Páginas renderizadas e assets comprimidos uma vez por worker
+        with startup_timer.phase("lifespan.frontend"):
+            frontend_assets.load(page_sources())
+        # Import do h2 e contexto TLS (certificados): a maior parte do tempo do lifespan
+        with startup_timer.phase("lifespan.gemini_pool"):
+            gemini_pool.start()
+        lead_writer.start()
+        lead_broadcaster.start()
+        close_streams_on_signal()
+    startup_timer.mark("started")
+    # Conexão com o Gemini, cache do prompt e índice de duplicados sem atrasar a inicialização
+    warm_up.start()
+    logger.info("Worker started", extra={
+        "pid": os.getpid(),
+        "workers": WEB_WORKERS,
+        "state": STATE_CONFIG["backend"],
+        **startup_timer.stats(),
+    })
     yield
+    # O uvicorn já parou de aceitar conexões e esperou as requisições em curso
+    # (--timeout-graceful-shutdown); aqui só sobra gravar e liberar o que ficou
+    started = time.perf_counter()
+    queued = lead_writer.stats()["queued"]
+    await warm_up.stop()
+    await lead_broadcaster.stop()
+    await lead_writer.stop()
+    await notification_queue.stop()
+    await system_prompt_cache.delete()
+    await gemini_pool.aclose()
+    lead_store.close()
+    if shared_state is not None:
+        shared_state.close()
+    logger.info("Worker drained", extra={
+        "pid": os.getpid(),
+        "leads_flushed": queued,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
 
 
 app = FastAPI(
@@ -152,7 +3297,94 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# CORS para permitir requisições do frontend
+# Rotas que geram chamadas ao Gemini
+CHAT_PATHS = ("/api/chat", "/api/chat/stream")
+
+
+def client_ip(request: Request) -> str:
+    """IP do cliente; as entradas à esquerda do X-Forwarded-For vêm do próprio cliente e não valem"""
+    hops = CHAT_LIMIT_CONFIG["trusted_proxy_hops"]
+    if hops > 0:
+        forwarded = [entry.strip() for entry in request.headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+        if forwarded:
+            return forwarded[-min(hops, len(forwarded))]
+    return request.client.host if request.client else "unknown"
+
+
+class ChatBodyLimit:
+    """Limite de tamanho do corpo do chat aplicado durante a leitura.
+
+    O Content-Length é conferido antes (middleware abaixo), mas uma requisição
+    chunked não o envia: aqui os bytes são contados à medida que chegam.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in CHAT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    rejected = True
+                    chat_limiter.oversized += 1
+                    await JSONResponse(status_code=413, content={"detail": "request_too_large"})(scope, receive, send)
+                    # O app vê a desconexão e para de ler o corpo
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            # Depois do 413 a resposta do app é descartada
+            if not rejected:
+                await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+
+def too_many_requests(detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+    )
+
+
+@app.middleware("http")
+async def chat_rate_limit(request: Request, call_next):
+    """Descarta abusos do chat antes de ler o JSON e de gastar tokens do Gemini"""
+    if request.method != "POST" or request.url.path not in CHAT_PATHS:
+        return await call_next(request)
+
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        content_length = 0
+    if content_length > CHAT_LIMIT_CONFIG["max_body_bytes"]:
+        chat_limiter.oversized += 1
+        return JSONResponse(status_code=413, content={"detail": "request_too_large"})
+
+    retry_after = await chat_limiter.check_ip(client_ip(request))
+    if retry_after:
+        return too_many_requests("rate_limited", retry_after)
+    return await call_next(request)
+
+
+app.add_middleware(ChatBodyLimit, max_bytes=CHAT_LIMIT_CONFIG["max_body_bytes"])
+
+# CORS para permitir requisições do frontend (registrado por último para
+# envolver também as respostas 429 do rate limit)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -161,6 +3393,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """ID de correlação da requisição nos logs e sorteio da amostragem de DEBUG"""
+    request_id = request.headers.get("x-request-id") or secrets.token_hex(8)
+    request_id_var.set(request_id[:64])
+    debug_sampled_var.set(random.random() < LOG_CONFIG["debug_sample_rate"])
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id[:64]
+    return response
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Contagem e latência por rota.
+
+    Registrado por último, é o middleware mais externo: envolve o ChatBodyLimit e o
+    rate limit, então conta também os 413 e 429 que eles respondem.
+    """
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    if route is not None:
+        path = route.path
+    elif request.url.path in CHAT_PATHS:
+        path = request.url.path
+    else:
+        path = "unmatched"
+    HTTP_LATENCY.observe(time.perf_counter() - started, path)
+    HTTP_REQUESTS.inc(path, request.method, str(response.status_code))
+    startup_timer.mark("first_response")
+    return response
+
+
 # Sistema de prompts para o agente
 SYSTEM_PROMPT = """You are a professional and elegant virtual estate agent called Sophie, specialising in the London property market.
 You work for PropertyBot, a premium AI-powered estate agency.
@@ -195,11 +3461,7 @@ CONVERSATION STRATEGY:
 5. When you have ALL 5 pieces of information, confirm the details
 
 LONDON AREAS YOU KNOW WELL:
-- Central: Mayfair, Kensington, Chelsea, Westminster, Knightsbridge
-- North: Hampstead, Islington, Camden
-- South: Wimbledon, Richmond, Greenwich
-- East: Canary Wharf, Shoreditch, Stratford
-- West: Notting Hill, Chiswick, Ealing
+{LONDON_AREAS}
 
 SPECIAL RESPONSE FORMAT:
 When you have collected ALL 5 mandatory pieces of information (name, mobile, email, budget, postcode),
@@ -217,204 +3479,1366 @@ include at the END of your response a JSON block in the following format:
 }
 [/LEAD_DATA]
 
-IMPORTANT:
-- Be patient and don't ask for all information at once
-- Ask natural questions throughout the conversation
-- Demonstrate knowledge of London neighbourhoods
-- Use £ for monetary values
-- London postcodes follow the format: SW1A 1AA, E14 5AB, W1K 7AA, etc.
-- Validate the email appears valid before including in JSON
-- Validate the postcode follows UK format
-"""
+IMPORTANT:
+- Be patient and don't ask for all information at once
+- Ask natural questions throughout the conversation
+- Demonstrate knowledge of London neighbourhoods
+- Use £ for monetary values
+- London postcodes follow the format: SW1A 1AA, E14 5AB, W1K 7AA, etc.
+- Validate the email appears valid before including in JSON
+- Validate the postcode follows UK format
+""".replace("{LONDON_AREAS}", area_index.prompt_section())
+
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "maxOutputTokens": 1024
+}
+
+
+class SystemPromptCache:
+    """Mantém um cachedContent do Gemini com o SYSTEM_PROMPT e o renova antes de expirar"""
+
+    def __init__(self, config: dict, shared: Optional[SharedStateDB] = None):
+        self.config = config
+        # Com vários workers o cachedContent é criado por um e reaproveitado pelos outros
+        self.shared = shared
+        self.name: Optional[str] = None
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+        self.creations = 0
+        self.adopted = 0
+        self.failures = 0
+        self._too_small: Optional[bool] = None
+        self._failing = False
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def usable(self) -> bool:
+        """Ativado e com um prompt grande o bastante; abaixo do mínimo o aviso sai uma única vez"""
+        if not self.config["enabled"]:
+            return False
+        if self._too_small is None:
+            # Mesma estimativa do orçamento do histórico (~4 caracteres por token)
+            tokens = len(SYSTEM_PROMPT) // 4
+            self._too_small = tokens < self.config["min_tokens"]
+            if self._too_small:
+                logger.warning("System prompt below the context cache minimum, using inline instructions", extra={
+                    "estimated_tokens": tokens,
+                    "min_tokens": self.config["min_tokens"],
+                })
+        return not self._too_small
+
+    async def get_name(self) -> Optional[str]:
+        """Nome do cachedContent válido, ou None para usar instruções inline"""
+        if not self.usable():
+            return None
+
+        now = time.monotonic()
+        if self.name and now < self.expires_at:
+            if now >= self.expires_at - self.config["refresh_margin"]:
+                # Renova em segundo plano enquanto o atual ainda vale
+                if self._refresh_task is None or self._refresh_task.done():
+                    self._refresh_task = asyncio.create_task(self.refresh())
+            return self.name
+
+        if now < self.retry_at:
+            return None
+        return await self.refresh()
+
+    async def refresh(self) -> Optional[str]:
+        """Cria um novo cachedContent (uma criação por vez)"""
+        async with self._lock:
+            now = time.monotonic()
+            if self.name and now < self.expires_at - self.config["refresh_margin"]:
+                return self.name
+            if now < self.retry_at:
+                return self.name if now < self.expires_at else None
+            if self.shared is not None and await self._adopt_shared(now):
+                return self.name
+            if self.shared is not None and not await self._claim_creation():
+                # Outro worker está criando: instruções inline até o dele aparecer
+                self.retry_at = now + self.SHARED_RECHECK_SECONDS
+                return self.name if now < self.expires_at else None
+
+            try:
+                return await self._create(now)
+            finally:
+                if self.shared is not None:
+                    await self._release_creation()
+
+    async def _create(self, now: float) -> Optional[str]:
+        """Cria o cachedContent no Gemini (chamado com o lock do processo)"""
+        ttl = self.config["ttl_seconds"]
+        payload = {
+            "model": f"models/{GEMINI_MODEL}",
+            "systemInstruction": {"parts": [{"text": SYSTEM_PROMPT}]},
+            "ttl": f"{ttl}s",
+        }
+        try:
+            response = await gemini_pool.post(GEMINI_CACHE_URL, json=payload, params={"key": GOOGLE_API_KEY})
+            if response.status_code != 200:
+                raise RuntimeError(f"{response.status_code} - {response.text}")
+            name = response.json()["name"]
+        except Exception as e:
+            self.failures += 1
+            self.retry_at = now + self.config["retry_after"]
+            # Só a primeira falha de uma sequência vira aviso; as novas tentativas ficam no DEBUG
+            log = logger.debug if self._failing else logger.warning
+            log("Context cache unavailable, using inline system prompt", extra={"error": str(e)})
+            self._failing = True
+            return self.name if now < self.expires_at else None
+
+        self._failing = False
+        self.name = name
+        self.expires_at = now + ttl
+        self.creations += 1
+        if self.shared is not None:
+            await self._publish_shared(name, time.time() + ttl)
+        return name
+
+    @staticmethod
+    def _shared_key() -> str:
+        # Muda junto com o modelo e o prompt: workers de versões diferentes não se misturam
+        digest = hashlib.sha256(f"{GEMINI_MODEL}\n{SYSTEM_PROMPT}".encode()).hexdigest()[:16]
+        return f"system_prompt_cache:{digest}"
+
+    async def _adopt_shared(self, now: float) -> bool:
+        """Usa o cachedContent criado por outro worker se ainda estiver longe de vencer"""
+        try:
+            found = await asyncio.to_thread(self.shared.get_value, self._shared_key())
+        except sqlite3.Error:
+            return False
+        if found is None:
+            return False
+        name, expires_wall = found
+        remaining = expires_wall - time.time()
+        if remaining <= self.config["refresh_margin"]:
+            return False
+        self.name = name
+        self.expires_at = now + remaining
+        self.adopted += 1
+        return True
+
+    # Tempo máximo que um worker segura a criação; os outros conferem de novo a cada poucos segundos
+    CREATION_CLAIM_SECONDS = 30.0
+    SHARED_RECHECK_SECONDS = 2.0
+
+    async def _claim_creation(self) -> bool:
+        try:
+            return await asyncio.to_thread(
+                self.shared.claim_value, self._shared_key() + ":creating",
+                WORKER_ID, time.time() + self.CREATION_CLAIM_SECONDS,
+            )
+        except sqlite3.Error:
+            # Sem como coordenar: cria assim mesmo (no pior caso, um cache a mais)
+            return True
+
+    async def _release_creation(self):
+        try:
+            await asyncio.to_thread(self.shared.delete_value, self._shared_key() + ":creating", WORKER_ID)
+        except sqlite3.Error:
+            pass
+
+    async def _publish_shared(self, name: str, expires_wall: float):
+        try:
+            await asyncio.to_thread(self.shared.set_value, self._shared_key(), name, expires_wall)
+        except sqlite3.Error as e:
+            logger.warning("Could not share the context cache name", extra={"error": str(e)})
+
+    async def invalidate(self):
+        """Descarta o cache atual (ex.: removido no servidor)"""
+        name = self.name
+        # Limpa antes de esperar a thread: as requisições seguintes já usam instruções inline
+        self.name = None
+        self.expires_at = 0.0
+        if self.shared is not None and name:
+            try:
+                await asyncio.to_thread(self.shared.delete_value, self._shared_key(), name)
+            except sqlite3.Error:
+                pass
+
+    async def delete(self):
+        """Remove o cachedContent no encerramento (melhor esforço)"""
+        if not self.name:
+            return
+        if self.shared is not None:
+            # Outros workers ainda podem estar usando; o TTL remove no Gemini
+            self.name = None
+            self.expires_at = 0.0
+            return
+        try:
+            await gemini_pool.client.delete(f"{GEMINI_API_BASE}/{self.name}", params={"key": GOOGLE_API_KEY})
+        except Exception:
+            pass
+        await self.invalidate()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.config["enabled"],
+            "prompt_too_small": bool(self._too_small),
+            "active": bool(self.name) and time.monotonic() < self.expires_at,
+            "creations": self.creations,
+            "adopted": self.adopted,
+            "failures": self.failures,
+        }
+
+
+system_prompt_cache = SystemPromptCache(GEMINI_CONTEXT_CACHE_CONFIG, shared_state)
+
+
+def build_gemini_payload(messages: list, cached_content: Optional[str] = None) -> dict:
+    """Monta o corpo da requisição para o Gemini"""
+    if cached_content:
+        # O SYSTEM_PROMPT já está no cachedContent
+        return {
+            "contents": messages,
+            "cachedContent": cached_content,
+            "generationConfig": GENERATION_CONFIG
+        }
+    return {
+        "contents": messages,
+        "systemInstruction": {
+            "parts": [{"text": SYSTEM_PROMPT}]
+        },
+        "generationConfig": GENERATION_CONFIG
+    }
+
+
+def cache_rejected(response: httpx.Response, payload: dict) -> bool:
+    """O Gemini recusou o cachedContent (expirado ou removido)"""
+    return "cachedContent" in payload and response.status_code in (400, 403, 404)
+
+
+def cacheable_response(text: str) -> bool:
+    """Respostas com bloco de lead nunca vão para o cache"""
+    return "[LEAD_DATA]" not in text
+
+
+def record_usage(usage: Optional[dict]):
+    """Contabiliza os tokens informados no usageMetadata do Gemini"""
+    if not usage:
+        return
+    GEMINI_TOKENS.inc("input", amount=usage.get("promptTokenCount", 0))
+    GEMINI_TOKENS.inc("output", amount=usage.get("candidatesTokenCount", 0))
+    GEMINI_TOKENS.inc("cached", amount=usage.get("cachedContentTokenCount", 0))
+
+
+def request_key(messages: list) -> str:
+    """Identifica requisições idênticas para o agrupamento no agendador"""
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+async def generate_content(messages: list) -> str:
+    """Uma chamada generateContent feita pelo agendador"""
+    payload = build_gemini_payload(messages, await system_prompt_cache.get_name())
+
+    response = await gemini_scheduler.run(partial(gemini_pool.post, GEMINI_API_URL, json=payload))
+
+    if cache_rejected(response, payload):
+        await system_prompt_cache.invalidate()
+        payload = build_gemini_payload(messages)
+        response = await gemini_scheduler.run(partial(gemini_pool.post, GEMINI_API_URL, json=payload))
+
+    if response.status_code != 200:
+        logger.error("Gemini API error", extra={"status": response.status_code, "body": response.text[:500]})
+        raise HTTPException(status_code=500, detail=f"Gemini API error: {response.status_code}")
+
+    data = response.json()
+    record_usage(data.get("usageMetadata"))
+    return data["candidates"][0]["content"]["parts"][0]["text"]
+
+
+async def call_gemini_api(messages: list) -> str:
+    """Chama a API do Gemini via REST"""
+    cache_key = response_cache.key_for(messages, GENERATION_CONFIG)
+    if cache_key:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    text = await gemini_scheduler.coalesce(request_key(messages), partial(generate_content, messages))
+
+    if cache_key and cacheable_response(text):
+        await response_cache.put(cache_key, text)
+    return text
+
+
+async def open_gemini_stream(messages: list) -> httpx.Response:
+    """Abre a resposta em streaming (SSE) do Gemini"""
+    payload = build_gemini_payload(messages, await system_prompt_cache.get_name())
+
+    response = await gemini_scheduler.run(
+        partial(gemini_pool.open_stream, GEMINI_STREAM_URL, json=payload),
+        discard=gemini_pool.close_stream,
+        kind="stream",
+    )
+
+    if cache_rejected(response, payload):
+        await gemini_pool.close_stream(response)
+        await system_prompt_cache.invalidate()
+        payload = build_gemini_payload(messages)
+        response = await gemini_scheduler.run(
+            partial(gemini_pool.open_stream, GEMINI_STREAM_URL, json=payload),
+            discard=gemini_pool.close_stream,
+            kind="stream",
+        )
+
+    if response.status_code != 200:
+        body = await response.aread()
+        await gemini_pool.close_stream(response)
+        logger.error("Gemini API error", extra={"status": response.status_code, "body": body.decode(errors="replace")[:500]})
+        raise HTTPException(status_code=500, detail=f"Gemini API error: {response.status_code}")
+
+    return response
+
+
+async def iter_gemini_stream(response: httpx.Response) -> AsyncIterator[str]:
+    """Produz os trechos de texto de uma resposta streamGenerateContent"""
+    usage = None
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = json.loads(line[len("data:"):])
+        # O último trecho traz o usageMetadata acumulado
+        usage = data.get("usageMetadata", usage)
+        for candidate in data.get("candidates", [])[:1]:
+            for part in candidate.get("content", {}).get("parts", []):
+                text = part.get("text")
+                if text:
+                    yield text
+    record_usage(usage)
+
+
+async def iter_cached_response(text: str) -> AsyncIterator[str]:
+    """Resposta do cache no mesmo formato do streaming"""
+    yield text
+
+
+class ChatMessage(BaseModel):
+    """Modelo para mensagens do chat"""
+    message: str
+    session_id: Optional[str] = None
+    conversation_history: list = []
+
+
+class ChatResponse(BaseModel):
+    """Modelo para resposta do chat"""
+    response: str
+    session_id: Optional[str] = None
+    lead_captured: bool = False
+    lead_data: Optional[dict] = None
+    validation_errors: Optional[list] = None
+    retry_after: Optional[float] = None
+
+
+class LeadData(BaseModel):
+    """Modelo para dados do lead"""
+    nome: str
+    email: str
+    tipo_interesse: str
+    orcamento: str
+    postcode: str
+    detalhes_adicionais: str = ""
+
+
+def extract_lead_data(response_text: str) -> Optional[dict]:
+    """Extrai dados do lead da resposta"""
+    try:
+        if "[LEAD_DATA]" in response_text and "[/LEAD_DATA]" in response_text:
+            start = response_text.index("[LEAD_DATA]") + len("[LEAD_DATA]")
+            end = response_text.index("[/LEAD_DATA]")
+            json_str = response_text[start:end].strip()
+            return json.loads(json_str)
+    except (json.JSONDecodeError, ValueError):
+        pass
+    return None
+
+
+class LeadBlockFilter:
+    """Separa incrementalmente o bloco [LEAD_DATA] do texto visível no streaming"""
+
+    OPEN = "[LEAD_DATA]"
+    CLOSE = "[/LEAD_DATA]"
+
+    def __init__(self):
+        self._pending = ""
+        self._block: Optional[str] = None
+        self.closed = False
+
+    def feed(self, chunk: str) -> str:
+        """Recebe um trecho do modelo e retorna a parte que pode ser exibida"""
+        if self._block is not None:
+            # Dentro do bloco: só o JSON é acumulado, nada é exibido
+            if not self.closed:
+                self._block += chunk
+                self.closed = self.CLOSE in self._block
+            return ""
+
+        text = self._pending + chunk
+        self._pending = ""
+
+        index = text.find(self.OPEN)
+        if index >= 0:
+            self._block = text[index + len(self.OPEN):]
+            self.closed = self.CLOSE in self._block
+            return text[:index]
+
+        # Segura um possível início de marcador partido entre trechos
+        for size in range(min(len(self.OPEN) - 1, len(text)), 0, -1):
+            if text.endswith(self.OPEN[:size]):
+                self._pending = text[-size:]
+                return text[:-size]
+        return text
+
+    def in_block(self) -> bool:
+        """Indica se um bloco [LEAD_DATA] foi aberto"""
+        return self._block is not None
+
+    def finish(self) -> str:
+        """Libera o texto retido ao final do stream"""
+        pending, self._pending = self._pending, ""
+        return pending
+
+    def lead_block(self) -> Optional[str]:
+        """Bloco completo (com marcadores) quando já foi fechado"""
+        if self._block is None or not self.closed:
+            return None
+        return self.OPEN + self._block[:self._block.index(self.CLOSE)] + self.CLOSE
+
+
+def clean_response(response_text: str) -> str:
+    """Remove o bloco JSON da resposta para exibição"""
+    if "[LEAD_DATA]" in response_text:
+        return response_text[:response_text.index("[LEAD_DATA]")].strip()
+    return response_text
+
+
+def validate_lead_data(lead_data: dict) -> tuple[bool, list]:
+    """Validate lead data and return errors"""
+    errors = check_lead_fields(lead_data)["errors"]
+    return len(errors) == 0, errors
+
+
+def lead_row(lead_data: dict, checked: dict) -> dict:
+    """Monta a linha do lead no formato do store, com os campos já validados"""
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "nome": lead_data.get("nome", ""),
+        "whatsapp": lead_data.get("whatsapp", ""),
+        "email": checked["email"],
+        "tipo_interesse": str(lead_data.get("tipo_interesse", "")).strip().lower(),
+        "orcamento": lead_data.get("orcamento", ""),
+        "postcode": checked["postcode"],
+        "detalhes_adicionais": lead_data.get("detalhes_adicionais", ""),
+        "email_valido": "Yes" if checked["email_valid"] else "No",
+        "postcode_valido": "Yes" if checked["postcode_valid"] else "No",
+        # Borough e zona vêm do índice local, sem outra chamada ao modelo
+        **area_index.lead_fields(checked["postcode"]),
+    }
+
+
+def history_to_contents(conversation_history: list) -> list:
+    """Converte o histórico enviado pelo cliente para o formato do Gemini"""
+    contents = []
+    for msg in conversation_history:
+        if not isinstance(msg, dict) or not isinstance(msg.get("role"), str) or not isinstance(msg.get("content"), str):
+            raise HTTPException(status_code=422, detail="invalid_conversation_history")
+        role = "user" if msg["role"] == "user" else "model"
+        contents.append({
+            "role": role,
+            "parts": [{"text": msg["content"]}]
+        })
+    return contents
+
+
+async def check_chat_limits(chat_message: ChatMessage):
+    """Tamanho da mensagem/histórico e limite por sessão, antes de montar o prompt"""
+    history = chat_message.conversation_history
+    if (
+        len(chat_message.message) > CHAT_LIMIT_CONFIG["max_message_chars"]
+        or len(history) > CHAT_LIMIT_CONFIG["max_history_messages"]
+        or sum(len(str(msg.get("content", ""))) for msg in history if isinstance(msg, dict)) > CHAT_LIMIT_CONFIG["max_history_chars"]
+    ):
+        chat_limiter.oversized += 1
+        raise HTTPException(status_code=413, detail="message_too_large")
+
+    if chat_message.session_id:
+        retry_after = await chat_limiter.check_session(chat_message.session_id)
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="rate_limited",
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+            )
+
+
+def chat_turn(session: dict, user_message: dict) -> tuple[dict, list]:
+    """Cópia da sessão para o turno atual e o histórico já compactado
+
+    Os campos extraídos também vão para a cópia: só passam a valer quando o turno
+    é salvo, e uma resposta de "tente novamente" não conta a mensagem duas vezes.
+    """
+    turn = dict(session, extracted=dict(session.get("extracted", {})))
+    extract_user_fields(turn, [user_message])
+    contents = compact_history(turn, session["contents"] + [user_message])
+    return turn, contents
+
+
+async def load_session(chat_message: ChatMessage) -> tuple[str, dict]:
+    """Carrega a sessão do cliente ou cria uma nova a partir do histórico enviado
+
+    Sem session_id (formato antigo, só com conversation_history) cada requisição cria
+    uma sessão nova; o cliente precisa reenviar o session_id da resposta para
+    reaproveitá-la. As que não voltam somem pelo TTL ou pelo limite de sessões.
+    """
+    if chat_message.session_id:
+        session = await session_store.get(chat_message.session_id)
+        if session is None:
+            # Sessão expirada: o cliente deve reenviar o histórico completo
+            raise HTTPException(status_code=409, detail="session_expired")
+        return chat_message.session_id, session
+
+    session_id = secrets.token_urlsafe(16)
+    session = {"contents": history_to_contents(chat_message.conversation_history)}
+    extract_user_fields(session, session["contents"])
+    return session_id, session
+
+
+# Resposta quando o Gemini não atende dentro do prazo da fila
+UPSTREAM_BUSY_REPLY = "Sorry, I'm receiving a lot of messages right now. Could you send that again in a few seconds?"
+
+
+def busy_response(session_id: str, error: UpstreamUnavailable) -> ChatResponse:
+    """Resposta amigável de "tente novamente"; o turno não entra no histórico"""
+    return ChatResponse(
+        response=UPSTREAM_BUSY_REPLY,
+        session_id=session_id,
+        retry_after=round(max(error.retry_after, 1.0), 1),
+    )
+
+
+async def process_lead(lead_data: dict) -> Optional[list]:
+    """Valida, salva e notifica um lead capturado; retorna os erros de validação"""
+    validation_errors = None
+
+    # Validar e normalizar os dados numa única passada
+    checked = check_lead_fields(lead_data)
+    if not checked["email_valid"]:
+        LEAD_VALIDATION_FAILURES.inc("email")
+    if not checked["postcode_valid"]:
+        LEAD_VALIDATION_FAILURES.inc("postcode")
+
+    if checked["errors"]:
+        validation_errors = checked["errors"]
+        logger.warning("Lead saved with validation errors", extra={"errors": validation_errors})
+
+    # Salvar lead (mesmo com erros de validação, para não perder dados).
+    # A gravação e a notificação acontecem no writer, sem esperar o disco.
+    await lead_writer.submit(lead_row(lead_data, checked))
+
+    return validation_errors
+
+
+class LeadFieldExtractor:
+    """Extração determinística e incremental dos campos de lead nas mensagens do cliente"""
+
+    # Campos que bastam para capturar o lead sem depender do bloco [LEAD_DATA]
+    REQUIRED = ("whatsapp", "email", "postcode", "orcamento", "tipo_interesse")
+
+    NAME_RE = re.compile(r"(?i:\b(?:my name is|name's|i am|i'm|this is|call me)\s+)([A-Z][a-zA-Z'-]+(?:\s[A-Z][a-zA-Z'-]+)*)")
+    MOBILE_RE = re.compile(UK_MOBILE_PATTERN)
+    BUDGET_RE = re.compile(r"£\s?\d[\d,.]*\s?(?:k|m|million|thousand|pcm|pw)?\b", re.IGNORECASE)
+    POSTCODE_RE = re.compile(rf"\b{UK_POSTCODE_PATTERN}\b", re.IGNORECASE)
+    INTENT_RE = {
+        "buy": re.compile(r"\b(?:buy|buying|purchas(?:e|ing)|first[- ]time buyer)\b", re.IGNORECASE),
+        "rent": re.compile(r"\b(?:rent|renting|rental|to let|lease|tenancy)\b", re.IGNORECASE),
+        "sell": re.compile(r"\b(?:sell|selling|valuation|value my)\b", re.IGNORECASE),
+    }
+    # Palavras que seguem "I'm"/"this is" sem serem nomes
+    NOT_NAMES = {"Looking", "Interested", "Moving", "Just", "Not", "Trying", "Based", "Planning", "Also", "Still", "Ready", "Thinking", "Hoping", "Currently", "The", "A", "An", "It", "My"}
+
+    def __init__(self):
+        self.turns = 0
+        self.turns_without_fields = 0
+        self.local_captures = 0
+        self.fields_filled = 0
+        self.malformed_blocks = 0
+
+    def scan(self, text: str) -> dict:
+        """Campos encontrados numa única mensagem"""
+        found = {}
+        # Checagens baratas evitam rodar regex em mensagens sem candidatos
+        has_digits = any(ch.isdigit() for ch in text)
+
+        match = self.NAME_RE.search(text)
+        if match and match.group(1).split()[0] not in self.NOT_NAMES:
+            found["nome"] = match.group(1)
+
+        if "@" in text:
+            match = EMAIL_RE.search(text)
+            if match and validate_email(match.group(0)):
+                found["email"] = match.group(0)
+
+        if has_digits:
+            match = self.MOBILE_RE.search(text)
+            if match:
+                digits = re.sub(r"\s", "", match.group(0))
+                found["whatsapp"] = "0" + digits[3:] if digits.startswith("+44") else digits
+
+            for match in self.POSTCODE_RE.finditer(text):
+                postcode = normalise_postcode(match.group(0))
+                if postcode:
+                    found["postcode"] = postcode
+                    break
+
+            if "£" in text:
+                match = self.BUDGET_RE.search(text)
+                if match:
+                    found["orcamento"] = match.group(0).strip()
+
+        # A intenção citada por último prevalece ("not buying, I want to rent")
+        latest = -1
+        for intent, pattern in self.INTENT_RE.items():
+            for match in pattern.finditer(text):
+                if match.start() > latest:
+                    latest = match.start()
+                    found["tipo_interesse"] = intent
+        return found
+
+    def update(self, state: dict, text: str) -> list:
+        """Acumula no estado da conversa os campos de uma nova mensagem; retorna os campos vistos"""
+        found = self.scan(text)
+        state.update(found)
+        self.turns += 1
+        if not found:
+            self.turns_without_fields += 1
+        return list(found)
+
+    def is_complete(self, state: dict) -> bool:
+        return all(state.get(field) for field in self.REQUIRED)
+
+    def fill_missing(self, lead_data: dict, state: dict):
+        """Completa com a extração local os campos que o modelo omitiu"""
+        for field, value in state.items():
+            if not lead_data.get(field):
+                lead_data[field] = value
+                self.fields_filled += 1
 
-async def call_gemini_api(messages: list) -> str:
-    """Chama a API do Gemini via REST"""
-    payload = {
-        "contents": messages,
-        "systemInstruction": {
-            "parts": [{"text": SYSTEM_PROMPT}]
-        },
-        "generationConfig": {
-            "temperature": 0.7,
-            "maxOutputTokens": 1024
+    def to_lead(self, state: dict) -> dict:
+        lead = {field: state.get(field, "") for field in ("nome",) + self.REQUIRED}
+        lead["detalhes_adicionais"] = "Captured from the conversation by local extraction"
+        return lead
+
+    def stats(self) -> dict:
+        return {
+            "turns": self.turns,
+            "turns_without_fields": self.turns_without_fields,
+            "local_captures": self.local_captures,
+            "fields_filled": self.fields_filled,
+            "malformed_blocks": self.malformed_blocks,
         }
-    }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            GEMINI_API_URL,
-            json=payload,
-            headers={"Content-Type": "application/json"}
-        )
 
-        if response.status_code != 200:
-            print(f"[ERROR] Gemini API error: {response.status_code} - {response.text}")
-            raise HTTPException(status_code=500, detail=f"Gemini API error: {response.status_code}")
+lead_extractor = LeadFieldExtractor()
 
-        data = response.json()
-        return data["candidates"][0]["content"]["parts"][0]["text"]
 
+def extract_user_fields(session: dict, messages: list):
+    """Passa as mensagens do cliente pelo extrator, acumulando no estado da sessão"""
+    state = session.setdefault("extracted", {})
+    for message in messages:
+        if message["role"] == "user":
+            lead_extractor.update(state, message_text(message))
 
-class ChatMessage(BaseModel):
-    """Modelo para mensagens do chat"""
-    message: str
-    conversation_history: list = []
 
+def resolve_lead(session: dict, model_lead: Optional[dict], block_opened: bool) -> Optional[dict]:
+    """Decide o lead do turno: o bloco do modelo completado localmente, ou a captura local"""
+    state = session.get("extracted", {})
+    if model_lead:
+        lead_extractor.fill_missing(model_lead, state)
+        session["lead_captured"] = True
+        LEADS_CAPTURED.inc("model")
+        return model_lead
 
-class ChatResponse(BaseModel):
-    """Modelo para resposta do chat"""
-    response: str
-    lead_captured: bool = False
-    lead_data: Optional[dict] = None
-    validation_errors: Optional[list] = None
+    if block_opened:
+        # Bloco [LEAD_DATA] com JSON inválido ou truncado: a extração local cobre
+        lead_extractor.malformed_blocks += 1
+        logger.warning("Invalid [LEAD_DATA] block in model response")
 
+    if not session.get("lead_captured") and lead_extractor.is_complete(state):
+        session["lead_captured"] = True
+        lead_extractor.local_captures += 1
+        LEADS_CAPTURED.inc("local")
+        return lead_extractor.to_lead(state)
+    return None
 
-class LeadData(BaseModel):
-    """Modelo para dados do lead"""
-    nome: str
-    email: str
-    tipo_interesse: str
-    orcamento: str
-    postcode: str
-    detalhes_adicionais: str = ""
 
+# Rótulos dos campos preservados no resumo quando turnos antigos saem do histórico
+PINNED_LEAD_LABELS = {
+    "nome": "name",
+    "whatsapp": "mobile",
+    "email": "email",
+    "tipo_interesse": "interest",
+    "orcamento": "budget",
+    "postcode": "postcode",
+}
 
-def extract_lead_data(response_text: str) -> Optional[dict]:
-    """Extrai dados do lead da resposta"""
-    try:
-        if "[LEAD_DATA]" in response_text and "[/LEAD_DATA]" in response_text:
-            start = response_text.index("[LEAD_DATA]") + len("[LEAD_DATA]")
-            end = response_text.index("[/LEAD_DATA]")
-            json_str = response_text[start:end].strip()
-            return json.loads(json_str)
-    except (json.JSONDecodeError, ValueError):
-        pass
-    return None
 
+def message_text(message: dict) -> str:
+    return "".join(part.get("text", "") for part in message.get("parts", []))
 
-def clean_response(response_text: str) -> str:
-    """Remove o bloco JSON da resposta para exibição"""
-    if "[LEAD_DATA]" in response_text:
-        return response_text[:response_text.index("[LEAD_DATA]")].strip()
-    return response_text
 
+def estimate_tokens(contents: list) -> int:
+    """Estimativa barata de tokens (~4 caracteres por token)"""
+    return sum(len(message_text(message)) // 4 + 4 for message in contents)
 
-def validate_lead_data(lead_data: dict) -> tuple[bool, list]:
-    """Validate lead data and return errors"""
-    errors = []
 
-    email = lead_data.get("email", "")
-    if not validate_email(email):
-        errors.append(f"Invalid email: {email}")
+def condense(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
 
-    postcode = lead_data.get("postcode", "")
-    if not validate_uk_postcode(postcode):
-        errors.append(f"Invalid postcode: {postcode} (expected format: SW1A 1AA)")
 
-    return len(errors) == 0, errors
+def summarise_turns(session: dict, messages: list):
+    """Acrescenta os turnos antigos ao resumo corrido da sessão (numa lista nova)"""
+    lines = list(session.get("summary", []))
+    for message in messages:
+        speaker = "Client" if message["role"] == "user" else "Sophie"
+        lines.append(f"- {speaker}: {condense(message_text(message), 160)}")
+
+    # O resumo também tem orçamento: as linhas mais antigas saem primeiro
+    budget_chars = HISTORY_CONFIG["summary_tokens"] * 4
+    while len(lines) > 1 and sum(len(line) + 1 for line in lines) > budget_chars:
+        lines.pop(0)
+    session["summary"] = lines
+
+
+def compact_history(session: dict, contents: list) -> list:
+    """Mantém os turnos recentes literais e move os antigos para o resumo da sessão.
+
+    Recebe a cópia do turno (ver chat_turn): o resumo só vale para a sessão gravada
+    quando o turno dá certo, senão um retry resumiria os mesmos turnos de novo.
+    """
+    if estimate_tokens(contents) <= HISTORY_CONFIG["token_budget"]:
+        return contents
 
+    last = len(contents) - 1
+    split = max(0, len(contents) - max(1, HISTORY_CONFIG["keep_messages"]))
+    # Os turnos mantidos sempre começam por uma mensagem do cliente
+    while split < last and contents[split]["role"] != "user":
+        split += 1
+    while split < last and estimate_tokens(contents[split:]) > HISTORY_CONFIG["token_budget"]:
+        split += 1
+        while split < last and contents[split]["role"] != "user":
+            split += 1
 
-def save_lead_to_csv(lead_data: dict, email_valid: bool, postcode_valid: bool):
-    """Salva os dados do lead no arquivo CSV"""
-    with open(CSV_FILE, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            datetime.now().isoformat(),
-            lead_data.get("nome", ""),
-            lead_data.get("whatsapp", ""),
-            lead_data.get("email", ""),
-            lead_data.get("tipo_interesse", ""),
-            lead_data.get("orcamento", ""),
-            lead_data.get("postcode", ""),
-            lead_data.get("detalhes_adicionais", ""),
-            "Yes" if email_valid else "No",
-            "Yes" if postcode_valid else "No"
-        ])
+    older = contents[:split]
+    if older:
+        summarise_turns(session, older)
+    return contents[split:]
+
+
+def with_area_facts(contents: list) -> list:
+    """Anexa ao turno atual os fatos das áreas citadas (índice local), sem gravar no histórico"""
+    if not contents or contents[-1]["role"] != "user":
+        return contents
+    facts = area_index.mentions(message_text(contents[-1]))
+    if not facts:
+        return contents
+    note = "[Area facts for reference]\n" + "\n".join(facts)
+    current = {"role": "user", "parts": contents[-1]["parts"] + [{"text": note}]}
+    return contents[:-1] + [current]
+
+
+def prompt_contents(session: dict, contents: list) -> list:
+    """Histórico enviado ao Gemini: resumo dos turnos antigos + turnos recentes"""
+    contents = with_area_facts(contents)
+    if not session.get("summary"):
+        return contents
+
+    text = "[Conversation summary]\nEarlier in this conversation:\n" + "\n".join(session["summary"])
+    # Os campos vêm da extração local, que já acompanhou todos os turnos
+    pinned = session.get("extracted")
+    if pinned:
+        details = "; ".join(f"{PINNED_LEAD_LABELS[field]}: {value}" for field, value in pinned.items())
+        text += f"\nDetails already provided by the client: {details}"
+
+    return [
+        {"role": "user", "parts": [{"text": text}]},
+        {"role": "model", "parts": [{"text": "Understood, I have the earlier context."}]},
+    ] + contents
 
 
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(chat_message: ChatMessage):
     """Endpoint principal do chat com o agente"""
     try:
-        # Construir histórico para o Gemini (formato REST API)
-        contents = []
+        await check_chat_limits(chat_message)
 
-        for msg in chat_message.conversation_history:
-            role = "user" if msg["role"] == "user" else "model"
-            contents.append({
-                "role": role,
-                "parts": [{"text": msg["content"]}]
-            })
+        # Histórico guardado no servidor; o cliente envia apenas a nova mensagem
+        session_id, session = await load_session(chat_message)
 
-        # Adicionar mensagem atual
-        contents.append({
-            "role": "user",
-            "parts": [{"text": chat_message.message}]
-        })
+        # Adicionar mensagem atual e limitar o histórico ao orçamento de tokens
+        user_message = {"role": "user", "parts": [{"text": chat_message.message}]}
+        turn, contents = chat_turn(session, user_message)
 
-        print(f"[DEBUG] Enviando mensagem para Gemini: {chat_message.message}")
-        print(f"[DEBUG] Histórico: {len(contents)} mensagens")
+        logger.debug("Sending message to Gemini", extra={
+            "message_chars": len(chat_message.message),
+            "history_messages": len(contents),
+        })
 
         # Chamar API REST do Gemini
-        response_text = await call_gemini_api(contents)
+        try:
+            response_text = await call_gemini_api(prompt_contents(turn, contents))
+        except UpstreamUnavailable as e:
+            logger.warning("Gemini unavailable, asking the client to retry", extra={"reason": e.reason})
+            await session_store.save(session_id, session)
+            return busy_response(session_id, e)
 
-        print(f"[DEBUG] Resposta recebida do Gemini")
+        logger.debug("Gemini response received", extra={"response_chars": len(response_text)})
 
-        # Verificar se há dados de lead na resposta
-        lead_data = extract_lead_data(response_text)
+        # Verificar se há dados de lead na resposta (ou já extraídos localmente)
+        lead_data = resolve_lead(turn, extract_lead_data(response_text), "[LEAD_DATA]" in response_text)
         lead_captured = False
         validation_errors = None
 
         if lead_data:
-            # Validar dados
-            email_valid = validate_email(lead_data.get("email", ""))
-            postcode_valid = validate_uk_postcode(lead_data.get("postcode", ""))
-
-            is_valid, errors = validate_lead_data(lead_data)
-
-            if not is_valid:
-                validation_errors = errors
-                print(f"[WARNING] Dados com validação: {errors}")
-
-            # Salvar lead no CSV (mesmo com erros de validação, para não perder dados)
-            save_lead_to_csv(lead_data, email_valid, postcode_valid)
+            validation_errors = await process_lead(lead_data)
             lead_captured = True
 
-            # Enviar notificação por email
-            send_email_notification(lead_data)
-
         # Limpar resposta para exibição
         clean_text = clean_response(response_text)
 
+        turn["contents"] = contents + [{
+            "role": "model",
+            "parts": [{"text": clean_text}]
+        }]
+        await session_store.save(session_id, turn)
+
         return ChatResponse(
             response=clean_text,
+            session_id=session_id,
             lead_captured=lead_captured,
             lead_data=lead_data,
             validation_errors=validation_errors
         )
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Chat request failed")
+        raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Formata um evento Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def busy_event_stream(session_id: str, error: UpstreamUnavailable) -> AsyncIterator[str]:
+    """Resposta "tente novamente" no formato do streaming"""
+    reply = busy_response(session_id, error)
+    yield sse_event("token", {"text": reply.response})
+    yield sse_event("done", reply.model_dump())
+
+
+async def chat_event_stream(
+    session_id: str,
+    session: dict,
+    contents: list,
+    chunks: AsyncIterator[str],
+    started: float,
+    upstream: Optional[httpx.Response] = None,
+    cache_key: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """Repassa os tokens do Gemini como SSE, retendo o bloco [LEAD_DATA]"""
+    lead_filter = LeadBlockFilter()
+    visible_parts = []
+    lead_data = None
+    validation_errors = None
+    lead_processed = False
+
+    async def capture_lead():
+        nonlocal lead_data, validation_errors, lead_processed
+        lead_processed = True
+        lead_block = lead_filter.lead_block()
+        lead_data = resolve_lead(session, extract_lead_data(lead_block) if lead_block else None, lead_filter.in_block())
+        if lead_data:
+            # Protegido do cancelamento: o cliente pode desconectar no meio da gravação
+            validation_errors = await asyncio.shield(process_lead(lead_data))
+
+    try:
+        async for chunk in chunks:
+            visible = lead_filter.feed(chunk)
+            if lead_filter.closed and not lead_processed:
+                # O bloco fechou: o lead é salvo já, sem esperar o fim do stream
+                await capture_lead()
+            if not visible:
+                continue
+            if not visible_parts:
+                CHAT_FIRST_TOKEN.observe(time.perf_counter() - started)
+                logger.debug("First token", extra={"ttft_ms": round((time.perf_counter() - started) * 1000)})
+            visible_parts.append(visible)
+            yield sse_event("token", {"text": visible})
+
+        tail = lead_filter.finish()
+        if tail:
+            visible_parts.append(tail)
+            yield sse_event("token", {"text": tail})
+    except Exception as e:
+        logger.error("Stream interrupted", extra={"error": str(e)})
+        yield sse_event("error", {"detail": "stream_interrupted"})
+        return
+    finally:
+        if upstream is not None:
+            await gemini_pool.close_stream(upstream)
+
+    # Sem bloco fechado: bloco truncado ou captura pela extração local
+    if not lead_processed:
+        await capture_lead()
+
+    clean_text = "".join(visible_parts).strip()
+    if cache_key and not lead_filter.in_block():
+        await response_cache.put(cache_key, clean_text)
+
+    session["contents"] = contents + [{
+        "role": "model",
+        "parts": [{"text": clean_text}]
+    }]
+    await session_store.save(session_id, session)
+
+    yield sse_event("done", {
+        "response": clean_text,
+        "session_id": session_id,
+        "lead_captured": bool(lead_data),
+        "lead_data": lead_data,
+        "validation_errors": validation_errors,
+    })
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(chat_message: ChatMessage):
+    """Chat em streaming: repassa o streamGenerateContent do Gemini como SSE"""
+    started = time.perf_counter()
+    try:
+        await check_chat_limits(chat_message)
+        session_id, session = await load_session(chat_message)
+
+        user_message = {"role": "user", "parts": [{"text": chat_message.message}]}
+        turn, contents = chat_turn(session, user_message)
+        prompt = prompt_contents(turn, contents)
+
+        cache_key = response_cache.key_for(prompt, GENERATION_CONFIG)
+        cached = await response_cache.get(cache_key) if cache_key else None
+
+        if cached is not None:
+            upstream = None
+            chunks = iter_cached_response(cached)
+            cache_key = None
+        else:
+            try:
+                upstream = await open_gemini_stream(prompt)
+            except UpstreamUnavailable as e:
+                logger.warning("Gemini unavailable, asking the client to retry", extra={"reason": e.reason})
+                await session_store.save(session_id, session)
+                return StreamingResponse(
+                    busy_event_stream(session_id, e),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                )
+            chunks = iter_gemini_stream(upstream)
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"[ERROR] Exception: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        # Mesmo tratamento do /api/chat: o erro antes do stream vira uma resposta JSON
+        logger.exception("Chat stream request failed")
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
 
+    return StreamingResponse(
+        chat_event_stream(session_id, turn, contents, chunks, started, upstream, cache_key),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def parse_date_bound(value: Optional[str], end: bool = False) -> Optional[str]:
+    """Converte uma data/hora ISO do filtro para comparação com o timestamp"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {value}")
+    if end and len(value) == 10:
+        # Data sem hora: inclui o dia inteiro
+        parsed += timedelta(days=1)
+    return parsed.isoformat()
+
+
+def interest_summary(counts: dict) -> dict:
+    """Contadores de compra/aluguel/venda para o painel"""
+    return {
+        "buy": sum(total for interest, total in counts.items() if "buy" in interest),
+        "rent": sum(total for interest, total in counts.items() if "rent" in interest),
+        "sell": sum(total for interest, total in counts.items() if "sell" in interest),
+        "total": sum(counts.values()),
+    }
+
+
+def lead_filters(
+    interest: Optional[str],
+    postcode_area: Optional[str],
+    date_from: Optional[str],
+    date_to: Optional[str],
+    valid: Optional[str],
+    borough: Optional[str] = None,
+    zone: Optional[int] = None,
+) -> dict:
+    """Normaliza os filtros de consulta de leads"""
+    if valid and valid not in ("yes", "no"):
+        raise HTTPException(status_code=400, detail="valid must be 'yes' or 'no'")
+    return {
+        "tipo_interesse": interest,
+        "postcode_area": postcode_area,
+        "borough": borough,
+        "zone": zone,
+        "date_from": parse_date_bound(date_from),
+        "date_to": parse_date_bound(date_to, end=True),
+        "valid": valid,
+    }
+
 
 @app.get("/api/leads")
-async def get_leads():
-    """Retorna todos os leads capturados"""
-    leads = []
-    if CSV_FILE.exists():
-        with open(CSV_FILE, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            leads = list(reader)
-    return {"leads": leads, "total": len(leads)}
+def get_leads(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[int] = Query(None, description="Retorna leads mais antigos que este id"),
+    since: Optional[int] = Query(None, description="Retorna apenas leads mais novos que este id"),
+    interest: Optional[str] = None,
+    postcode_area: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    valid: Optional[str] = None,
+    borough: Optional[str] = None,
+    zone: Optional[int] = Query(None, ge=1, le=9),
+):
+    """Retorna os leads capturados, paginados e filtrados (mais novos primeiro)"""
+    filters = lead_filters(interest, postcode_area, date_from, date_to, valid, borough, zone)
+
+    # Uma linha extra indica se há mais páginas
+    if since is not None:
+        leads = lead_store.query_leads(filters, limit + 1, after_id=since)
+        has_more = len(leads) > limit
+        leads = leads[:limit]
+        latest_id = leads[-1]["id"] if leads else since
+        leads.reverse()
+        next_cursor = None
+    else:
+        leads = lead_store.query_leads(filters, limit + 1, before_id=cursor)
+        has_more = len(leads) > limit
+        leads = leads[:limit]
+        latest_id = lead_store.latest_id()
+        next_cursor = leads[-1]["id"] if has_more else None
+
+    counts = interest_summary(lead_store.interest_counts())
+
+    return {
+        "leads": leads,
+        "total": counts["total"],
+        "counts": counts,
+        "next_cursor": next_cursor,
+        "latest_id": latest_id,
+        "has_more": has_more,
+    }
+
+
+def failure_rate(failures: int, total: int) -> float:
+    return round(failures / total, 4) if total else 0.0
+
+
+@app.get("/api/leads/stats")
+async def get_lead_stats(
+    days: int = Query(30, ge=1, le=366, description="Dias mais recentes em by_day"),
+    weeks: int = Query(12, ge=1, le=104, description="Semanas mais recentes em by_week"),
+):
+    """Agregados dos leads (interesse, distrito, dia/semana, orçamento, validação), sem varrer a tabela"""
+    rollups = await asyncio.to_thread(lead_store.rollups)
+    total = rollups.get("all", {}).get("total", 0)
+    by_interest = rollups.get("interest", {})
+    validation = rollups.get("validation", {})
+    budget = rollups.get("budget", {})
+    budget_order = [label for _, label in SALE_BUDGET_BUCKETS + RENT_BUDGET_BUCKETS] + ["unknown"]
+    return {
+        "total": total,
+        "counts": interest_summary(by_interest),
+        "by_interest": by_interest,
+        "by_district": dict(sorted(rollups.get("district", {}).items(), key=lambda item: (-item[1], item[0]))),
+        "by_day": dict(sorted(rollups.get("day", {}).items())[-days:]),
+        "by_week": dict(sorted(rollups.get("week", {}).items())[-weeks:]),
+        "budget": {label: budget[label] for label in budget_order if label in budget},
+        "validation": {
+            "email_invalid": validation.get("email_invalid", 0),
+            "postcode_invalid": validation.get("postcode_invalid", 0),
+            "any_invalid": validation.get("any_invalid", 0),
+            "email_invalid_rate": failure_rate(validation.get("email_invalid", 0), total),
+            "postcode_invalid_rate": failure_rate(validation.get("postcode_invalid", 0), total),
+            "any_invalid_rate": failure_rate(validation.get("any_invalid", 0), total),
+        },
+    }
+
+
+def iter_leads_csv(leads: Iterable[dict], fields: list) -> Iterator[str]:
+    """Gera o CSV de leads em blocos, sem montar o arquivo em memória"""
+    import csv
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+
+    for index, lead in enumerate(leads, start=1):
+        writer.writerow([lead[field] for field in fields])
+        if index % EXPORT_CONFIG["chunk_rows"] == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_leads_ndjson(leads: Iterable[dict]) -> Iterator[str]:
+    """Um objeto JSON por linha, em blocos"""
+    lines = []
+    for lead in leads:
+        lines.append(json.dumps({field: lead[field] for field in EXPORT_FIELDS}, ensure_ascii=False))
+        if len(lines) >= EXPORT_CONFIG["chunk_rows"]:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def columnar_row_group(rows: list) -> dict:
+    """Grupo de linhas em colunas: ids em delta, colunas repetitivas como dicionário + códigos"""
+    ids = [row["id"] for row in rows]
+    columns = {"id": [ids[0]] + [current - previous for previous, current in zip(ids, ids[1:])]}
+    for field in STORE_FIELDS:
+        values = [row[field] for row in rows]
+        if field in COLUMNAR_DICTIONARY_FIELDS:
+            codes = {}
+            columns[field] = {
+                "codes": [codes.setdefault(value, len(codes)) for value in values],
+                "dictionary": list(codes),
+            }
+        else:
+            columns[field] = values
+    return {"rows": len(rows), "first_id": ids[0], "last_id": ids[-1], "columns": columns}
+
+
+def iter_leads_columnar(leads: Iterable[dict], until_id: int) -> Iterator[str]:
+    """Formato colunar compacto: cabeçalho, um grupo de linhas por linha JSON e um rodapé com o cursor"""
+    compact = partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
+    yield compact({
+        "format": "leads-columnar",
+        "version": 1,
+        "columns": EXPORT_FIELDS,
+        "dictionary_columns": list(COLUMNAR_DICTIONARY_FIELDS),
+        "until_id": until_id,
+    }) + "\n"
+    total = 0
+    last_id = None
+    rows = []
+    for lead in leads:
+        rows.append(lead)
+        if len(rows) >= EXPORT_CONFIG["row_group_size"]:
+            yield compact(columnar_row_group(rows)) + "\n"
+            total += len(rows)
+            last_id = rows[-1]["id"]
+            rows = []
+    if rows:
+        yield compact(columnar_row_group(rows)) + "\n"
+        total += len(rows)
+        last_id = rows[-1]["id"]
+    yield compact({"end": True, "rows": total, "last_id": last_id}) + "\n"
+
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "columnar": ("application/x-ndjson", "columnar.ndjson"),
+}
+
+
+def export_response(export_format: str, filters: dict, since: int, fields: list = EXPORT_FIELDS,
+                    filename: Optional[str] = None) -> StreamingResponse:
+    """Exportação em streaming até o último lead gravado agora; since retoma de onde parou"""
+    until_id = lead_store.latest_id()
+    leads = lead_store.iter_leads(EXPORT_CONFIG["chunk_rows"], filters, after_id=since, until_id=until_id)
+    if export_format == "csv":
+        body = iter_leads_csv(leads, fields)
+    elif export_format == "ndjson":
+        body = iter_leads_ndjson(leads)
+    else:
+        body = iter_leads_columnar(leads, until_id)
+    media_type, extension = EXPORT_FORMATS[export_format]
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename or f"leads.{extension}"}"',
+            # Próximo since para uma exportação incremental
+            "X-Export-Until-Id": str(until_id),
+        },
+    )
+
+
+async def lead_event_stream(queue: asyncio.Queue) -> AsyncIterator[str]:
+    """Eventos SSE de um painel: hello, lotes de leads novos e keep-alive"""
+    try:
+        yield f"event: hello\ndata: {json.dumps({'latest_id': lead_broadcaster.latest_id})}\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), LEAD_EVENTS_CONFIG["heartbeat"])
+            except asyncio.TimeoutError:
+                # Comentário SSE: mantém a conexão aberta em proxies
+                yield ": keep-alive\n\n"
+                continue
+            if event is None:
+                return
+            yield event
+    finally:
+        lead_broadcaster.unsubscribe(queue)
+
+
+@app.get("/api/leads/events")
+async def lead_events():
+    """Leads novos, leads atualizados por junção e contadores (SSE), à medida que são gravados"""
+    queue = await lead_broadcaster.subscribe()
+    if queue is None:
+        raise HTTPException(status_code=503, detail="too_many_subscribers")
+    return StreamingResponse(
+        lead_event_stream(queue),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/leads/export")
+def export_leads(
+    format: str = Query("csv", pattern="^(csv|ndjson|columnar)$"),
+    since: int = Query(0, ge=0, description="Exporta apenas leads com id maior que este"),
+    interest: Optional[str] = None,
+    postcode_area: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    valid: Optional[str] = None,
+    borough: Optional[str] = None,
+    zone: Optional[int] = Query(None, ge=1, le=9),
+):
+    """Exporta os leads em streaming (mais antigos primeiro), com os filtros da listagem"""
+    filters = lead_filters(interest, postcode_area, date_from, date_to, valid, borough, zone)
+    return export_response(format, filters, since)
+
+
+@app.get("/api/leads/export.csv")
+def export_leads_csv():
+    """Download dos leads no formato do CSV original"""
+    return export_response("csv", {}, 0, LEAD_FIELDS, "leads_imobiliaria.csv")
+
+
+@app.get("/api/areas/{query}")
+async def get_area(query: str):
+    """Borough, zona e fatos de uma área a partir do postcode, outward code ou nome"""
+    info = area_index.lookup(query)
+    if info is None:
+        area = area_index.area(query)
+        if area is None:
+            raise HTTPException(status_code=404, detail="area_not_found")
+        return {"query": query, "area": area}
+    return {"query": query, **info}
+
+
+@app.get("/api/ready")
+async def readiness():
+    """Pronto para tráfego: inicialização concluída e warm-up terminado (ou desativado); 503 até lá"""
+    return JSONResponse(
+        status_code=200 if warm_up.ready else 503,
+        content={"ready": warm_up.ready, "warmup": warm_up.stats(), "startup": startup_timer.stats()},
+    )
+
+
+def stored_stats() -> dict:
+    """Estatísticas que contam linhas no SQLite (estado compartilhado e outbox), lidas juntas numa thread"""
+    return {
+        "rate_limit": chat_limiter.stats(),
+        "sessions": session_store.stats(),
+        "notifications": notification_queue.stats(),
+        "response_cache": response_cache.stats(),
+    }
 
 
 @app.get("/api/health")
 async def health_check():
     """Verificação de saúde da API"""
-    return {"status": "healthy", "service": "PropertyBot"}
+    stored = await asyncio.to_thread(stored_stats)
+    return {
+        "status": "healthy",
+        "service": "PropertyBot",
+        "gemini_pool": gemini_pool.stats(),
+        "gemini_scheduler": gemini_scheduler.stats(),
+        "rate_limit": stored["rate_limit"],
+        "sessions": stored["sessions"],
+        "notifications": stored["notifications"],
+        "lead_writer": lead_writer.stats(),
+        "response_cache": stored["response_cache"],
+        "context_cache": system_prompt_cache.stats(),
+        "lead_extraction": lead_extractor.stats(),
+        "areas": area_index.stats(),
+        "lead_events": lead_broadcaster.stats(),
+        "lead_dedupe": lead_dedupe.stats() if lead_dedupe is not None else None,
+        "frontend": frontend_assets.stats(),
+        "warmup": warm_up.stats(),
+        "startup": startup_timer.stats(),
+        "worker": {"pid": os.getpid(), "workers": WEB_WORKERS, "state_backend": STATE_CONFIG["backend"]},
+    }
+
+
+def stats_metrics(stored: dict) -> list:
+    """Estatísticas já mantidas pelos componentes, no formato Prometheus (stored vem de stored_stats)"""
+    scheduler = gemini_scheduler.stats()
+    pool = gemini_pool.stats()
+    cache = stored["response_cache"]
+    writer = lead_writer.stats()
+    notifications = stored["notifications"]
+    values = [
+        ("chat_rate_limited_total", "counter", "Chat requests rejected by the rate limit",
+         [('scope="ip"', chat_limiter.ip_limited), ('scope="session"', chat_limiter.session_limited),
+          ('scope="oversized"', chat_limiter.oversized)]),
+        ("gemini_scheduler_waiting", "gauge", "Gemini calls waiting for a slot", [("", scheduler["waiting"])]),
+        ("gemini_scheduler_running", "gauge", "Gemini calls in progress", [("", scheduler["running"])]),
+        ("gemini_retries_total", "counter", "Gemini calls retried after 429/5xx", [("", scheduler["retries_total"])]),
+        ("gemini_coalesced_total", "counter", "Requests served by an identical in-flight call", [("", scheduler["coalesced_total"])]),
+        ("gemini_rejected_total", "counter", "Calls answered with a retry reply", [("", scheduler["rejected_total"])]),
+        ("gemini_breaker_open", "gauge", "1 while the circuit breaker is open", [("", int(scheduler["breaker"] != "closed"))]),
+        ("gemini_pool_connections", "gauge", "Open upstream connections", [("", pool["connections"])]),
+        ("response_cache_requests_total", "counter", "Response cache lookups",
+         [('result="hit"', cache["hits"]), ('result="miss"', cache["misses"])]),
+        ("chat_sessions", "gauge", "Live chat sessions", [("", stored["sessions"].get("sessions", 0))]),
+        ("lead_writer_queued", "gauge", "Leads waiting to be written", [("", writer["queued"])]),
+        ("notifications_pending", "gauge", "Notification emails waiting to be sent", [("", notifications["pending"])]),
+        ("lead_event_subscribers", "gauge", "Admin dashboards connected to the lead stream",
+         [("", lead_broadcaster.stats()["subscribers"])]),
+    ]
+    lines = []
+    for name, kind, help_text, samples in values:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Métricas no formato texto do Prometheus"""
+    stored = await asyncio.to_thread(stored_stats)
+    return PlainTextResponse(metrics.render(stats_metrics(stored)), media_type="text/plain; version=0.0.4")
 
 
 # Painel Admin HTML
@@ -496,10 +4920,32 @@ ADMIN_HTML = """
             <div class="p-6 border-b border-gray-100">
                 <div class="flex justify-between items-center">
                     <h2 class="font-serif text-xl text-london-charcoal">Captured Leads</h2>
-                    <button onclick="loadLeads()" class="bg-london-navy text-white px-4 py-2 rounded text-sm hover:bg-london-charcoal transition-colors">
-                        Refresh
-                    </button>
+                    <div class="flex items-center space-x-2">
+                        <a href="/api/leads/export.csv" class="border border-london-navy text-london-navy px-4 py-2 rounded text-sm hover:bg-london-cream transition-colors">
+                            Export CSV
+                        </a>
+                        <button onclick="loadLeads()" class="bg-london-navy text-white px-4 py-2 rounded text-sm hover:bg-london-charcoal transition-colors">
+                            Refresh
+                        </button>
+                    </div>
                 </div>
+                <form id="lead-filters" class="grid md:grid-cols-6 gap-3 mt-4" onsubmit="event.preventDefault(); loadLeads();">
+                    <select name="interest" class="border border-gray-200 rounded px-3 py-2 text-sm">
+                        <option value="">All interests</option>
+                        <option value="buy">Buy</option>
+                        <option value="rent">Rent</option>
+                        <option value="sell">Sell</option>
+                    </select>
+                    <input name="postcode_area" placeholder="Postcode or area (e.g. SW1A, Chelsea)" class="border border-gray-200 rounded px-3 py-2 text-sm">
+                    <input name="borough" placeholder="Borough (e.g. Camden)" class="border border-gray-200 rounded px-3 py-2 text-sm">
+                    <input name="date_from" type="date" class="border border-gray-200 rounded px-3 py-2 text-sm">
+                    <input name="date_to" type="date" class="border border-gray-200 rounded px-3 py-2 text-sm">
+                    <select name="valid" class="border border-gray-200 rounded px-3 py-2 text-sm" onchange="loadLeads()">
+                        <option value="">Any validation</option>
+                        <option value="yes">Valid</option>
+                        <option value="no">With errors</option>
+                    </select>
+                </form>
             </div>
             <div class="overflow-x-auto">
                 <table class="w-full">
@@ -522,137 +4968,517 @@ ADMIN_HTML = """
                     </tbody>
                 </table>
             </div>
+            <div id="load-more" class="hidden p-4 text-center border-t border-gray-100">
+                <button onclick="loadMore()" class="text-sm text-london-navy hover:text-london-gold transition-colors">Load more</button>
+            </div>
         </div>
     </main>
 
     <script>
-        async function loadLeads() {
-            try {
-                const response = await fetch('/api/leads');
-                const data = await response.json();
+        let latestId = 0;
+        let nextCursor = null;
+
+        function filterQuery() {
+            const params = new URLSearchParams();
+            new FormData(document.getElementById('lead-filters')).forEach((value, key) => {
+                if (value) params.set(key, value);
+            });
+            return params;
+        }
+
+        function updateStats(counts) {
+            document.getElementById('total-leads').textContent = counts.total;
+            document.getElementById('total-comprar').textContent = counts.buy;
+            document.getElementById('total-alugar').textContent = counts.rent;
+            document.getElementById('total-vender').textContent = counts.sell;
+        }
+
+        function renderLead(lead) {
+            const date = new Date(lead.timestamp).toLocaleDateString('en-GB', {
+                day: '2-digit',
+                month: '2-digit',
+                year: 'numeric',
+                hour: '2-digit',
+                minute: '2-digit'
+            });
+
+            const interestColor = {
+                'buy': 'bg-green-100 text-green-800',
+                'rent': 'bg-blue-100 text-blue-800',
+                'sell': 'bg-purple-100 text-purple-800'
+            }[lead.tipo_interesse?.toLowerCase()] || 'bg-gray-100 text-gray-800';
+
+            const emailValid = lead.email_valido === 'Yes';
+            const postcodeValid = lead.postcode_valido === 'Yes';
 
-                // Update stats
-                document.getElementById('total-leads').textContent = data.total;
+            const interestText = {'buy': 'buying', 'rent': 'renting', 'sell': 'selling'}[lead.tipo_interesse?.toLowerCase()] || 'property';
+            const whatsappMsg = encodeURIComponent(`Hello ${lead.nome}! I hope you're well. I noticed you're interested in ${interestText} in the ${lead.postcode || 'London'} area. I'm Sophie from PropertyBot and would love to assist you. Would you be available for a quick chat?`);
+            const whatsappLink = lead.whatsapp ? `<a href="https://wa.me/44${lead.whatsapp.replace(/\\D/g,'').replace(/^0/,'')}" target="_blank" class="text-green-600 hover:underline">${lead.whatsapp}</a>` : '-';
+
+            const emailSubject = encodeURIComponent(`Your ${interestText} enquiry - PropertyBot`);
+            const emailBody = encodeURIComponent(`Dear ${lead.nome},\n\nI hope this email finds you well.\n\nI noticed you expressed interest in ${interestText} in the ${lead.postcode || 'London'} area with a budget of ${lead.orcamento || 'to be confirmed'}.\n\nI would be delighted to arrange a call to discuss your requirements and present our best options.\n\nWhen would be a convenient time for a chat?\n\nKind regards,\nSophie\nPropertyBot Team`);
+            const emailLink = lead.email ? `<a href="mailto:${lead.email}?subject=${emailSubject}&body=${emailBody}" class="text-red-600 hover:underline">${lead.email}</a>` : '-';
+
+            return `
+                <tr class="hover:bg-gray-50" data-lead-id="${lead.id}">
+                    <td class="px-6 py-4 text-sm text-london-charcoal">${date}</td>
+                    <td class="px-6 py-4 text-sm font-medium text-london-charcoal">${lead.nome || '-'}</td>
+                    <td class="px-6 py-4 text-sm text-london-charcoal">${whatsappLink}</td>
+                    <td class="px-6 py-4 text-sm text-london-charcoal">${emailLink}</td>
+                    <td class="px-6 py-4">
+                        <span class="px-2 py-1 text-xs rounded-full ${interestColor}">
+                            ${lead.tipo_interesse || '-'}
+                        </span>
+                    </td>
+                    <td class="px-6 py-4 text-sm text-london-charcoal">${lead.orcamento || '-'}</td>
+                    <td class="px-6 py-4 text-sm text-london-charcoal">${lead.postcode || '-'}${lead.borough ? `<div class="text-xs text-london-slate">${lead.borough} · Zone ${lead.zona}</div>` : ''}</td>
+                    <td class="px-6 py-4 text-sm">
+                        <span class="inline-flex items-center space-x-1">
+                            <span title="Email" class="${emailValid ? 'text-green-500' : 'text-red-500'}">✉️</span>
+                            <span title="Postcode" class="${postcodeValid ? 'text-green-500' : 'text-red-500'}">📍</span>
+                        </span>
+                    </td>
+                </tr>
+            `;
+        }
 
-                const comprar = data.leads.filter(l => l.tipo_interesse?.toLowerCase().includes('buy')).length;
-                const alugar = data.leads.filter(l => l.tipo_interesse?.toLowerCase().includes('rent')).length;
-                const vender = data.leads.filter(l => l.tipo_interesse?.toLowerCase().includes('sell')).length;
+        async function fetchLeads(extra) {
+            const params = filterQuery();
+            Object.entries(extra).forEach(([key, value]) => params.set(key, value));
+            const response = await fetch('/api/leads?' + params.toString());
+            if (!response.ok) throw new Error('HTTP ' + response.status);
+            return response.json();
+        }
 
-                document.getElementById('total-comprar').textContent = comprar;
-                document.getElementById('total-alugar').textContent = alugar;
-                document.getElementById('total-vender').textContent = vender;
+        async function loadLeads() {
+            try {
+                const data = await fetchLeads({});
+                updateStats(data.counts);
+                latestId = data.latest_id;
+                nextCursor = data.next_cursor;
 
-                // Update table
                 const tbody = document.getElementById('leads-table');
 
                 if (data.leads.length === 0) {
                     tbody.innerHTML = '<tr><td colspan="8" class="px-6 py-8 text-center text-london-slate">No leads captured yet</td></tr>';
-                    return;
+                } else {
+                    tbody.innerHTML = data.leads.map(renderLead).join('');
                 }
-
-                tbody.innerHTML = data.leads.reverse().map(lead => {
-                    const date = new Date(lead.timestamp).toLocaleDateString('en-GB', {
-                        day: '2-digit',
-                        month: '2-digit',
-                        year: 'numeric',
-                        hour: '2-digit',
-                        minute: '2-digit'
-                    });
-
-                    const interestColor = {
-                        'buy': 'bg-green-100 text-green-800',
-                        'rent': 'bg-blue-100 text-blue-800',
-                        'sell': 'bg-purple-100 text-purple-800'
-                    }[lead.tipo_interesse?.toLowerCase()] || 'bg-gray-100 text-gray-800';
-
-                    const emailValid = lead.email_valido === 'Yes';
-                    const postcodeValid = lead.postcode_valido === 'Yes';
-
-                    const interestText = {'buy': 'buying', 'rent': 'renting', 'sell': 'selling'}[lead.tipo_interesse?.toLowerCase()] || 'property';
-                    const whatsappMsg = encodeURIComponent(`Hello ${lead.nome}! I hope you're well. I noticed you're interested in ${interestText} in the ${lead.postcode || 'London'} area. I'm Sophie from PropertyBot and would love to assist you. Would you be available for a quick chat?`);
-                    const whatsappLink = lead.whatsapp ? `<a href="https://wa.me/44${lead.whatsapp.replace(/\\D/g,'').replace(/^0/,'')}" target="_blank" class="text-green-600 hover:underline">${lead.whatsapp}</a>` : '-';
-
-                    const emailSubject = encodeURIComponent(`Your ${interestText} enquiry - PropertyBot`);
-                    const emailBody = encodeURIComponent(`Dear ${lead.nome},\n\nI hope this email finds you well.\n\nI noticed you expressed interest in ${interestText} in the ${lead.postcode || 'London'} area with a budget of ${lead.orcamento || 'to be confirmed'}.\n\nI would be delighted to arrange a call to discuss your requirements and present our best options.\n\nWhen would be a convenient time for a chat?\n\nKind regards,\nSophie\nPropertyBot Team`);
-                    const emailLink = lead.email ? `<a href="mailto:${lead.email}?subject=${emailSubject}&body=${emailBody}" class="text-red-600 hover:underline">${lead.email}</a>` : '-';
-
-                    return `
-                        <tr class="hover:bg-gray-50">
-                            <td class="px-6 py-4 text-sm text-london-charcoal">${date}</td>
-                            <td class="px-6 py-4 text-sm font-medium text-london-charcoal">${lead.nome || '-'}</td>
-                            <td class="px-6 py-4 text-sm text-london-charcoal">${whatsappLink}</td>
-                            <td class="px-6 py-4 text-sm text-london-charcoal">${emailLink}</td>
-                            <td class="px-6 py-4">
-                                <span class="px-2 py-1 text-xs rounded-full ${interestColor}">
-                                    ${lead.tipo_interesse || '-'}
-                                </span>
-                            </td>
-                            <td class="px-6 py-4 text-sm text-london-charcoal">${lead.orcamento || '-'}</td>
-                            <td class="px-6 py-4 text-sm text-london-charcoal">${lead.postcode || '-'}</td>
-                            <td class="px-6 py-4 text-sm">
-                                <span class="inline-flex items-center space-x-1">
-                                    <span title="Email" class="${emailValid ? 'text-green-500' : 'text-red-500'}">✉️</span>
-                                    <span title="Postcode" class="${postcodeValid ? 'text-green-500' : 'text-red-500'}">📍</span>
-                                </span>
-                            </td>
-                        </tr>
-                    `;
-                }).join('');
+                document.getElementById('load-more').classList.toggle('hidden', !nextCursor);
 
             } catch (error) {
                 console.error('Erro ao carregar leads:', error);
                 document.getElementById('leads-table').innerHTML =
-                    '<tr><td colspan="7" class="px-6 py-8 text-center text-red-500">Erro ao carregar leads</td></tr>';
+                    '<tr><td colspan="8" class="px-6 py-8 text-center text-red-500">Erro ao carregar leads</td></tr>';
+            }
+        }
+
+        async function loadMore() {
+            if (!nextCursor) return;
+            try {
+                const data = await fetchLeads({cursor: nextCursor});
+                nextCursor = data.next_cursor;
+                document.getElementById('leads-table').insertAdjacentHTML('beforeend', data.leads.map(renderLead).join(''));
+                document.getElementById('load-more').classList.toggle('hidden', !nextCursor);
+            } catch (error) {
+                console.error('Erro ao carregar leads:', error);
+            }
+        }
+
+        function prependLeads(leads) {
+            // Leads come newest first; rows already on the page are skipped
+            const tbody = document.getElementById('leads-table');
+            if (!tbody.querySelector('tr[data-lead-id]')) tbody.innerHTML = '';
+            const fresh = leads.filter(lead => !tbody.querySelector(`tr[data-lead-id="${lead.id}"]`));
+            tbody.insertAdjacentHTML('afterbegin', fresh.map(renderLead).join(''));
+            return fresh.length;
+        }
+
+        function replaceLeads(leads) {
+            // Repeated leads are merged into the existing row: redraw it in place
+            leads.forEach(lead => {
+                const row = document.querySelector(`tr[data-lead-id="${lead.id}"]`);
+                if (row) row.outerHTML = renderLead(lead);
+            });
+        }
+
+        async function refreshLeads() {
+            // Only fetch rows newer than the last one already shown
+            try {
+                let data;
+                do {
+                    data = await fetchLeads({since: latestId});
+                    latestId = Math.max(latestId, data.latest_id);
+                    if (data.leads.length > 0) prependLeads(data.leads);
+                } while (data.has_more);
+                updateStats(data.counts);
+            } catch (error) {
+                console.error('Erro ao atualizar leads:', error);
             }
         }
 
-        // Load leads on page load
-        loadLeads();
+        // Fallback: poll for new rows while the event stream is unavailable
+        let pollTimer = null;
+
+        function startPolling() {
+            if (!pollTimer) pollTimer = setInterval(refreshLeads, 30000);
+        }
+
+        function stopPolling() {
+            clearInterval(pollTimer);
+            pollTimer = null;
+        }
+
+        function connectEvents() {
+            if (!window.EventSource) {
+                startPolling();
+                return;
+            }
+            const source = new EventSource('/api/leads/events');
+
+            source.addEventListener('hello', event => {
+                stopPolling();
+                // Catch up on anything saved while disconnected
+                if (JSON.parse(event.data).latest_id > latestId) refreshLeads();
+            });
+
+            source.addEventListener('leads', event => {
+                const data = JSON.parse(event.data);
+                replaceLeads(data.updated);
+                // With filters (or rows already shown) the server applies the filters via since=
+                if (filterQuery().toString() || data.leads.some(lead => lead.id <= latestId)) {
+                    refreshLeads();
+                    return;
+                }
+                if (data.leads.length > 0) prependLeads(data.leads.slice().reverse());
+                updateStats(data.totals);
+                latestId = Math.max(latestId, data.latest_id);
+            });
+
+            source.onerror = () => {
+                // EventSource reconnects by itself; poll in the meantime
+                startPolling();
+                if (source.readyState === EventSource.CLOSED) setTimeout(connectEvents, 30000);
+            };
+        }
 
-        // Auto-refresh every 30 seconds
-        setInterval(loadLeads, 30000);
+        // Load leads on page load, then follow new ones as they are saved
+        loadLeads().then(connectEvents);
     </script>
 </body>
 </html>
 """
 
 
-@app.get("/admin", response_class=HTMLResponse)
-async def admin_panel():
+# Assets do frontend: URLs com o hash do conteúdo, ETag e variantes gzip/brotli
+COMPRESSIBLE_SUFFIXES = {".js", ".css", ".html", ".svg", ".json", ".txt"}
+# Referências a /static/... em atributos, strings de JS e url() de CSS (a query, ex. ?v=3, é descartada)
+STATIC_URL_RE = re.compile(r"""(["'(])/static/([^"'()?#\s]+)(?:\?[^"'()#\s]*)?(?=["')])""")
+HASHED_NAME_RE = re.compile(r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<suffix>\.[A-Za-z0-9]+)$")
+# Ordem de preferência quando o cliente aceita as duas
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+class StaticAsset:
+    """Um arquivo ou página com hash do conteúdo; os de texto ficam em memória com as variantes comprimidas"""
+
+    __slots__ = ("key", "path", "media_type", "digest", "body", "variants")
+
+    def __init__(self, key: str, path: Optional[Path], media_type: str, digest: str,
+                 body: Optional[bytes] = None, variants: Optional[dict] = None):
+        self.key = key
+        self.path = path
+        self.media_type = media_type
+        self.digest = digest
+        self.body = body
+        self.variants = variants or {}
+
+    def etag(self, encoding: Optional[str] = None) -> str:
+        # Cada codificação é uma representação diferente, com ETag próprio
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+def hashed_name(name: str, digest: str) -> str:
+    """js/chat.js -> js/chat.<hash>.js"""
+    stem, dot, suffix = name.rpartition(".")
+    return f"{stem}.{digest}.{suffix}" if dot else f"{name}.{digest}"
+
+
+def brotli_module():
+    """brotli é opcional e só é usado no build-assets (sem ele as variantes são só gzip)"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def compress_variants(body: bytes, best: bool) -> dict:
+    """Variantes gzip/brotli menores que o original (best = compressão máxima, usada no build)"""
+    import gzip
+
+    variants = {"gzip": gzip.compress(body, compresslevel=9 if best else 6, mtime=0)}
+    brotli = brotli_module() if best else None
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {encoding: data for encoding, data in variants.items() if len(data) < len(body)}
+
+
+def accepted_encoding(header: str, available: dict) -> Optional[str]:
+    """Melhor variante disponível segundo o Accept-Encoding (q=0 exclui)"""
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODING_SUFFIXES:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def etag_matches(header: Optional[str], asset: StaticAsset) -> bool:
+    """If-None-Match (comparação fraca: qualquer codificação do mesmo conteúdo vale)"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        if tag.split("-", 1)[0] == asset.digest:
+            return True
+    return False
+
+
+class AssetRegistry:
+    """Assets de frontend/static e páginas pré-renderizadas, indexados pelo hash do conteúdo
+
+    Tudo é lido uma vez na inicialização: os templates saem com as URLs de /static
+    trocadas pelas versões com hash, e as variantes .gz/.br vêm de frontend/dist
+    (python backend/main.py build-assets). Sem o build, os textos são comprimidos
+    só com gzip na hora de carregar.
+    """
+
+    def __init__(self, root: Path, dist: Path):
+        self.root = root
+        self.static = root / "static"
+        self.dist = dist
+        self.assets = {}
+        self.pages = {}
+        self.precompressed = 0
+
+    def load(self, pages: dict, best: bool = False):
+        import mimetypes
+
+        assets = {}
+        self.assets = assets
+        self.precompressed = 0
+        files = [path for path in self.static.rglob("*") if path.is_file()]
+        # Binários primeiro: os textos podem citar as URLs com hash deles
+        for path in sorted(files, key=lambda path: (path.suffix in COMPRESSIBLE_SUFFIXES, path.as_posix())):
+            name = path.relative_to(self.static).as_posix()
+            media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+            if path.suffix in COMPRESSIBLE_SUFFIXES:
+                assets[name] = self._text_asset(name, path.read_text(encoding="utf-8"), media_type, best)
+            else:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(partial(f.read, 1 << 16), b""):
+                        digest.update(chunk)
+                digest = digest.hexdigest()[:12]
+                assets[name] = StaticAsset(hashed_name(name, digest), path, media_type, digest)
+        self.pages = {
+            name: self._text_asset(f"pages/{name}.html", source, "text/html; charset=utf-8", best)
+            for name, source in pages.items()
+        }
+
+    def _text_asset(self, name: str, text: str, media_type: str, best: bool) -> StaticAsset:
+        body = self.rewrite(text).encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        key = hashed_name(name, digest)
+        variants = {}
+        if not best:
+            for encoding, suffix in ENCODING_SUFFIXES.items():
+                sidecar = self.dist / f"{key}{suffix}"
+                if sidecar.is_file():
+                    variants[encoding] = sidecar.read_bytes()
+            if variants:
+                self.precompressed += 1
+        if not variants:
+            variants = compress_variants(body, best)
+        return StaticAsset(key, None, media_type, digest, body, variants)
+
+    def url(self, name: str) -> Optional[str]:
+        asset = self.assets.get(name)
+        return f"/static/{asset.key}" if asset is not None else None
+
+    def rewrite(self, text: str) -> str:
+        """Troca /static/<arquivo> pela URL com hash (referências desconhecidas ficam como estão)"""
+        def replace(match):
+            url = self.url(match.group(2))
+            return match.group(1) + url if url else match.group(0)
+        return STATIC_URL_RE.sub(replace, text)
+
+    def resolve(self, name: str) -> tuple:
+        """(asset, imutável) de um caminho em /static, com ou sem hash"""
+        asset = self.assets.get(name)
+        if asset is not None:
+            return asset, False
+        match = HASHED_NAME_RE.match(name)
+        if match is None:
+            return None, False
+        asset = self.assets.get(match["stem"] + match["suffix"])
+        if asset is None:
+            return None, False
+        # Hash antigo (deploy anterior): entrega o conteúdo atual, mas sem cache longo
+        return asset, asset.digest == match["digest"]
+
+    def build(self, pages: dict) -> dict:
+        """Gera frontend/dist com as variantes gzip/brotli de cada texto e remove as de versões antigas"""
+        self.load(pages, best=True)
+        written = set()
+        for asset in [*self.assets.values(), *self.pages.values()]:
+            for encoding, data in asset.variants.items():
+                target = self.dist / f"{asset.key}{ENCODING_SUFFIXES[encoding]}"
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.write_bytes(data)
+                written.add(target)
+        removed = 0
+        if self.dist.is_dir():
+            for path in self.dist.rglob("*"):
+                if path.is_file() and path not in written:
+                    path.unlink()
+                    removed += 1
+        return {"files": len(written), "removed": removed, "brotli": brotli_module() is not None, "dist": str(self.dist)}
+
+    def response(self, request: Request, asset: StaticAsset, cache_control: str) -> Response:
+        """Resposta com ETag, 304 e a variante pedida no Accept-Encoding"""
+        encoding = None
+        headers = {"Cache-Control": cache_control}
+        if asset.body is not None:
+            encoding = accepted_encoding(request.headers.get("accept-encoding", ""), asset.variants)
+            headers["Vary"] = "Accept-Encoding"
+        headers["ETag"] = asset.etag(encoding)
+        if etag_matches(request.headers.get("if-none-match"), asset):
+            return Response(status_code=304, headers=headers)
+        if asset.body is None:
+            return FileResponse(asset.path, media_type=asset.media_type, headers=headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+        return Response(asset.body, media_type=asset.media_type, headers=headers)
+
+    def stats(self) -> dict:
+        return {
+            "assets": len(self.assets),
+            "pages": len(self.pages),
+            "precompressed": self.precompressed,
+            "brotli": any("br" in asset.variants for asset in [*self.assets.values(), *self.pages.values()]),
+        }
+
+
+def page_sources() -> dict:
+    """Templates servidos pelo app (nome -> HTML), incluindo o painel admin"""
+    templates = FRONTEND_DIR / "templates"
+    pages = {name: (templates / f"{name}.html").read_text(encoding="utf-8") for name in ("index", "landing", "terms", "privacy")}
+    pages["admin"] = ADMIN_HTML
+    return pages
+
+
+frontend_assets = AssetRegistry(FRONTEND_DIR, ASSETS_DIST_DIR)
+
+
+@app.api_route("/admin", methods=["GET", "HEAD"])
+async def admin_panel(request: Request):
     """Painel administrativo para visualizar leads"""
-    return ADMIN_HTML
+    return frontend_assets.response(request, frontend_assets.pages["admin"], "private, no-cache")
 
 
 # Servir arquivos estáticos
-frontend_path = Path(__file__).parent.parent / "frontend"
-app.mount("/static", StaticFiles(directory=frontend_path / "static"), name="static")
+@app.api_route("/static/{name:path}", methods=["GET", "HEAD"])
+async def serve_static(name: str, request: Request):
+    """Arquivos de frontend/static; URLs com hash são imutáveis, as demais revalidam pelo ETag"""
+    asset, immutable = frontend_assets.resolve(name)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if immutable:
+        cache_control = f"public, max-age={STATIC_CONFIG['immutable_max_age']}, immutable"
+    else:
+        cache_control = f"public, max-age={STATIC_CONFIG['max_age']}"
+    return frontend_assets.response(request, asset, cache_control)
 
 
-@app.get("/")
-async def serve_frontend():
+@app.api_route("/", methods=["GET", "HEAD"])
+async def serve_frontend(request: Request):
     """Serve a página principal do frontend"""
-    return FileResponse(frontend_path / "templates" / "index.html")
+    return frontend_assets.response(request, frontend_assets.pages["index"], "no-cache")
 
 
-@app.get("/landing")
-async def serve_landing():
+@app.api_route("/landing", methods=["GET", "HEAD"])
+async def serve_landing(request: Request):
     """Serve a landing page de vendas"""
-    return FileResponse(frontend_path / "templates" / "landing.html")
+    return frontend_assets.response(request, frontend_assets.pages["landing"], "no-cache")
 
 
-@app.get("/terms")
-async def serve_terms():
+@app.api_route("/terms", methods=["GET", "HEAD"])
+async def serve_terms(request: Request):
     """Serve the Terms of Service page"""
-    return FileResponse(frontend_path / "templates" / "terms.html")
+    return frontend_assets.response(request, frontend_assets.pages["terms"], "no-cache")
 
 
-@app.get("/privacy")
-async def serve_privacy():
+@app.api_route("/privacy", methods=["GET", "HEAD"])
+async def serve_privacy(request: Request):
     """Serve the Privacy Policy page"""
-    return FileResponse(frontend_path / "templates" / "privacy.html")
+    return frontend_assets.response(request, frontend_assets.pages["privacy"], "no-cache")
+
+
+# Rotas e índices prontos: fim da importação do módulo
+startup_timer.phases["module"] = round((time.perf_counter() - MODULE_STARTED) * 1000, 1)
+startup_timer.mark("imported")
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-csv":
+        # python backend/main.py migrate-csv [arquivo.csv]
+        source = Path(sys.argv[2]) if len(sys.argv) > 2 else CSV_FILE
+        lead_store.open()
+        migrate_csv_to_store(lead_store, source, force=True)
+        lead_store.close()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "build-assets":
+        # python backend/main.py build-assets  -> variantes .gz/.br em frontend/dist
+        print(json.dumps(frontend_assets.build(page_sources())))
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "dedupe":
+        # python backend/main.py dedupe  -> junta os leads repetidos (reinicie o app depois)
+        lead_store.open()
+        print(json.dumps(dedupe_store(lead_store)))
+        lead_store.close()
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "revalidate":
+        # python backend/main.py revalidate            -> leads do banco
+        # python backend/main.py revalidate leads.csv  -> CSV normalizado na saída padrão
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], "r", encoding="utf-8", newline="") as f:
+                revalidate_csv(f, sys.stdout)
+        else:
+            lead_store.open()
+            totals = revalidate_store(lead_store)
+            # Postcodes normalizados podem mudar o distrito
+            totals["areas_updated"] = index_lead_areas(lead_store, area_index, force=True)
+            print(json.dumps(totals))
+            lead_store.close()
+        sys.exit(0)
+
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,279 @@
+"""
+Teste de carga do chat contra o mock do Gemini
+
+Sobe o mock (benchmarks/mock_gemini.py) e o backend.main:app em processos
+separados, roda conversas de vários turnos em paralelo (parte delas termina
+com captura de lead) e mostra p50/p95/p99, requisições/s e memória por sessão.
+
+    python benchmarks/load_test.py --sessions 50 --turns 5
+    python benchmarks/load_test.py --stream --mock-latency-ms 800
+    python benchmarks/load_test.py --workers 4 --sessions 200
+    python benchmarks/load_test.py --url http://localhost:8000 --pid 1234
+
+Variáveis extras do app podem ser passadas com --env CHAVE=VALOR.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+FILLER_TURNS = [
+    "Hi there, I'm looking for a flat in London",
+    "What areas would you recommend for a young family?",
+    "How long does the buying process usually take?",
+    "Are there good schools near Clapham?",
+    "What about transport links to the City?",
+    "Do you have anything with a garden?",
+]
+
+
+def lead_turns(index: int) -> list:
+    """Conversa que termina com todos os dados de um lead"""
+    intent = random.choice(["buy", "rent", "sell"])
+    return [
+        f"Hello, I'd like to {intent} a property in London",
+        f"My budget is around £{random.randint(300, 1500)}k",
+        f"My name is Client{index}",
+        f"You can email me at client{index}@example.com",
+        f"My WhatsApp is 07700 9{index % 100000:05d}",
+        f"The postcode is SW{random.randint(1, 20)} {random.randint(1, 9)}AB",
+    ]
+
+
+def conversation(index: int, turns: int, lead_ratio: float) -> list:
+    if random.random() < lead_ratio:
+        messages = lead_turns(index)
+        # Turnos extras antes dos dados, para conversas mais longas que o roteiro
+        extra = max(0, turns - len(messages))
+        return random.sample(FILLER_TURNS, min(extra, len(FILLER_TURNS))) + messages
+    return [random.choice(FILLER_TURNS) for _ in range(turns)]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def rss_kb(pid: int) -> int:
+    """VmRSS do processo (Linux)"""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.first_tokens = []
+        self.errors = 0
+        self.busy = 0
+        self.leads = 0
+        self.status = {}
+
+
+async def send_turn(client: httpx.AsyncClient, url: str, body: dict, stream: bool, results: Results) -> Optional[dict]:
+    started = time.perf_counter()
+    if not stream:
+        response = await client.post(f"{url}/api/chat", json=body)
+        results.latencies.append(time.perf_counter() - started)
+        results.status[response.status_code] = results.status.get(response.status_code, 0) + 1
+        return response.json() if response.status_code == 200 else None
+
+    done = None
+    first_token = None
+    async with client.stream("POST", f"{url}/api/chat/stream", json=body) as response:
+        results.status[response.status_code] = results.status.get(response.status_code, 0) + 1
+        if response.status_code != 200:
+            await response.aread()
+            results.latencies.append(time.perf_counter() - started)
+            return None
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                if event == "token" and first_token is None:
+                    first_token = time.perf_counter() - started
+                elif event == "done":
+                    done = json.loads(line[5:])
+                elif event == "error":
+                    done = None
+    results.latencies.append(time.perf_counter() - started)
+    if first_token is not None:
+        results.first_tokens.append(first_token)
+    return done
+
+
+async def run_session(client: httpx.AsyncClient, url: str, messages: list, stream: bool, results: Results):
+    session_id = None
+    for message in messages:
+        body = {"message": message, "session_id": session_id} if session_id else {"message": message}
+        reply = await send_turn(client, url, body, stream, results)
+        if reply is None:
+            results.errors += 1
+            return
+        if reply.get("retry_after"):
+            results.busy += 1
+            continue
+        session_id = reply["session_id"]
+        if reply.get("lead_captured"):
+            results.leads += 1
+
+
+async def run_load(args, pid: Optional[int]) -> dict:
+    limits = httpx.Limits(max_connections=args.sessions + 10, max_keepalive_connections=args.sessions + 10)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        # Aquecimento: conexões, cache do prompt e imports preguiçosos
+        await client.post(f"{args.url}/api/chat", json={"message": "hello"})
+        rss_before = rss_kb(pid) if pid else 0
+
+        results = Results()
+        conversations = [conversation(i, args.turns, args.lead_ratio) for i in range(args.sessions)]
+        started = time.perf_counter()
+        await asyncio.gather(*(run_session(client, args.url, messages, args.stream, results) for messages in conversations))
+        elapsed = time.perf_counter() - started
+        rss_after = rss_kb(pid) if pid else 0
+
+    requests_total = len(results.latencies)
+    report = {
+        "mode": "stream" if args.stream else "chat",
+        "sessions": args.sessions,
+        "requests": requests_total,
+        "errors": results.errors,
+        "busy_replies": results.busy,
+        "leads_captured": results.leads,
+        "status": results.status,
+        "elapsed_s": round(elapsed, 2),
+        "requests_per_s": round(requests_total / elapsed, 1) if elapsed else 0,
+        "latency_ms": {
+            f"p{pct}": round(percentile(results.latencies, pct) * 1000, 1) for pct in (50, 95, 99)
+        },
+    }
+    if args.stream:
+        report["first_token_ms"] = {
+            f"p{pct}": round(percentile(results.first_tokens, pct) * 1000, 1) for pct in (50, 95, 99)
+        }
+    if pid:
+        # As sessões continuam vivas no store ao final do teste
+        report["rss_kb"] = {"before": rss_before, "after": rss_after}
+        report["memory_per_session_kb"] = round((rss_after - rss_before) / args.sessions, 1)
+    return report
+
+
+def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start in {timeout:.0f}s")
+
+
+def start_processes(args, workdir: str) -> list:
+    """Sobe o mock do Gemini e o app; retorna os processos (app por último)"""
+    mock_env = dict(os.environ)
+    mock_env.update({
+        "MOCK_LATENCY_MS": str(args.mock_latency_ms),
+        "MOCK_JITTER_MS": str(args.mock_jitter_ms),
+        "MOCK_ERROR_RATE": str(args.mock_error_rate),
+        "MOCK_5XX_RATE": str(args.mock_5xx_rate),
+        "MOCK_QUOTA_RPS": str(args.mock_quota_rps),
+    })
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.mock_gemini:app",
+         "--port", str(args.mock_port), "--log-level", "warning"],
+        cwd=ROOT, env=mock_env,
+    )
+    wait_ready(f"http://127.0.0.1:{args.mock_port}/stats")
+
+    app_env = dict(os.environ)
+    app_env.update({
+        "GOOGLE_API_KEY": "benchmark",
+        "GEMINI_API_BASE": f"http://127.0.0.1:{args.mock_port}/v1beta",
+        "LEADS_DB_PATH": str(Path(workdir) / "leads.db"),
+        "LOG_LEVEL": "WARNING",
+        # Todo o tráfego vem do mesmo IP: o limite por IP não se aplica aqui
+        "CHAT_RATE_LIMIT_PER_IP": "1000000000",
+        "WEB_CONCURRENCY": str(args.workers),
+        "STATE_DB_PATH": str(Path(workdir) / "state.db"),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        app_env[key] = value
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app",
+         "--port", str(args.port), "--log-level", "warning", "--no-access-log", "--workers", str(args.workers)],
+        cwd=ROOT, env=app_env,
+    )
+    wait_ready(f"http://127.0.0.1:{args.port}/api/health")
+    return [mock, app]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test do chat contra o mock do Gemini")
+    parser.add_argument("--sessions", type=int, default=50, help="conversas simultâneas")
+    parser.add_argument("--turns", type=int, default=6, help="turnos por conversa")
+    parser.add_argument("--lead-ratio", type=float, default=0.5, help="fração das conversas que terminam em lead")
+    parser.add_argument("--stream", action="store_true", help="usa /api/chat/stream")
+    parser.add_argument("--url", help="servidor já em execução (não sobe mock nem app)")
+    parser.add_argument("--pid", type=int, help="PID do servidor externo, para medir memória")
+    parser.add_argument("--workers", type=int, default=1, help="workers do uvicorn (estado compartilhado em SQLite)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--mock-latency-ms", type=float, default=300)
+    parser.add_argument("--mock-jitter-ms", type=float, default=100)
+    parser.add_argument("--mock-error-rate", type=float, default=0)
+    parser.add_argument("--mock-5xx-rate", type=float, default=0)
+    parser.add_argument("--mock-quota-rps", type=float, default=0)
+    parser.add_argument("--env", action="append", default=[], help="CHAVE=VALOR extra para o app")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="grava o relatório neste arquivo")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.url:
+                pid = args.pid
+            else:
+                processes = start_processes(args, workdir)
+                args.url = f"http://127.0.0.1:{args.port}"
+                # Com vários workers o PID é do supervisor: a memória por sessão não se aplica
+                pid = processes[-1].pid if args.workers == 1 else None
+            report = asyncio.run(run_load(args, pid))
+        finally:
+            for process in reversed(processes):
+                process.send_signal(signal.SIGINT)
+                process.wait(timeout=15)
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
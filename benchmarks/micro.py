@@ -0,0 +1,167 @@
+"""
+Microbenchmarks das partes quentes do backend
+
+Mede extract_lead_data, os validadores, a extração local de campos, o
+índice de áreas, o filtro do bloco [LEAD_DATA] no streaming e o lead store (SQLite).
+
+    python benchmarks/micro.py
+    python benchmarks/micro.py --json baseline.json
+    python benchmarks/micro.py --compare baseline.json --threshold 0.2
+
+Com --compare o script termina com código 1 se algum caso ficar mais lento
+que a linha de base além do limite.
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+WORKDIR = tempfile.TemporaryDirectory()
+os.environ.setdefault("LEADS_DB_PATH", str(Path(WORKDIR.name) / "leads.db"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from backend import main  # noqa: E402
+
+RESPONSE_WITH_LEAD = (
+    "Perfect, our team will be in touch shortly.\n[LEAD_DATA]\n"
+    + json.dumps({
+        "nome": "Ana Silva", "whatsapp": "07700900123", "email": "ana@example.com",
+        "tipo_interesse": "buy", "orcamento": "£650k", "postcode": "SW1A 1AA",
+        "detalhes_adicionais": "2 bed flat, close to the tube",
+    })
+    + "\n[/LEAD_DATA]"
+)
+RESPONSE_PLAIN = "Lovely! Which areas of London are you considering, and what is your budget? " * 3
+CLIENT_MESSAGE = "Hi, my name is Ana, I want to buy in SW1A 1AA, budget £650k, email ana@example.com"
+
+
+def sample_lead(index: int) -> dict:
+    return {
+        "timestamp": f"2024-06-{index % 28 + 1:02d}T10:00:00",
+        "nome": f"Client {index}",
+        "whatsapp": f"07700{index % 1000000:06d}",
+        "email": f"client{index}@example.com",
+        "tipo_interesse": ("buy", "rent", "sell")[index % 3],
+        "orcamento": f"£{300 + index % 900}k",
+        "postcode": f"{('SW', 'E', 'N', 'NW', 'SE')[index % 5]}{index % 20 + 1} {index % 9 + 1}AB",
+        "detalhes_adicionais": "",
+        "email_valido": "Yes",
+        "postcode_valido": "Yes" if index % 10 else "No",
+        "distrito": f"{('SW', 'E', 'N', 'NW', 'SE')[index % 5]}{index % 20 + 1}",
+        "borough": ("Westminster", "Tower Hamlets", "Islington", "Camden", "Southwark")[index % 5],
+        "zona": str(index % 3 + 1),
+    }
+
+
+LEAD_BATCH = [sample_lead(i) for i in range(1000)]
+
+
+def stream_filter():
+    lead_filter = main.LeadBlockFilter()
+    for start in range(0, len(RESPONSE_WITH_LEAD), 12):
+        lead_filter.feed(RESPONSE_WITH_LEAD[start:start + 12])
+    lead_filter.finish()
+    return lead_filter.lead_block()
+
+
+def store_cases(rows: int) -> dict:
+    """Casos do lead store sobre um banco com `rows` leads"""
+    store = main.SQLiteLeadStore(Path(WORKDIR.name) / "bench.db", fsync="normal")
+    store.open()
+    main.rollup_leads(store)
+    batch_size = 500
+    for start in range(0, rows, batch_size):
+        store.save_many([sample_lead(i) for i in range(start, min(rows, start + batch_size))])
+
+    counter = iter(range(rows, rows * 100))
+    batch = [sample_lead(i) for i in range(100)]
+    dedupe = main.LeadDedupeIndex()
+    dedupe.load(store)
+    return {
+        "store.save": lambda: store.save(sample_lead(next(counter))),
+        "store.save_many(100)": lambda: store.save_many(batch),
+        "store.count": store.count,
+        "store.interest_counts": store.interest_counts,
+        "store.rollups": store.rollups,
+        "store.query_leads(page)": lambda: store.query_leads({}, 100),
+        "store.query_leads(postcode_area)": lambda: store.query_leads({"postcode_area": "SW1"}, 100),
+        "store.query_leads(borough)": lambda: store.query_leads({"borough": "Westminster"}, 100),
+        "store.query_leads(interest+valid)": lambda: store.query_leads({"tipo_interesse": "rent", "valid": "no"}, 100),
+        "store.iter_leads(1000)": lambda: sum(1 for _ in zip(range(1000), store.iter_leads())),
+        "store.merge_many(100 repeats)": lambda: store.merge_many(batch, dedupe),
+    }
+
+
+def cases(rows: int) -> dict:
+    extractor = main.LeadFieldExtractor()
+    result = {
+        "extract_lead_data(lead)": lambda: main.extract_lead_data(RESPONSE_WITH_LEAD),
+        "extract_lead_data(plain)": lambda: main.extract_lead_data(RESPONSE_PLAIN),
+        "validate_uk_postcode(valid)": lambda: main.validate_uk_postcode("SW1A 1AA"),
+        "validate_uk_postcode(invalid)": lambda: main.validate_uk_postcode("NOT A POSTCODE"),
+        "validate_email": lambda: main.validate_email("ana.silva+homes@example.co.uk"),
+        "validate_lead_data": lambda: main.validate_lead_data({"email": "ana@example.com", "postcode": "SW1A 1AA"}),
+        "check_lead_fields": lambda: main.check_lead_fields({"email": "ana@example.com", "postcode": "sw1a1aa"}),
+        "validate_leads(1000)": lambda: sum(1 for _ in main.validate_leads(LEAD_BATCH)),
+        "lead_extractor.scan": lambda: extractor.scan(CLIENT_MESSAGE),
+        "area_index.lookup": lambda: main.area_index.lookup("SW1A 1AA"),
+        "area_index.mentions": lambda: main.area_index.mentions(CLIENT_MESSAGE),
+        "dedupe_keys": lambda: main.dedupe_keys(LEAD_BATCH[0]),
+        "lead_rollup_buckets": lambda: main.lead_rollup_buckets(LEAD_BATCH[0]),
+        "LeadBlockFilter(stream)": stream_filter,
+    }
+    result.update(store_cases(rows))
+    return result
+
+
+def measure(func, repeat: int) -> float:
+    """Melhor tempo por chamada (segundos) entre `repeat` rodadas"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Microbenchmarks do backend")
+    parser.add_argument("--rows", type=int, default=20000, help="leads no banco dos casos do store")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="só os casos que contêm este texto")
+    parser.add_argument("--json", help="grava os resultados (µs por chamada) neste arquivo")
+    parser.add_argument("--compare", help="arquivo JSON de uma rodada anterior")
+    parser.add_argument("--threshold", type=float, default=0.2, help="piora tolerada no --compare (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else {}
+    results = {}
+    regressions = []
+    print(f"{'case':<36} {'µs/op':>10} {'ops/s':>12} {'vs base':>9}")
+    for name, func in cases(args.rows).items():
+        if args.filter not in name:
+            continue
+        micros = measure(func, args.repeat) * 1e6
+        results[name] = round(micros, 3)
+        change = ""
+        if name in baseline and baseline[name]:
+            ratio = micros / baseline[name] - 1
+            change = f"{ratio:+.0%}"
+            if ratio > args.threshold:
+                regressions.append(name)
+                change += " !"
+        print(f"{name:<36} {micros:>10.2f} {1e6 / micros:>12,.0f} {change:>9}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+    if regressions:
+        print(f"\nRegressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,166 @@
+"""
+Mock local da API do Gemini para benchmarks e testes de carga
+
+Responde generateContent, streamGenerateContent (SSE) e cachedContents com
+latência, streaming e injeção de erros configuráveis por variáveis de ambiente:
+
+    MOCK_LATENCY_MS        latência base de cada resposta (padrão 300)
+    MOCK_JITTER_MS         variação aleatória somada à latência (padrão 100)
+    MOCK_STREAM_CHUNK      caracteres por trecho no streaming (padrão 12)
+    MOCK_STREAM_DELAY_MS   intervalo entre trechos no streaming (padrão 20)
+    MOCK_ERROR_RATE        fração de respostas 429 (padrão 0)
+    MOCK_5XX_RATE          fração de respostas 503 (padrão 0)
+    MOCK_QUOTA_RPS         cota de requisições por segundo; acima dela, 429 (padrão 0 = sem cota)
+
+Quando as mensagens do cliente já trazem e-mail e postcode, a resposta
+termina com um bloco [LEAD_DATA], como o modelo real faz.
+
+    python -m uvicorn benchmarks.mock_gemini:app --port 9100
+"""
+
+import os
+import re
+import json
+import time
+import random
+import asyncio
+from typing import Optional
+from collections import deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY = float(os.environ.get("MOCK_LATENCY_MS", "300")) / 1000
+JITTER = float(os.environ.get("MOCK_JITTER_MS", "100")) / 1000
+STREAM_CHUNK = int(os.environ.get("MOCK_STREAM_CHUNK", "12"))
+STREAM_DELAY = float(os.environ.get("MOCK_STREAM_DELAY_MS", "20")) / 1000
+ERROR_RATE = float(os.environ.get("MOCK_ERROR_RATE", "0"))
+SERVER_ERROR_RATE = float(os.environ.get("MOCK_5XX_RATE", "0"))
+QUOTA_RPS = float(os.environ.get("MOCK_QUOTA_RPS", "0"))
+
+EMAIL_RE = re.compile(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}")
+POSTCODE_RE = re.compile(r"\b[A-Z]{1,2}[0-9][A-Z0-9]?\s*[0-9][A-Z]{2}\b", re.IGNORECASE)
+MOBILE_RE = re.compile(r"(?:\+44\s?7|07)\d{3}\s?\d{3}\s?\d{3}")
+BUDGET_RE = re.compile(r"£\s?\d[\d,.]*\s?(?:k|m)?", re.IGNORECASE)
+NAME_RE = re.compile(r"(?i:my name is)\s+([A-Z][a-z]+)")
+
+REPLIES = [
+    "Lovely to hear from you! Are you looking to buy, rent or sell a property in London?",
+    "Wonderful. Which areas of London are you considering, and what is your budget?",
+    "That sounds like a great choice. May I take your name and the best email to reach you?",
+    "Thank you! And could you share your WhatsApp number and the postcode you're interested in?",
+    "Perfect, our team will be in touch shortly with some options that match what you need.",
+]
+
+app = FastAPI(title="Gemini mock")
+stats = {"generate": 0, "stream": 0, "cache": 0, "throttled": 0, "errors": 0}
+recent: deque = deque()
+
+
+def user_texts(payload: dict) -> list:
+    return [
+        "".join(part.get("text", "") for part in message.get("parts", []))
+        for message in payload.get("contents", [])
+        if message.get("role") == "user"
+    ]
+
+
+def reply_for(payload: dict) -> str:
+    """Resposta roteirizada pelo número de turnos; fecha com [LEAD_DATA] quando possível"""
+    texts = user_texts(payload)
+    conversation = "\n".join(texts)
+    email = EMAIL_RE.search(conversation)
+    postcode = POSTCODE_RE.search(conversation)
+    if email and postcode:
+        mobile = MOBILE_RE.search(conversation)
+        budget = BUDGET_RE.search(conversation)
+        name = NAME_RE.search(conversation)
+        intent = next((word for word in ("rent", "sell", "buy") if word in conversation.lower()), "buy")
+        lead = {
+            "nome": name.group(1) if name else "",
+            "whatsapp": mobile.group(0) if mobile else "",
+            "email": email.group(0),
+            "tipo_interesse": intent,
+            "orcamento": budget.group(0) if budget else "",
+            "postcode": postcode.group(0),
+            "detalhes_adicionais": "",
+        }
+        return REPLIES[-1] + "\n[LEAD_DATA]\n" + json.dumps(lead, ensure_ascii=False) + "\n[/LEAD_DATA]"
+    return REPLIES[min(len(texts), len(REPLIES)) - 1] if texts else REPLIES[0]
+
+
+def usage_for(payload: dict, text: str) -> dict:
+    prompt_chars = len(json.dumps(payload.get("contents", [])))
+    return {"promptTokenCount": prompt_chars // 4, "candidatesTokenCount": len(text) // 4}
+
+
+def injected_error() -> Optional[JSONResponse]:
+    """Cota por segundo e erros aleatórios, como o Gemini sob carga"""
+    if QUOTA_RPS:
+        now = time.monotonic()
+        while recent and now - recent[0] > 1:
+            recent.popleft()
+        if len(recent) >= QUOTA_RPS:
+            stats["throttled"] += 1
+            return JSONResponse({"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}},
+                                status_code=429, headers={"Retry-After": "1"})
+        recent.append(now)
+    roll = random.random()
+    if roll < ERROR_RATE:
+        stats["throttled"] += 1
+        return JSONResponse({"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}, status_code=429)
+    if roll < ERROR_RATE + SERVER_ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"code": 503, "status": "UNAVAILABLE"}}, status_code=503)
+    return None
+
+
+@app.post("/v1beta/models/{model_action}")
+async def generate(model_action: str, request: Request):
+    payload = await request.json()
+    error = injected_error()
+    if error is not None:
+        return error
+
+    text = reply_for(payload)
+    usage = usage_for(payload, text)
+    delay = LATENCY + random.uniform(0, JITTER)
+
+    if model_action.endswith(":streamGenerateContent"):
+        stats["stream"] += 1
+
+        async def events():
+            await asyncio.sleep(delay)
+            for start in range(0, len(text), STREAM_CHUNK):
+                chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": text[start:start + STREAM_CHUNK]}]}}]}
+                if start + STREAM_CHUNK >= len(text):
+                    chunk["usageMetadata"] = usage
+                yield f"data: {json.dumps(chunk)}\r\n\r\n"
+                await asyncio.sleep(STREAM_DELAY)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    stats["generate"] += 1
+    await asyncio.sleep(delay)
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+        "usageMetadata": usage,
+    }
+
+
+@app.post("/v1beta/cachedContents")
+async def create_cache(request: Request):
+    await request.json()
+    stats["cache"] += 1
+    expire = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600))
+    return {"name": f"cachedContents/mock-{stats['cache']}", "expireTime": expire}
+
+
+@app.delete("/v1beta/cachedContents/{name}")
+async def delete_cache(name: str):
+    return {}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
@@ -15,6 +15,7 @@ class PropertyChatWidget {
         this.leadNotification = document.getElementById('lead-notification');
 
         this.conversationHistory = [];
+        this.sessionId = null;
         this.isOpen = false;
         this.isLoading = false;
 
@@ -74,13 +75,29 @@ class PropertyChatWidget {
         this.isLoading = true;
 
         try {
-            const response = await this.sendMessage(message);
+            // Render tokens as they arrive
+            let streamedText = '';
+            let botElement = null;
+
+            const response = await this.sendMessage(message, (text) => {
+                if (!botElement) {
+                    this.hideTypingIndicator();
+                    botElement = this.addMessage('', 'bot');
+                }
+                streamedText += text;
+                botElement.innerHTML = this.formatMessage(streamedText);
+                this.scrollToBottom();
+            });
 
             // Remove typing indicator
             this.hideTypingIndicator();
 
             // Add bot response to UI
-            this.addMessage(response.response, 'bot');
+            if (botElement) {
+                botElement.innerHTML = this.formatMessage(response.response);
+            } else {
+                this.addMessage(response.response, 'bot');
+            }
 
             // Add to conversation history
             this.conversationHistory.push({
@@ -102,23 +119,85 @@ class PropertyChatWidget {
         this.isLoading = false;
     }
 
-    async sendMessage(message) {
-        const response = await fetch('/api/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
+    async sendMessage(message, onToken) {
+        // With a server-side session only the new message is sent
+        let response = await this.postMessage(this.sessionId
+            ? { message: message, session_id: this.sessionId }
+            : { message: message, conversation_history: this.previousHistory() });
+
+        // Session expired on the server: resend the full history once
+        if (response.status === 409) {
+            this.sessionId = null;
+            response = await this.postMessage({
                 message: message,
-                conversation_history: this.conversationHistory
-            })
-        });
+                conversation_history: this.previousHistory()
+            });
+        }
 
         if (!response.ok) {
             throw new Error('Failed to send message');
         }
 
-        return response.json();
+        let data = null;
+        await this.readEvents(response, (event, payload) => {
+            if (event === 'token') {
+                onToken(payload.text);
+            } else if (event === 'done') {
+                data = payload;
+            } else if (event === 'error') {
+                throw new Error(payload.detail);
+            }
+        });
+
+        if (!data) {
+            throw new Error('Stream ended unexpectedly');
+        }
+
+        this.sessionId = data.session_id || null;
+        return data;
+    }
+
+    async readEvents(response, onEvent) {
+        // Minimal Server-Sent Events parser over a fetch() body
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let event = 'message';
+                let data = '';
+                block.split('\n').forEach((line) => {
+                    if (line.startsWith('event:')) event = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+
+                if (data) onEvent(event, JSON.parse(data));
+            }
+        }
+    }
+
+    postMessage(body) {
+        return fetch('/api/chat/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(body)
+        });
+    }
+
+    previousHistory() {
+        // The current message is already the last history entry
+        return this.conversationHistory.slice(0, -1);
     }
 
     addMessage(content, sender) {
@@ -151,6 +230,8 @@ class PropertyChatWidget {
 
         this.chatMessages.appendChild(messageDiv);
         this.scrollToBottom();
+
+        return messageDiv.querySelector('p');
     }
 
     showTypingIndicator() {
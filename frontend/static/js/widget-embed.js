@@ -432,6 +432,7 @@
             this.iconClose = document.getElementById('lpa-icon-close');
 
             this.conversationHistory = [];
+            this.sessionId = null;
             this.isOpen = false;
             this.isLoading = false;
 
@@ -474,19 +475,51 @@
             this.isLoading = true;
 
             try {
-                const response = await fetch(`${config.apiUrl}/api/chat`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        message: message,
-                        conversation_history: this.conversationHistory
-                    })
+                // With a server-side session only the new message is sent
+                const previous = this.conversationHistory.slice(0, -1);
+                let response = await this.postMessage(this.sessionId
+                    ? { message: message, session_id: this.sessionId }
+                    : { message: message, conversation_history: previous });
+
+                // Session expired on the server: resend the full history once
+                if (response.status === 409) {
+                    this.sessionId = null;
+                    response = await this.postMessage({ message: message, conversation_history: previous });
+                }
+
+                if (!response.ok) throw new Error('Failed to send message');
+
+                // Render tokens as they arrive
+                let data = null;
+                let streamedText = '';
+                let botElement = null;
+
+                await this.readEvents(response, (event, payload) => {
+                    if (event === 'token') {
+                        if (!botElement) {
+                            this.hideTyping();
+                            botElement = this.addMessage('', 'bot');
+                        }
+                        streamedText += payload.text;
+                        botElement.innerHTML = this.formatMessage(streamedText);
+                        this.messages.scrollTop = this.messages.scrollHeight;
+                    } else if (event === 'done') {
+                        data = payload;
+                    } else if (event === 'error') {
+                        throw new Error(payload.detail);
+                    }
                 });
 
-                const data = await response.json();
+                if (!data) throw new Error('Stream ended unexpectedly');
+
+                this.sessionId = data.session_id || null;
                 this.hideTyping();
 
-                this.addMessage(data.response, 'bot');
+                if (botElement) {
+                    botElement.innerHTML = this.formatMessage(data.response);
+                } else {
+                    this.addMessage(data.response, 'bot');
+                }
                 this.conversationHistory.push({ role: 'assistant', content: data.response });
 
                 if (data.lead_captured) {
@@ -500,6 +533,42 @@
             this.isLoading = false;
         }
 
+        async readEvents(response, onEvent) {
+            // Minimal Server-Sent Events parser over a fetch() body
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const block = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let event = 'message';
+                    let data = '';
+                    block.split('\n').forEach((line) => {
+                        if (line.startsWith('event:')) event = line.slice(6).trim();
+                        else if (line.startsWith('data:')) data += line.slice(5).trim();
+                    });
+
+                    if (data) onEvent(event, JSON.parse(data));
+                }
+            }
+        }
+
+        postMessage(body) {
+            return fetch(`${config.apiUrl}/api/chat/stream`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(body)
+            });
+        }
+
         addMessage(content, sender) {
             const div = document.createElement('div');
             div.className = `lpa-message lpa-${sender}`;
@@ -517,6 +586,8 @@
 
             this.messages.appendChild(div);
             this.messages.scrollTop = this.messages.scrollHeight;
+
+            return div.querySelector('.lpa-message-content');
         }
 
         formatMessage(content) {
@@ -1,2 +1,7 @@
 #!/bin/bash
-exec python -m uvicorn backend.main:app --host 0.0.0.0 --port ${PORT:-8000}
+# WEB_CONCURRENCY > 1 sobe vários workers (estado compartilhado em SQLite, veja o README).
+# No SIGTERM o uvicorn para de aceitar conexões e espera as requisições em curso
+# por até DRAIN_TIMEOUT_SECONDS antes de encerrar os workers.
+exec python -m uvicorn backend.main:app --host 0.0.0.0 --port ${PORT:-8000} \
+    --workers ${WEB_CONCURRENCY:-1} \
+    --timeout-graceful-shutdown ${DRAIN_TIMEOUT_SECONDS:-20}
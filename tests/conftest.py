@@ -0,0 +1,22 @@
+"""
+Configuração comum dos testes
+
+O backend lê a configuração do ambiente na importação: os bancos vão para um
+diretório temporário e o Gemini aponta para um endereço que não responde
+(cada teste injeta o seu stub).
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+WORKDIR = tempfile.TemporaryDirectory()
+
+os.environ.setdefault("LEADS_DB_PATH", str(Path(WORKDIR.name) / "leads.db"))
+os.environ.setdefault("STATE_DB_PATH", str(Path(WORKDIR.name) / "state.db"))
+os.environ.setdefault("GEMINI_API_BASE", "http://127.0.0.1:9/v1beta")
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+sys.path.insert(0, str(ROOT))
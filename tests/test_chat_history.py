@@ -0,0 +1,98 @@
+"""Estado da sessão (resumo e campos extraídos) quando o Gemini falha no meio da conversa"""
+
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import main
+from backend.main import ChatMessage, UpstreamUnavailable
+
+
+@pytest.fixture
+def small_budget(monkeypatch):
+    monkeypatch.setitem(main.HISTORY_CONFIG, "token_budget", 60)
+    monkeypatch.setitem(main.HISTORY_CONFIG, "keep_messages", 2)
+    monkeypatch.setitem(main.HISTORY_CONFIG, "summary_tokens", 2000)
+    monkeypatch.setitem(main.CHAT_LIMIT_CONFIG, "per_session", 1000)
+
+
+def history(turns: int) -> list:
+    messages = []
+    for index in range(turns):
+        messages.append({"role": "user", "content": f"Question number {index} about flats in Camden and Islington"})
+        messages.append({"role": "assistant", "content": f"Answer number {index} with some details about the area"})
+    return messages
+
+
+def test_busy_replies_do_not_duplicate_summary(small_budget, monkeypatch):
+    replies = []
+
+    async def gemini(contents):
+        if replies:
+            return replies.pop(0)
+        raise UpstreamUnavailable("queue_deadline", 1)
+
+    monkeypatch.setattr(main, "call_gemini_api", gemini)
+
+    async def scenario():
+        first = await main.chat(ChatMessage(message="hello", conversation_history=history(4)))
+        session_id = first.session_id
+        assert first.retry_after
+        for _ in range(2):
+            reply = await main.chat(ChatMessage(message="hello", session_id=session_id))
+            assert reply.retry_after
+            session = await main.session_store.get(session_id)
+            assert not session.get("summary")
+
+        replies.append("Sure, happy to help.")
+        reply = await main.chat(ChatMessage(message="hello", session_id=session_id))
+        assert reply.retry_after is None
+        session = await main.session_store.get(session_id)
+        summary = session["summary"]
+        assert summary
+        assert len(summary) == len(set(summary))
+        # Os turnos resumidos saem do histórico literal
+        assert len(session["contents"]) < 9
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("path", ["/api/chat", "/api/chat/stream"])
+@pytest.mark.parametrize("entry", [{"role": "user"}, {"content": "hi"}, "hi", {"role": "user", "content": 3}])
+def test_malformed_history_is_rejected(path, entry):
+    client = TestClient(main.app)
+    response = client.post(path, json={"message": "hello", "conversation_history": [entry]})
+    assert response.status_code == 422
+    assert response.json() == {"detail": "invalid_conversation_history"}
+
+
+def test_failed_turns_do_not_advance_extracted_fields(monkeypatch):
+    outcomes = ["Hi!", UpstreamUnavailable("queue_deadline", 1), RuntimeError("upstream reset"), "Thanks, Ana!"]
+
+    async def gemini(contents):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(main, "call_gemini_api", gemini)
+    monkeypatch.setitem(main.CHAT_LIMIT_CONFIG, "per_session", 1000)
+    message = "My email is ana@example.com"
+
+    async def scenario():
+        first = await main.chat(ChatMessage(message="hello", conversation_history=history(1)))
+        session_id = first.session_id
+        # Busy e erro: a mensagem não entra no estado extraído da sessão
+        assert (await main.chat(ChatMessage(message=message, session_id=session_id))).retry_after
+        with pytest.raises(main.HTTPException):
+            await main.chat(ChatMessage(message=message, session_id=session_id))
+        session = await main.session_store.get(session_id)
+        assert "email" not in session.get("extracted", {})
+
+        reply = await main.chat(ChatMessage(message=message, session_id=session_id))
+        assert reply.retry_after is None
+        session = await main.session_store.get(session_id)
+        assert session["extracted"]["email"] == "ana@example.com"
+
+    asyncio.run(scenario())
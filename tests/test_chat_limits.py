@@ -0,0 +1,60 @@
+"""IP do cliente atrás de proxy e limite de tamanho do corpo do chat"""
+
+import pytest
+from starlette.requests import Request
+from fastapi.testclient import TestClient
+
+from backend import main
+
+
+def request_from(peer: str, forwarded: str = None) -> Request:
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 1234)})
+
+
+@pytest.mark.parametrize("hops, forwarded, expected", [
+    (0, "198.51.100.1", "10.0.0.1"),
+    (1, None, "10.0.0.1"),
+    (1, "203.0.113.7", "203.0.113.7"),
+    # Entradas à esquerda vêm do cliente: não servem para escapar do limite
+    (1, "198.51.100.1, 203.0.113.7", "203.0.113.7"),
+    (2, "198.51.100.1, 203.0.113.7, 192.0.2.10", "203.0.113.7"),
+    (3, "203.0.113.7", "203.0.113.7"),
+])
+def test_client_ip(monkeypatch, hops, forwarded, expected):
+    monkeypatch.setitem(main.CHAT_LIMIT_CONFIG, "trusted_proxy_hops", hops)
+    assert main.client_ip(request_from("10.0.0.1", forwarded)) == expected
+
+
+def chunked_body(size: int):
+    yield b'{"message": "'
+    for _ in range(size // 1000):
+        yield b"a" * 1000
+    yield b'"}'
+
+
+@pytest.mark.parametrize("path", ["/api/chat", "/api/chat/stream"])
+def test_chunked_body_over_limit_is_rejected(path):
+    client = TestClient(main.app)
+    size = main.CHAT_LIMIT_CONFIG["max_body_bytes"] + 10_000
+    response = client.post(path, content=chunked_body(size), headers={"content-type": "application/json"})
+    assert response.status_code == 413
+    assert response.json() == {"detail": "request_too_large"}
+
+
+def test_content_length_over_limit_is_rejected():
+    client = TestClient(main.app)
+    body = b'{"message": "' + b"a" * main.CHAT_LIMIT_CONFIG["max_body_bytes"] + b'"}'
+    response = client.post("/api/chat", content=body, headers={"content-type": "application/json"})
+    assert response.status_code == 413
+
+
+def test_rejections_are_counted_in_request_metrics():
+    client = TestClient(main.app)
+    size = main.CHAT_LIMIT_CONFIG["max_body_bytes"] + 10_000
+    before = main.HTTP_REQUESTS.values.get(("/api/chat/stream", "POST", "413"), 0)
+    response = client.post("/api/chat/stream", content=chunked_body(size), headers={"content-type": "application/json"})
+    assert response.status_code == 413
+    # O 413 do ChatBodyLimit passa pelo middleware de métricas, que é o mais externo
+    assert main.HTTP_REQUESTS.values[("/api/chat/stream", "POST", "413")] == before + 1
+    assert main.app.user_middleware[0].kwargs["dispatch"] is main.record_request_metrics
@@ -0,0 +1,77 @@
+"""Streaming do chat: o lead do bloco [LEAD_DATA] é salvo mesmo se o cliente cair antes do fim"""
+
+import asyncio
+import json
+import time
+
+from backend import main
+
+LEAD = {
+    "nome": "Ana Silva",
+    "whatsapp": "07700900123",
+    "email": "ana@example.com",
+    "tipo_interesse": "rent",
+    "orcamento": "£2000 pcm",
+    "postcode": "SW1A 1AA",
+}
+
+
+def test_lead_is_saved_when_client_disconnects_after_block(monkeypatch):
+    saved = []
+
+    async def process_lead(lead_data):
+        await asyncio.sleep(0)
+        saved.append(lead_data)
+        return None
+
+    monkeypatch.setattr(main, "process_lead", process_lead)
+
+    async def scenario():
+        finished = asyncio.Event()
+
+        async def chunks():
+            yield "Thanks, Ana! "
+            yield "[LEAD_DATA]" + json.dumps(LEAD)
+            yield "[/LEAD_DATA]"
+            # O modelo ainda não terminou quando o cliente desconecta
+            await finished.wait()
+
+        session = {"contents": [], "extracted": {}}
+        stream = main.chat_event_stream("session", session, [], chunks(), time.perf_counter())
+
+        async def consume():
+            return [event async for event in stream]
+
+        task = asyncio.create_task(consume())
+        for _ in range(20):
+            await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert [lead["email"] for lead in saved] == ["ana@example.com"]
+
+
+def test_done_event_reports_the_captured_lead(monkeypatch):
+    saved = []
+
+    async def process_lead(lead_data):
+        saved.append(lead_data)
+        return ["Invalid postcode: X"]
+
+    monkeypatch.setattr(main, "process_lead", process_lead)
+
+    async def chunks():
+        yield "Thanks! [LEAD_DATA]" + json.dumps(LEAD) + "[/LEAD_DATA]"
+
+    async def scenario():
+        session = {"contents": [], "extracted": {}}
+        stream = main.chat_event_stream("session", session, [], chunks(), time.perf_counter())
+        return [event async for event in stream]
+
+    events = asyncio.run(scenario())
+    done = json.loads(events[-1].split("data: ", 1)[1])
+    assert done["response"] == "Thanks!"
+    assert done["lead_captured"] is True
+    assert done["validation_errors"] == ["Invalid postcode: X"]
+    assert len(saved) == 1
@@ -0,0 +1,119 @@
+"""cachedContent do SYSTEM_PROMPT: criação, mínimo de tokens e volta às instruções inline"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from backend import main
+from backend.main import SystemPromptCache
+
+
+class StubGemini:
+    """Respostas por sufixo do caminho e registro das requisições recebidas"""
+
+    def __init__(self):
+        self.requests = []
+        self.routes = {}
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        for suffix, respond in self.routes.items():
+            if request.url.path.endswith(suffix):
+                return respond(request)
+        return httpx.Response(404)
+
+    def payloads(self, suffix: str) -> list:
+        return [json.loads(request.content) for request in self.requests if request.url.path.endswith(suffix)]
+
+
+@pytest.fixture
+def stub_gemini(monkeypatch):
+    stub = StubGemini()
+    pool = main.GeminiHTTPPool(main.GEMINI_HTTP_CONFIG)
+    pool.client = httpx.AsyncClient(transport=httpx.MockTransport(stub))
+    monkeypatch.setattr(main, "gemini_pool", pool)
+    return stub
+
+
+def cache_config(**overrides) -> dict:
+    config = dict(main.GEMINI_CONTEXT_CACHE_CONFIG, enabled=True, min_tokens=0, retry_after=600)
+    config.update(overrides)
+    return config
+
+
+def generated(text: str):
+    def respond(request):
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": text}]}}]})
+    return respond
+
+
+def test_disabled_by_default():
+    assert main.GEMINI_CONTEXT_CACHE_CONFIG["enabled"] is False
+    # Ativado, o prompt atual ficaria abaixo do mínimo e o cache nem seria tentado
+    assert not SystemPromptCache(dict(main.GEMINI_CONTEXT_CACHE_CONFIG, enabled=True)).usable()
+
+
+def test_prompt_below_minimum_never_calls_gemini(stub_gemini):
+    cache = SystemPromptCache(cache_config(min_tokens=100_000))
+
+    async def scenario():
+        assert await cache.get_name() is None
+        assert await cache.get_name() is None
+
+    asyncio.run(scenario())
+    assert stub_gemini.requests == []
+    assert cache.stats()["prompt_too_small"] is True
+
+
+def test_creates_and_reuses_cached_content(stub_gemini):
+    stub_gemini.routes["/cachedContents"] = lambda request: httpx.Response(200, json={"name": "cachedContents/abc"})
+    cache = SystemPromptCache(cache_config())
+
+    async def scenario():
+        assert await cache.get_name() == "cachedContents/abc"
+        assert await cache.get_name() == "cachedContents/abc"
+
+    asyncio.run(scenario())
+    assert len(stub_gemini.requests) == 1
+    assert cache.stats()["creations"] == 1
+    body = stub_gemini.payloads("/cachedContents")[0]
+    assert body["systemInstruction"]["parts"][0]["text"] == main.SYSTEM_PROMPT
+
+
+def test_creation_failure_falls_back_and_waits_before_retrying(stub_gemini):
+    stub_gemini.routes["/cachedContents"] = lambda request: httpx.Response(400, json={"error": "too small"})
+    cache = SystemPromptCache(cache_config())
+
+    async def scenario():
+        assert await cache.get_name() is None
+        assert await cache.get_name() is None
+
+    asyncio.run(scenario())
+    assert len(stub_gemini.requests) == 1
+    assert cache.stats()["failures"] == 1
+
+
+def test_rejected_cache_is_retried_inline(stub_gemini, monkeypatch):
+    """cachedContent removido no servidor: a chamada é refeita com o prompt inline"""
+    stub_gemini.routes["/cachedContents"] = lambda request: httpx.Response(200, json={"name": "cachedContents/gone"})
+
+    def generate(request):
+        if "cachedContent" in json.loads(request.content):
+            return httpx.Response(404, json={"error": "not found"})
+        return generated("Hello from inline")(request)
+
+    stub_gemini.routes[":generateContent"] = generate
+    cache = SystemPromptCache(cache_config())
+    monkeypatch.setattr(main, "system_prompt_cache", cache)
+
+    async def scenario():
+        messages = [{"role": "user", "parts": [{"text": "hi"}]}]
+        assert await main.generate_content(messages) == "Hello from inline"
+
+    asyncio.run(scenario())
+    payloads = stub_gemini.payloads(":generateContent")
+    assert "cachedContent" in payloads[0]
+    assert "systemInstruction" in payloads[1]
+    assert cache.name is None
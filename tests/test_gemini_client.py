@@ -0,0 +1,198 @@
+"""Cliente httpx compartilhado do Gemini contra um servidor local que imita a API"""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi import HTTPException
+
+from backend import main
+from backend.main import GeminiHTTPPool
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 com keep-alive; guarda a porta de origem de cada requisição"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.seen.append(("GET", self.path, self.client_address[1], None))
+        self.reply(200, json.dumps({"name": f"models/{main.GEMINI_MODEL}"}).encode())
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.seen.append(("POST", self.path, self.client_address[1], payload))
+        time.sleep(self.server.delay)
+        if self.server.status != 200:
+            self.reply(self.server.status, b'{"error": {"message": "bad request"}}')
+        elif ":streamGenerateContent" in self.path:
+            chunks = [{"candidates": [{"content": {"parts": [{"text": text}]}}]} for text in self.server.chunks]
+            body = "".join(f"data: {json.dumps(chunk)}\r\n\r\n" for chunk in chunks)
+            self.reply(200, body.encode(), "text/event-stream")
+        else:
+            self.reply(200, json.dumps({
+                "candidates": [{"content": {"parts": [{"text": self.server.text}]}}],
+                "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 3},
+            }).encode())
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGeminiHandler)
+    server.daemon_threads = True
+    server.seen = []
+    server.status = 200
+    server.delay = 0
+    server.text = "Olá!"
+    server.chunks = ["Olá", ", tudo bem?"]
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+
+    base = f"http://127.0.0.1:{server.server_address[1]}/v1beta"
+    model = f"{base}/models/{main.GEMINI_MODEL}"
+    monkeypatch.setattr(main, "GEMINI_API_BASE", base)
+    monkeypatch.setattr(main, "GEMINI_API_URL", f"{model}:generateContent?key={main.GOOGLE_API_KEY}")
+    monkeypatch.setattr(main, "GEMINI_STREAM_URL", f"{model}:streamGenerateContent?alt=sse&key={main.GOOGLE_API_KEY}")
+    monkeypatch.setattr(main, "gemini_scheduler", main.GeminiScheduler(dict(main.GEMINI_SCHEDULER_CONFIG)))
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(dict(main.RESPONSE_CACHE_CONFIG, enabled=False)))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def pool_config(**overrides) -> dict:
+    config = dict(main.GEMINI_HTTP_CONFIG, http2=False)
+    config.update(overrides)
+    return config
+
+
+def messages(text: str) -> list:
+    return [{"role": "user", "parts": [{"text": text}]}]
+
+
+def test_post_reuses_one_connection(fake_gemini):
+    pool = GeminiHTTPPool(pool_config())
+
+    async def scenario():
+        for _ in range(3):
+            response = await pool.post(main.GEMINI_API_URL, json={"contents": []})
+            assert response.status_code == 200
+        stats = pool.stats()
+        await pool.aclose()
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert len({port for _, _, port, _ in fake_gemini.seen}) == 1
+    assert stats["requests_total"] == 3
+    assert stats["connections"] == 1
+    assert stats["idle"] == 1
+    assert stats["in_flight"] == 0
+    assert pool.client is None
+
+
+def test_saturated_pool_counts_waits(fake_gemini):
+    pool = GeminiHTTPPool(pool_config(max_connections=1, max_keepalive_connections=1))
+    fake_gemini.delay = 0.2
+
+    async def scenario():
+        calls = [asyncio.create_task(pool.post(main.GEMINI_API_URL, json={"contents": []})) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        during = pool.stats()
+        await asyncio.gather(*calls)
+        after = pool.stats()
+        await pool.aclose()
+        return during, after
+
+    during, after = asyncio.run(scenario())
+    # A segunda chamada espera a única conexão do pool
+    assert during["in_use"] == 1
+    assert during["in_flight"] == 2
+    assert after["waits_total"] == 1
+    assert after["in_use"] == 0 and after["in_flight"] == 0
+    assert after["requests_total"] == 2
+
+
+def test_preconnect_leaves_connection_for_first_call(fake_gemini):
+    pool = GeminiHTTPPool(pool_config())
+
+    async def scenario():
+        await pool.preconnect()
+        assert pool.stats()["connections"] == 1
+        await pool.post(main.GEMINI_API_URL, json={"contents": []})
+        await pool.aclose()
+
+    asyncio.run(scenario())
+    [(get, get_path, get_port, _), (post, _, post_port, _)] = fake_gemini.seen
+    assert (get, post) == ("GET", "POST")
+    assert get_path.startswith(f"/v1beta/models/{main.GEMINI_MODEL}?key=")
+    assert get_port == post_port
+
+
+def test_call_gemini_api_goes_through_shared_pool(fake_gemini, monkeypatch):
+    pool = GeminiHTTPPool(pool_config())
+    monkeypatch.setattr(main, "gemini_pool", pool)
+
+    async def scenario():
+        first = await main.call_gemini_api(messages("Quero alugar em Londres"))
+        second = await main.call_gemini_api(messages("E em Manchester?"))
+        await pool.aclose()
+        return first, second
+
+    assert asyncio.run(scenario()) == ("Olá!", "Olá!")
+    posts = [entry for entry in fake_gemini.seen if entry[0] == "POST"]
+    assert len(posts) == 2
+    assert len({port for _, _, port, _ in posts}) == 1
+    assert posts[0][3]["contents"] == messages("Quero alugar em Londres")
+    assert "systemInstruction" in posts[0][3]
+
+
+def test_upstream_error_becomes_http_500(fake_gemini, monkeypatch):
+    pool = GeminiHTTPPool(pool_config())
+    monkeypatch.setattr(main, "gemini_pool", pool)
+    fake_gemini.status = 400
+
+    async def scenario():
+        try:
+            with pytest.raises(HTTPException) as error:
+                await main.generate_content(messages("Olá"))
+        finally:
+            await pool.aclose()
+        return error.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 500
+    assert pool.in_flight == 0
+
+
+def test_stream_yields_text_and_releases_connection(fake_gemini, monkeypatch):
+    pool = GeminiHTTPPool(pool_config())
+    monkeypatch.setattr(main, "gemini_pool", pool)
+
+    async def scenario():
+        response = await main.open_gemini_stream(messages("Olá"))
+        assert pool.in_flight == 1
+        try:
+            chunks = [text async for text in main.iter_gemini_stream(response)]
+        finally:
+            await pool.close_stream(response)
+        stats = pool.stats()
+        await pool.aclose()
+        return chunks, stats
+
+    chunks, stats = asyncio.run(scenario())
+    assert chunks == ["Olá", ", tudo bem?"]
+    assert stats["in_flight"] == 0
+    assert stats["connections"] == 1
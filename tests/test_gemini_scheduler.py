@@ -0,0 +1,214 @@
+"""Circuit breaker, token bucket e agrupamento de chamadas do GeminiScheduler"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from backend.main import GEMINI_SCHEDULER_CONFIG, GeminiScheduler, UpstreamUnavailable
+
+
+def scheduler(**overrides) -> GeminiScheduler:
+    config = dict(GEMINI_SCHEDULER_CONFIG)
+    config.update({
+        "max_concurrency": 4,
+        "rate_per_second": 0,
+        "burst": 1,
+        "max_retries": 0,
+        "retry_base": 0.01,
+        "retry_max": 0.01,
+        "queue_deadline": 1,
+        "breaker_threshold": 2,
+        "breaker_reset": 0.05,
+    })
+    config.update(overrides)
+    return GeminiScheduler(config)
+
+
+def reply(status: int):
+    async def send():
+        return httpx.Response(status)
+    return send
+
+
+async def open_breaker(s: GeminiScheduler):
+    for _ in range(s.config["breaker_threshold"]):
+        with pytest.raises(UpstreamUnavailable):
+            await s.run(reply(503))
+    assert s.stats()["breaker"] == "open"
+
+
+def test_breaker_opens_and_recovers_after_probe():
+    async def scenario():
+        s = scheduler()
+        await open_breaker(s)
+        with pytest.raises(UpstreamUnavailable, match="circuit_open"):
+            await s.run(reply(200))
+        await asyncio.sleep(0.06)
+        assert (await s.run(reply(200))).status_code == 200
+        assert s.stats()["breaker"] == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_failed_probe_reopens_breaker():
+    async def scenario():
+        s = scheduler()
+        await open_breaker(s)
+        await asyncio.sleep(0.06)
+        with pytest.raises(UpstreamUnavailable, match="upstream_503"):
+            await s.run(reply(503))
+        assert s.stats()["breaker"] == "open"
+        assert s.stats()["breaker_opens"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_probe_cancelled_waiting_for_token_releases_half_open():
+    async def scenario():
+        s = scheduler()
+        await open_breaker(s)
+        s.config["rate_per_second"] = 1
+        s._tokens = 0
+        await asyncio.sleep(0.06)
+        probe = asyncio.create_task(s.run(reply(200)))
+        await asyncio.sleep(0.01)
+        assert s.stats()["breaker"] == "half_open"
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert s.stats()["breaker"] == "open"
+        s.config["rate_per_second"] = 0
+        assert (await s.run(reply(200))).status_code == 200
+
+    asyncio.run(scenario())
+
+
+def test_probe_rejected_by_rate_limit_releases_half_open():
+    async def scenario():
+        s = scheduler(queue_deadline=0.5)
+        await open_breaker(s)
+        s.config["rate_per_second"] = 0.1
+        s._tokens = 0
+        await asyncio.sleep(0.06)
+        with pytest.raises(UpstreamUnavailable, match="rate_limited"):
+            await s.run(reply(200))
+        s.config["rate_per_second"] = 0
+        assert (await s.run(reply(200))).status_code == 200
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_spaces_calls():
+    async def scenario():
+        s = scheduler(rate_per_second=20, burst=1)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for _ in range(3):
+            await s.run(reply(200))
+        # Rajada de 1: a segunda e a terceira esperam 1/20 s cada
+        assert loop.time() - started >= 0.09
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_rejects_beyond_deadline():
+    async def scenario():
+        s = scheduler(rate_per_second=1, burst=1, queue_deadline=0.2)
+        await s.run(reply(200))
+        with pytest.raises(UpstreamUnavailable, match="rate_limited") as e:
+            await s.run(reply(200))
+        assert e.value.retry_after > 0
+
+    asyncio.run(scenario())
+
+
+def test_retries_until_success():
+    async def scenario():
+        s = scheduler(max_retries=2, breaker_threshold=5)
+        statuses = iter([429, 503, 200])
+
+        async def send():
+            return httpx.Response(next(statuses))
+
+        assert (await s.run(send)).status_code == 200
+        assert s.stats()["retries_total"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_shares_one_call():
+    async def scenario():
+        s = scheduler()
+        calls = 0
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "shared"
+
+        results = await asyncio.gather(*(s.coalesce("k", factory) for _ in range(5)))
+        assert results == ["shared"] * 5
+        assert calls == 1
+        assert s.stats()["coalesced_total"] == 4
+        assert s.stats()["coalescing"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_owner_cancel_keeps_other_waiters():
+    async def scenario():
+        s = scheduler()
+
+        async def factory():
+            await asyncio.sleep(0.05)
+            return "shared"
+
+        owner = asyncio.create_task(s.coalesce("k", factory))
+        await asyncio.sleep(0)
+        other = asyncio.create_task(s.coalesce("k", factory))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        assert await other == "shared"
+        assert owner.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_cancels_call_when_nobody_waits():
+    async def scenario():
+        s = scheduler()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def factory():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(s.coalesce("k", factory))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        assert s.stats()["coalescing"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_propagates_errors_to_all_waiters():
+    async def scenario():
+        s = scheduler()
+
+        async def factory():
+            await asyncio.sleep(0.01)
+            raise UpstreamUnavailable("upstream_503")
+
+        results = await asyncio.gather(*(s.coalesce("k", factory) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, UpstreamUnavailable) for r in results)
+
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+"""Stream de leads do painel: leads novos e leads atualizados por junção"""
+
+import asyncio
+import json
+import threading
+from pathlib import Path
+
+from backend import main
+from backend.main import LeadBroadcaster, LeadDedupeIndex, SQLiteLeadStore
+
+
+def lead(**fields) -> dict:
+    base = {
+        "timestamp": "2026-10-01T10:00:00",
+        "nome": "Ana",
+        "email": "ana@example.com",
+        "whatsapp": "07700900123",
+        "tipo_interesse": "buy",
+        "postcode": "SW1A 1AA",
+    }
+    base.update(fields)
+    return base
+
+
+def events(queue: asyncio.Queue) -> list:
+    found = []
+    while not queue.empty():
+        found.append(json.loads(queue.get_nowait().split("data: ", 1)[1]))
+    return found
+
+
+def test_pushes_new_and_merged_leads(tmp_path: Path):
+    store = SQLiteLeadStore(tmp_path / "leads.db")
+    store.open()
+    index = LeadDedupeIndex()
+    config = dict(main.LEAD_EVENTS_CONFIG, max_subscribers=5, queue_size=10)
+
+    async def scenario():
+        broadcaster = LeadBroadcaster(store, config)
+        store.merge_many([lead()], index)
+        queue = await broadcaster.subscribe()
+        # Já existia antes da conexão: não é repassado
+        await broadcaster._publish_new()
+        assert events(queue) == []
+
+        store.merge_many([lead(nome="Bob", email="bob@example.com", whatsapp="07700900999")], index)
+        await broadcaster._publish_new()
+        [event] = events(queue)
+        assert [row["nome"] for row in event["leads"]] == ["Bob"]
+        assert event["updated"] == []
+        assert event["totals"]["total"] == 2
+
+        # Lead repetido: atualiza a linha existente e chega como "updated"
+        store.merge_many([lead(tipo_interesse="rent", orcamento="£2000 pcm")], index)
+        await broadcaster._publish_new()
+        [event] = events(queue)
+        assert event["leads"] == []
+        assert [row["id"] for row in event["updated"]] == [1]
+        assert event["updated"][0]["orcamento"] == "£2000 pcm"
+        assert event["totals"]["total"] == 2
+
+        await broadcaster._publish_new()
+        assert events(queue) == []
+
+    asyncio.run(scenario())
+    store.close()
+
+
+def test_merge_of_unsent_lead_goes_as_new(tmp_path: Path):
+    store = SQLiteLeadStore(tmp_path / "leads.db")
+    store.open()
+    index = LeadDedupeIndex()
+
+    async def scenario():
+        broadcaster = LeadBroadcaster(store, dict(main.LEAD_EVENTS_CONFIG))
+        queue = await broadcaster.subscribe()
+        store.merge_many([lead()], index)
+        store.merge_many([lead(orcamento="£700k")], index)
+        await broadcaster._publish_new()
+        [event] = events(queue)
+        assert event["updated"] == []
+        assert [row["orcamento"] for row in event["leads"]] == ["£700k"]
+
+    asyncio.run(scenario())
+    store.close()
+
+
+def test_stats_read_rollups_off_the_loop(tmp_path: Path, monkeypatch):
+    store = SQLiteLeadStore(tmp_path / "leads.db")
+    store.open()
+    store.merge_many([lead(), lead(nome="Bob", email="bob@example.com", whatsapp="07700900999")], LeadDedupeIndex())
+    threads = []
+    rollups = store.rollups
+
+    def tracked_rollups():
+        threads.append(threading.get_ident())
+        return rollups()
+
+    monkeypatch.setattr(store, "rollups", tracked_rollups)
+    monkeypatch.setattr(main, "lead_store", store)
+
+    async def scenario():
+        stats = await main.get_lead_stats(days=30, weeks=12)
+        return stats, threading.get_ident()
+
+    stats, loop_thread = asyncio.run(scenario())
+    assert stats["total"] == 2
+    assert threads and threads[0] != loop_thread
+    store.close()
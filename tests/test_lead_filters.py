@@ -0,0 +1,65 @@
+"""Filtro de área do /api/leads no SQLite: área, distrito e subdistritos"""
+
+from pathlib import Path
+
+import pytest
+
+from backend.main import SQLiteLeadStore, area_index
+
+POSTCODES = ["SW1A 1AA", "SW11 1AA", "W1K 1AA", "W10 4AA", "EC1A 1BB", "E1 6AN"]
+
+
+@pytest.fixture
+def store(tmp_path: Path):
+    store = SQLiteLeadStore(tmp_path / "leads.db")
+    store.open()
+    leads = []
+    for number, postcode in enumerate(POSTCODES):
+        lead = {
+            "timestamp": "2026-10-01T10:00:00",
+            "nome": f"Client {number}",
+            "email": f"client{number}@example.com",
+            "whatsapp": f"0770090{number:04d}",
+            "tipo_interesse": "buy",
+            "postcode": postcode,
+            "email_valido": "Yes",
+            "postcode_valido": "Yes",
+        }
+        lead.update(area_index.lead_fields(postcode))
+        leads.append(lead)
+    store.save_many(leads)
+    yield store
+    store.close()
+
+
+def postcodes(store: SQLiteLeadStore, area: str) -> list:
+    return sorted(row["postcode"] for row in store.query_leads({"postcode_area": area}, 100))
+
+
+@pytest.mark.parametrize("area, expected", [
+    ("SW1", ["SW1A 1AA"]),
+    ("SW1A", ["SW1A 1AA"]),
+    ("sw11", ["SW11 1AA"]),
+    ("W1", ["W1K 1AA"]),
+    ("EC1", ["EC1A 1BB"]),
+    ("E1", ["E1 6AN"]),
+    ("SW", ["SW11 1AA", "SW1A 1AA"]),
+])
+def test_district_includes_lettered_subdistricts(store, area, expected):
+    assert postcodes(store, area) == expected
+
+
+@pytest.mark.parametrize("area, expected", [
+    ("SW1A 1AA", ["SW1A 1AA"]),
+    ("sw1a1aa", ["SW1A 1AA"]),
+    ("W1K 9ZZ", ["W1K 1AA"]),
+    ("E1 6AN", ["E1 6AN"]),
+])
+def test_full_postcode_filters_by_its_outward_code(store, area, expected):
+    assert postcodes(store, area) == expected
+
+
+def test_area_names_and_unknown_values(store):
+    assert postcodes(store, "Mayfair") == ["W1K 1AA"]
+    assert postcodes(store, "Battersea") == ["SW11 1AA"]
+    assert postcodes(store, "Atlantis") == []
@@ -0,0 +1,171 @@
+"""Outbox de notificações: entrega, reenvio com backoff e digest contra um SMTP falso"""
+
+import asyncio
+import socketserver
+import threading
+from pathlib import Path
+
+import pytest
+
+from backend import main
+from backend.main import NotificationOutbox, NotificationQueue
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Diálogo SMTP mínimo; as primeiras `server.failures` mensagens recebem 451"""
+
+    def reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self.reply("220 fake ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 fake")
+            elif command.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                body = []
+                while (data := self.rfile.readline()) not in (b".\r\n", b""):
+                    body.append(data)
+                if self.server.failures > 0:
+                    self.server.failures -= 1
+                    self.reply("451 try again later")
+                else:
+                    self.server.messages.append(b"".join(body).decode(errors="replace"))
+                    self.reply("250 queued")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), FakeSMTPHandler)
+    server.daemon_threads = True
+    server.failures = 0
+    server.messages = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def email_config(smtp_server, monkeypatch):
+    monkeypatch.setitem(main.EMAIL_CONFIG, "sender_email", "bot@example.com")
+    monkeypatch.setitem(main.EMAIL_CONFIG, "recipient_email", "agent@example.com")
+    config = dict(main.EMAIL_CONFIG)
+    config.update({
+        "smtp_server": "127.0.0.1",
+        "smtp_port": smtp_server.server_address[1],
+        "starttls": False,
+        "sender_password": "",
+        "timeout": 5,
+        "digest_window": 0,
+        "retry_base": 0.05,
+        "retry_max": 0.05,
+        "max_attempts": 3,
+    })
+    return config
+
+
+def lead(index: int) -> dict:
+    return {
+        "nome": f"Client {index}",
+        "email": f"client{index}@example.com",
+        "whatsapp": "07700900123",
+        "tipo_interesse": "buy",
+        "orcamento": "£500k",
+        "postcode": "SW1A 1AA",
+    }
+
+
+async def wait_until(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+
+def test_delivers_queued_leads(tmp_path: Path, smtp_server, email_config):
+    async def scenario():
+        queue = NotificationQueue(NotificationOutbox(tmp_path / "leads.db"), email_config)
+        queue.start()
+        assert await queue.enqueue([lead(1), lead(2)]) == 2
+        await wait_until(lambda: queue.sent == 2)
+        assert queue.stats()["pending"] == 0
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert len(smtp_server.messages) == 2
+    assert all("New_Lead_Captured" in message for message in smtp_server.messages)
+
+
+def test_retries_after_smtp_failure(tmp_path: Path, smtp_server, email_config):
+    smtp_server.failures = 2
+
+    async def scenario():
+        queue = NotificationQueue(NotificationOutbox(tmp_path / "leads.db"), email_config)
+        queue.start()
+        await queue.enqueue([lead(1)])
+        await wait_until(lambda: queue.sent == 1)
+        assert queue.retries == 2
+        assert queue.send_failures == 2
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert len(smtp_server.messages) == 1
+
+
+def test_gives_up_after_max_attempts(tmp_path: Path, smtp_server, email_config):
+    smtp_server.failures = 100
+
+    async def scenario():
+        queue = NotificationQueue(NotificationOutbox(tmp_path / "leads.db"), email_config)
+        queue.start()
+        await queue.enqueue([lead(1)])
+        await wait_until(lambda: queue.stats()["failed"] == 1)
+        assert queue.sent == 0
+        await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_pending_items_survive_restart(tmp_path: Path, smtp_server, email_config):
+    outbox = NotificationOutbox(tmp_path / "leads.db")
+    outbox.open()
+    outbox.add_many([{"lead": lead(1), "captured_at": "2026-01-01T10:00:00"}])
+    outbox.close()
+
+    async def scenario():
+        queue = NotificationQueue(NotificationOutbox(tmp_path / "leads.db"), email_config)
+        queue.start()
+        await wait_until(lambda: queue.sent == 1)
+        await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_digest_groups_a_burst(tmp_path: Path, smtp_server, email_config):
+    email_config["digest_window"] = 0.1
+
+    async def scenario():
+        queue = NotificationQueue(NotificationOutbox(tmp_path / "leads.db"), email_config)
+        queue.start()
+        await queue.enqueue([lead(1)])
+        await queue.enqueue([lead(2), lead(3)])
+        await wait_until(lambda: queue.sent == 3)
+        assert queue.digests == 1
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert len(smtp_server.messages) == 1
@@ -0,0 +1,90 @@
+"""Estado compartilhado entre workers (SQLite): as leituras e gravações saem do event loop"""
+
+import asyncio
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import main
+from backend.main import SharedStateDB, SQLiteResponseCache
+
+
+@pytest.fixture
+def shared(tmp_path: Path):
+    db = SharedStateDB(tmp_path / "state.db")
+    db.open()
+    yield db
+    db.close()
+
+
+def tracked(monkeypatch, target, name: str) -> list:
+    """Registra a thread em que o método síncrono roda"""
+    threads = []
+    original = getattr(target, name)
+
+    def wrapper(*args, **kwargs):
+        threads.append(threading.get_ident())
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(target, name, wrapper)
+    return threads
+
+
+def test_response_cache_runs_off_the_loop(shared, monkeypatch):
+    cache = SQLiteResponseCache(dict(main.RESPONSE_CACHE_CONFIG, enabled=True), shared)
+    gets = tracked(monkeypatch, cache, "_get")
+    puts = tracked(monkeypatch, cache, "_put")
+
+    async def scenario():
+        assert await cache.get("key") is None
+        await cache.put("key", "Olá!")
+        assert await cache.get("key") == "Olá!"
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(scenario())
+    assert len(gets) == 2 and len(puts) == 1
+    assert loop_thread not in gets + puts
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_context_cache_coordination_runs_off_the_loop(shared, monkeypatch):
+    config = dict(main.GEMINI_CONTEXT_CACHE_CONFIG, enabled=True, min_tokens=0)
+    cache = main.SystemPromptCache(config, shared)
+    # Outro worker já criou o cachedContent
+    shared.set_value(cache._shared_key(), "cachedContents/other-worker", time.time() + 3600)
+    reads = tracked(monkeypatch, shared, "get_value")
+    deletes = tracked(monkeypatch, shared, "delete_value")
+
+    async def scenario():
+        assert await cache.get_name() == "cachedContents/other-worker"
+        await cache.invalidate()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(scenario())
+    assert cache.adopted == 1 and cache.name is None
+    assert reads and deletes
+    assert loop_thread not in reads + deletes
+    assert shared.get_value(cache._shared_key()) is None
+
+
+def test_health_and_metrics_count_rows_off_the_loop(monkeypatch):
+    calls = []
+    stored_stats = main.stored_stats
+
+    def tracked_stats():
+        # Numa thread do to_thread não há event loop rodando
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        calls.append(threading.get_ident())
+        return stored_stats()
+
+    monkeypatch.setattr(main, "stored_stats", tracked_stats)
+    with TestClient(main.app) as client:
+        health = client.get("/api/health")
+        metrics = client.get("/metrics")
+    assert health.status_code == 200 and "sessions" in health.json()
+    assert metrics.status_code == 200 and "chat_sessions" in metrics.text
+    assert len(calls) == 2